@@ -0,0 +1,252 @@
+"""
+Block compressed captures.
+
+The records of a .dat capture are grouped into blocks of N records, each block
+compressed on its own with zlib or lzma. Offsets everywhere (the index, run
+tables, skipped ranges) stay offsets into the uncompressed record stream, so a
+capture and its compressed copy share an index, and loading a byte range only
+decompresses the blocks it overlaps.
+
+    header   MAGIC, codec, records per block
+    block    compressed size, raw size, raw start, records, compressed bytes
+    ...
+    table    one entry per block: file offset, raw start, raw size, records
+    footer   table offset, block count, TABLE_MAGIC
+
+The table is written when the writer is closed. If the recorder died before
+that, the blocks are walked instead, and a partly written last block is ignored.
+
+    blocks.py compress <capture.dat> [output] [--codec lzma] [--records N]
+    blocks.py decompress <capture.datz> [output]
+"""
+import sys
+import os
+import zlib
+import lzma
+import bisect
+import struct
+import argparse
+
+MAGIC = b'CMONBLK1'
+TABLE_MAGIC = b'CMONTBL1'
+EXTENSION = '.datz'
+
+HEADER = struct.Struct('=8sBI')
+BLOCK = struct.Struct('=IIQI')
+ENTRY = struct.Struct('=QQII')
+FOOTER = struct.Struct('=QI8s')
+
+ZLIB = 0
+LZMA = 1
+CODECS = {'zlib': ZLIB, 'lzma': LZMA}
+
+BLOCK_RECORDS = 256
+
+def compress(codec, data):
+    if codec == LZMA:
+        return lzma.compress(data)
+    return zlib.compress(data, 6)
+
+def decompress(codec, data):
+    if codec == LZMA:
+        return lzma.decompress(data)
+    return zlib.decompress(data)
+
+def is_blocks(filename):
+    with open(filename, 'rb') as fp:
+        return fp.read(len(MAGIC)) == MAGIC
+
+class Block():
+    def __init__(self, offset, start, size, records):
+        self.offset = offset
+        self.start = start
+        self.size = size
+        self.records = records
+
+    @property
+    def end(self):
+        return self.start+self.size
+
+class BlockFile():
+    def __init__(self, filename):
+        self.filename = filename
+        self.cache = (None, None)
+        with open(filename, 'rb') as fp:
+            magic, self.codec, self.block_records = HEADER.unpack(fp.read(HEADER.size))
+            if magic != MAGIC:
+                raise RuntimeError(f'{filename} is not a block compressed capture')
+            self.blocks, self.data_end = self.read_table(fp)
+        self.starts = [x.start for x in self.blocks]
+        self.size = self.blocks[-1].end if len(self.blocks) > 0 else 0
+
+    def read_table(self, fp):
+        """
+        Blocks and the file offset just past the last one
+        """
+        fp.seek(0, os.SEEK_END)
+        length = fp.tell()
+        if length >= HEADER.size+FOOTER.size:
+            fp.seek(length-FOOTER.size)
+            offset, count, magic = FOOTER.unpack(fp.read(FOOTER.size))
+            if magic == TABLE_MAGIC and offset+count*ENTRY.size+FOOTER.size == length:
+                fp.seek(offset)
+                raw = fp.read(count*ENTRY.size)
+                return [Block(*x) for x in ENTRY.iter_unpack(raw)], offset
+
+        #no table, the recorder didn't close the file
+        blocks = []
+        offset = HEADER.size
+        while offset+BLOCK.size <= length:
+            fp.seek(offset)
+            csize, size, start, records = BLOCK.unpack(fp.read(BLOCK.size))
+            if offset+BLOCK.size+csize > length:
+                break
+            blocks.append(Block(offset, start, size, records))
+            offset += BLOCK.size+csize
+        return blocks, offset
+
+    def block(self, idx):
+        if self.cache[0] == idx:
+            return self.cache[1]
+        info = self.blocks[idx]
+        with open(self.filename, 'rb') as fp:
+            fp.seek(info.offset)
+            csize, size, _, _ = BLOCK.unpack(fp.read(BLOCK.size))
+            data = decompress(self.codec, fp.read(csize))
+        self.cache = (idx, data)
+        return data
+
+    def read(self, start=0, end=None):
+        """
+        Uncompressed bytes [start, end) of the record stream
+        """
+        if end is None or end > self.size:
+            end = self.size
+        if start >= end:
+            return b''
+        first = max(bisect.bisect_right(self.starts, start)-1, 0)
+        parts = []
+        for idx in range(first, len(self.blocks)):
+            info = self.blocks[idx]
+            if info.start >= end:
+                break
+            data = self.block(idx)
+            parts.append(data[max(start-info.start, 0):end-info.start])
+        return b''.join(parts)
+
+#the table is reread when the file changes, e.g. while still being recorded
+_open = {}
+
+def open_blocks(filename):
+    stat = os.stat(filename)
+    key = (stat.st_mtime, stat.st_size)
+    cached = _open.get(filename, None)
+    if cached is None or cached[0] != key:
+        cached = _open[filename] = (key, BlockFile(filename))
+    return cached[1]
+
+def read_capture(filename, start=0, end=None):
+    """
+    Bytes [start, end) of a capture's record stream, compressed or not
+    """
+    if is_blocks(filename):
+        return open_blocks(filename).read(start, end)
+    with open(filename, 'rb') as fp:
+        fp.seek(start)
+        if end is None:
+            return fp.read()
+        return fp.read(end-start)
+
+class BlockWriter():
+    """
+    Appends records, compressing every block_records of them. Reopening an
+    existing file continues it.
+    """
+    def __init__(self, filename, codec=ZLIB, block_records=BLOCK_RECORDS):
+        self.filename = filename
+        self.pending = []
+        self.blocks = []
+
+        if os.path.exists(filename) and os.path.getsize(filename) > 0:
+            existing = BlockFile(filename)
+            self.codec = existing.codec
+            self.block_records = existing.block_records
+            self.blocks = existing.blocks
+            self.start = existing.size
+            self.fp = open(filename, 'r+b')
+            self.fp.truncate(existing.data_end)
+            self.fp.seek(existing.data_end)
+        else:
+            self.codec = codec
+            self.block_records = block_records
+            self.start = 0
+            self.fp = open(filename, 'wb')
+            self.fp.write(HEADER.pack(MAGIC, codec, block_records))
+
+    def write(self, record):
+        self.pending.append(record)
+        if len(self.pending) >= self.block_records:
+            self.flush_block()
+
+    def flush_block(self):
+        if len(self.pending) == 0:
+            return
+        data = b''.join(self.pending)
+        packed = compress(self.codec, data)
+        offset = self.fp.tell()
+        self.fp.write(BLOCK.pack(len(packed), len(data), self.start, len(self.pending)))
+        self.fp.write(packed)
+        self.fp.flush()
+        self.blocks.append(Block(offset, self.start, len(data), len(self.pending)))
+        self.start += len(data)
+        self.pending = []
+
+    def close(self):
+        self.flush_block()
+        offset = self.fp.tell()
+        self.fp.write(b''.join(ENTRY.pack(x.offset, x.start, x.size, x.records) for x in self.blocks))
+        self.fp.write(FOOTER.pack(offset, len(self.blocks), TABLE_MAGIC))
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def main(argv):
+    import scan
+
+    parser = argparse.ArgumentParser(description='Convert captures to and from the block compressed format.')
+    parser.add_argument('command', choices=['compress', 'decompress'])
+    parser.add_argument('capture')
+    parser.add_argument('output', nargs='?', default=None)
+    parser.add_argument('--codec', default='zlib', choices=list(CODECS.keys()))
+    parser.add_argument('--records', type=int, default=BLOCK_RECORDS, help='records per block')
+    args = parser.parse_args(argv[1:])
+
+    base = os.path.splitext(args.capture)[0]
+    if args.command == 'compress':
+        output = args.output or base+EXTENSION
+        raw = read_capture(args.capture)
+        scanner = scan.Scanner(raw)
+        #damaged stretches are kept as they are so offsets don't move
+        last = 0
+        if os.path.exists(output):
+            os.remove(output)
+        with BlockWriter(output, CODECS[args.codec], args.records) as writer:
+            for _, end in scanner.records():
+                writer.write(raw[last:end])
+                last = end
+            if last < len(raw):
+                writer.write(raw[last:])
+    else:
+        output = args.output or base+'.dat'
+        raw = read_capture(args.capture)
+        with open(output, 'wb') as fp:
+            fp.write(raw)
+
+    print(f'{args.capture} ({os.path.getsize(args.capture)} bytes) -> {output} ({os.path.getsize(output)} bytes)')
+
+if __name__ == '__main__':
+    main(sys.argv)
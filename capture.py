@@ -0,0 +1,329 @@
+"""
+Record CelesteTAS and tuw in one process, into one merged stream.
+
+Both shared regions are polled from a single loop, each tick reading whichever
+changed, so there is one wakeup per tick instead of one per recorder and every
+record is stamped from the same clock. Stamps are time.monotonic() anchored to
+the wall clock at start, so they never step backwards and still line up with
+video. Change detection is a byte compare for CelesteTAS and the sequence number
+for tuw, nothing is parsed while recording, and records go through one buffered
+file flushed every FLUSH_INTERVAL seconds instead of opening the output for
+every record like main.py does.
+
+Records are (stamp, source, payload size) then the payload exactly as read:
+
+    source 0    CelesteTAS message, as stored after the stamp in a .dat capture
+    source 1    tuw state, as stored in a .tuw file
+
+Records are in stamp order. `capture.py split` writes them back out as a .dat
+and a .tuw, so the existing tools read them, and merges the two by game time
+into <name>_merged.npz: every CelesteTAS state with the inputs and death count
+of the tuw state of the same game frame nearest in time, see MERGED.
+
+Game frames are matched on the assumption that the CelesteTAS chapter timer
+frame and the tuw game time (100 ns ticks, frame = ticks*60/1e7) both count the
+session time of the chapter. replay.py builds its tuw game time from the
+CelesteTAS frame, so replays always agree; on a real capture split prints how
+many states matched and warns when it is few.
+
+    capture.py [--celestetas <file>] [--tuw <file>] [--output <file>]
+    capture.py split <file.cmon>
+"""
+import sys
+import os
+import io
+import time
+import struct
+import signal
+import argparse
+
+import sources
+import tuw
+
+CELESTETAS = 0
+TUW = 1
+NAMES = ['celestetas', 'tuw']
+
+RECORD = struct.Struct('=dBI')
+EXTENSION = '.cmon'
+
+#seconds of records that may be lost if the recorder dies
+FLUSH_INTERVAL = 1.0
+
+#split warns when fewer CelesteTAS states than this find their tuw state
+MIN_MATCHED = 0.5
+
+#columns of <name>_merged.npz, one row per CelesteTAS state in stamp order
+MERGED = {
+    'offset': 'byte offset of the state in <name>.dat, Message.file_start_idx',
+    'stamp': 'recorder clock',
+    'frame': 'chapter timer frame',
+    'tuw': 'index of the matched state in inputs.InputColumns.from_file(<name>.tuw), -1 if none',
+    'lag': 'tuw stamp minus CelesteTAS stamp in seconds, nan if unmatched',
+    'deaths': 'tuw death count, -1 if unmatched',
+    'buttons': 'tuw.BUTTONS bitmask, 0 if unmatched',
+    'directions': 'tuw.DIRECTIONS bitmask, 0 if unmatched',
+    'aim_x': 'analog aim',
+    'aim_y': 'analog aim',
+    }
+
+class Clock():
+    """
+    Monotonic seconds on the scale of time.time()
+    """
+    def __init__(self):
+        self.wall = time.time()
+        self.start = time.monotonic()
+
+    def __call__(self):
+        return self.wall + time.monotonic()-self.start
+
+class CelesteTasSource():
+    def __init__(self, fp):
+        self.fp = fp
+        self.last = None
+
+    def poll(self):
+        """
+        The message if it changed since the last poll, else None
+        """
+        fp = self.fp
+        fp.seek(0)
+        head = fp.read(9)
+        size = struct.unpack_from('=I', head, 5)[0]
+        raw = head + fp.read(size)
+        if raw == self.last:
+            return None
+        self.last = raw
+        return raw
+
+class TuwSource():
+    def __init__(self, fp):
+        self.fp = fp
+        self.sequence = None
+        self.skipped = 0
+
+    def poll(self):
+        fp = self.fp
+        fp.seek(0)
+        size = struct.unpack('=H', fp.read(2))[0]
+        if size == 0:
+            return None
+        raw = fp.read(size)
+        sequence = struct.unpack_from('=I', raw)[0]
+        if sequence == self.sequence:
+            return None
+        if self.sequence is not None and sequence > self.sequence+1:
+            self.skipped += sequence-self.sequence-1
+        self.sequence = sequence
+        return raw
+
+class Stats():
+    def __init__(self):
+        self.start = time.time()
+        self.cpu_start = time.process_time()
+        self.polls = 0
+        self.unique = [0, 0]
+        self.skipped = 0
+
+    def __str__(self):
+        wall = time.time()-self.start
+        cpu = time.process_time()-self.cpu_start
+        counts = ', '.join(f'{count} {name}' for count, name in zip(self.unique, NAMES))
+        return (f'{counts} states captured in {wall:.1f} s over {self.polls} polls, '
+            + f'{self.skipped} tuw sequence numbers missed, '
+            + f'{cpu:.2f} s cpu ({cpu/max(wall, 1e-9)*100:.1f}%)')
+
+def record(polled, out, stats, interval=0.001):
+    """
+    polled is a list of (source id, source) to read every tick
+    """
+    clock = Clock()
+    flushed = clock()
+    while True:
+        time.sleep(interval)
+        stats.polls += 1
+        now = clock()
+        for source_id, source in polled:
+            try:
+                raw = source.poll()
+            except (ValueError, struct.error):
+                continue
+            if raw is None:
+                continue
+            out.write(RECORD.pack(now, source_id, len(raw)) + raw)
+            stats.unique[source_id] += 1
+        if now-flushed > FLUSH_INTERVAL:
+            out.flush()
+            flushed = now
+
+def read_records(filename):
+    """
+    (stamp, source, payload) of every record
+    """
+    with open(filename, 'rb') as fp:
+        raw = fp.read()
+    offset = 0
+    while offset+RECORD.size <= len(raw):
+        stamp, source, size = RECORD.unpack_from(raw, offset)
+        offset += RECORD.size
+        if offset+size > len(raw):
+            break
+        yield stamp, source, raw[offset:offset+size]
+        offset += size
+
+def align(cel_stamp, cel_frame, tuw_stamp, tuw_frame):
+    """
+    For every CelesteTAS state the index of the tuw record with the same game
+    frame nearest in time, -1 if there is none
+    """
+    import numpy as np
+
+    result = np.full(len(cel_stamp), -1, dtype=np.int64)
+    if len(tuw_stamp) == 0 or len(cel_stamp) == 0:
+        return result
+    #one sortable key, frame first then stamp within the frame
+    base = min(cel_stamp.min(), tuw_stamp.min())
+    span = max(cel_stamp.max(), tuw_stamp.max())-base+1
+    tuw_key = tuw_frame*span + (tuw_stamp-base)
+    order = np.argsort(tuw_key)
+    pos = np.searchsorted(tuw_key[order], cel_frame*span + (cel_stamp-base))
+
+    best = np.full(len(cel_stamp), np.inf)
+    for candidate in [pos-1, pos]:
+        valid = (candidate >= 0) & (candidate < len(order))
+        idx = order[np.clip(candidate, 0, len(order)-1)]
+        dist = np.where(valid & (tuw_frame[idx] == cel_frame), np.abs(tuw_stamp[idx]-cel_stamp), np.inf)
+        better = dist < best
+        result[better] = idx[better]
+        best[better] = dist[better]
+    return result
+
+def celestetas_frame(payload):
+    from main import Message
+
+    msg = Message(io.BytesIO(payload))
+    try:
+        msg.decode_info_string()
+    except Exception:
+        return -1
+    return msg.frame
+
+def merged_file(filename):
+    return os.path.splitext(filename)[0]+'_merged.npz'
+
+def split(filename):
+    """
+    Write the records back out as <name>.dat and <name>.tuw, and the
+    CelesteTAS states joined to the tuw state of the same game frame as
+    <name>_merged.npz, see MERGED. Returns the merged columns.
+    """
+    import numpy as np
+    from inputs import InputColumns
+
+    base = os.path.splitext(filename)[0]
+    offset = []
+    stamp = []
+    frame = []
+    tuw_count = 0
+    with open(base+'.dat', 'wb') as dat, open(base+tuw.EXTENSION, 'wb') as tw:
+        for record_stamp, source, payload in read_records(filename):
+            if source == CELESTETAS:
+                offset.append(dat.tell())
+                stamp.append(record_stamp)
+                frame.append(celestetas_frame(payload))
+                dat.write(struct.pack('d', record_stamp) + payload)
+            elif source == TUW:
+                tw.write(tuw.RECORD.pack(record_stamp, len(payload)) + payload)
+                tuw_count += 1
+    print(f'{base}.dat: {len(stamp)} CelesteTAS states, {base}{tuw.EXTENSION}: {tuw_count} tuw states')
+
+    stamp = np.array(stamp, dtype=np.float64)
+    frame = np.array(frame, dtype=np.int64)
+    inputs = InputColumns.from_file(base+tuw.EXTENSION)
+    match = align(stamp, frame, inputs.stamp, inputs.frame)
+    matched = match >= 0
+    pick = np.where(matched, match, 0)
+
+    def joined(values, empty):
+        values = np.asarray(values)
+        if len(values) == 0:
+            return np.full(len(match), empty, dtype=values.dtype)
+        return np.where(matched, values[pick], empty).astype(values.dtype)
+
+    merged = {
+        'offset': np.array(offset, dtype=np.int64),
+        'stamp': stamp,
+        'frame': frame,
+        'tuw': match,
+        'lag': joined(inputs.stamp, np.nan)-stamp,
+        'deaths': joined(inputs.deaths, -1),
+        'buttons': joined(inputs.buttons, 0),
+        'directions': joined(inputs.directions, 0),
+        'aim_x': joined(inputs.aim_x, 0),
+        'aim_y': joined(inputs.aim_y, 0),
+        }
+    np.savez(merged_file(filename), **merged)
+
+    if matched.any():
+        lag = merged['lag'][matched]*1000
+        print(f'{matched.mean():.1%} of CelesteTAS states have a tuw state of the same game frame, '
+            + f'tuw {np.median(lag):+.1f} ms median, {np.percentile(np.abs(lag), 99):.1f} ms p99 apart')
+    if len(stamp) > 0 and matched.mean() < MIN_MATCHED:
+        print('Few states line up by game frame, the chapter timer and the tuw game time may not be the same clock')
+    print(f'Wrote {merged_file(filename)}')
+    return merged
+
+def stop(signum, frame):
+    raise KeyboardInterrupt
+
+def main(argv):
+    if len(argv) > 1 and argv[1] == 'split':
+        parser = argparse.ArgumentParser(description='Split a merged capture into a .dat and a .tuw.')
+        parser.add_argument('capture')
+        args = parser.parse_args(argv[2:])
+        split(args.capture)
+        return
+
+    parser = argparse.ArgumentParser(description='Record CelesteTAS and tuw state into one merged capture.')
+    parser.add_argument('--celestetas', default=None,
+        help='file backed shared memory to read instead of the CelesteTAS mmap, e.g. from replay.py')
+    parser.add_argument('--tuw', default=None, help=f'shared file to read instead of {sources.TUW_PATH}')
+    parser.add_argument('--no-celestetas', action='store_true')
+    parser.add_argument('--no-tuw', action='store_true')
+    parser.add_argument('--interval', type=float, default=0.001, help='seconds between polls')
+    parser.add_argument('--output', '-o', default=None)
+    args = parser.parse_args(argv[1:])
+
+    outfile = args.output
+    if outfile is None:
+        outfile = time.strftime('%Y-%m-%d-%H%M%S')+EXTENSION
+
+    #stop cleanly when killed by a test harness too
+    signal.signal(signal.SIGTERM, stop)
+
+    regions = []
+    polled = []
+    if not args.no_celestetas:
+        regions.append(sources.open_celestetas(args.celestetas))
+        polled.append((CELESTETAS, CelesteTasSource(regions[-1])))
+    if not args.no_tuw:
+        regions.append(sources.open_tuw(args.tuw))
+        polled.append((TUW, TuwSource(regions[-1])))
+    if len(polled) == 0:
+        raise RuntimeError('Nothing to record')
+
+    stats = Stats()
+    try:
+        with open(outfile, 'ab') as out:
+            record(polled, out, stats, args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for region in regions:
+            region.close()
+    stats.skipped = sum(x.skipped for _, x in polled if isinstance(x, TuwSource))
+    print(stats)
+
+if __name__ == '__main__':
+    main(sys.argv)
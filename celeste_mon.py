@@ -0,0 +1,183 @@
+"""
+Single entry point for working with captures.
+
+    celeste_mon.py list <data file>
+    celeste_mon.py index <data file> [data file ...]
+    celeste_mon.py translate <data file | directory> [...] [--jobs N] [--force]
+    celeste_mon.py plot <data file> <room name> [room name ...] [--output <image>] [--lod] [--geometry]
+    celeste_mon.py export <data file> [--format csv|json|edl|ffconcat] [--output <file>]
+    celeste_mon.py stats <data file> [room name ...]
+    celeste_mon.py stats --history <history.json> [room name ...] [--add <data file> ...] [--sessions]
+
+Heavy dependencies (matplotlib, NumPy, pythonnet) are only imported by the
+subcommands that use them, so listing rooms from an existing index stays fast.
+"""
+import sys
+import argparse
+
+import profiling
+
+def cmd_list(args):
+    from decode import RoomSet
+
+    for infile in args.captures:
+        RoomSet(infile).print_rooms()
+
+def cmd_index(args):
+    from decode import RoomSet
+
+    for infile in args.captures:
+        rooms = RoomSet(infile, reindex=True)
+        print(f'{infile}: {len(rooms.index)} rooms, {len(rooms.runs["room"])} runs')
+
+def cmd_translate(args):
+    import translate
+
+    argv = [sys.argv[0], *args.paths]
+    if args.jobs is not None:
+        argv += ['--jobs', str(args.jobs)]
+    if args.force:
+        argv.append('--force')
+    translate.main(argv)
+
+def cmd_plot(args):
+    import matplotlib
+    if args.output is not None:
+        matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+    from decode import RoomSet
+
+    rooms = RoomSet(args.capture)
+    fig, ax = plt.subplots()
+    for name in args.rooms:
+        rooms.plot_room(ax, name, lod=args.lod, geometry=args.geometry)
+    rooms.configure_ax(ax)
+
+    if args.output is None:
+        plt.show()
+    else:
+        fig.savefig(args.output, dpi=args.dpi)
+
+def write_csv(fp, rows, fields):
+    import csv
+
+    writer = csv.DictWriter(fp, fieldnames=fields, lineterminator='\n')
+    writer.writeheader()
+    writer.writerows(rows)
+
+def write_json(fp, rows, fields):
+    import json
+
+    json.dump(rows, fp)
+
+def cmd_export(args):
+    from decode import RoomSet, RUN_FIELDS
+
+    rooms = RoomSet(args.capture)
+    runs = rooms.runs
+    rows = [{k: runs[k][idx] for k in RUN_FIELDS} for idx in range(len(runs['room']))]
+
+    if args.format in {'csv', 'json'}:
+        writer = {'csv': write_csv, 'json': write_json}[args.format]
+        write = lambda fp: writer(fp, rows, RUN_FIELDS)
+    else:
+        import video
+
+        if args.video is None:
+            sys.exit(f'--format {args.format} needs --video')
+        table = video.RunTable([rooms])
+        videos = [video.Video(path, video.parse_time(start), args.fps) for path, start in args.video]
+        clips = video.make_clips(table, table.select_first_last(), videos)
+        write = lambda fp: video.WRITERS[args.format](fp, clips)
+
+    if args.output is None:
+        write(sys.stdout)
+    else:
+        with open(args.output, 'w', newline='') as fp:
+            write(fp)
+
+def cmd_stats(args):
+    import stats
+
+    #the single capture form keeps its <data file> [room name ...] shape
+    names = args.names
+    if args.history is None:
+        if len(names) == 0:
+            args.parser.error('a data file is needed, or --history')
+        if len(args.add) > 0:
+            args.parser.error('--add needs --history')
+        from decode import RoomSet
+        rooms = names[1:]
+        rows = stats.room_stats(RoomSet(names[0]))
+    else:
+        rooms = names
+        history = stats.History(args.history)
+        for infile in args.add:
+            history.add(infile)
+        history.save()
+        if args.sessions:
+            for name in rooms:
+                for infile, row in history.timeline(name):
+                    print(stats.format_row(f'{name} {infile}', row))
+            return
+        rows = history.rooms()
+
+    if len(rooms) == 0:
+        rooms = list(rows.keys())
+    for name in rooms:
+        if name in rows:
+            print(stats.format_row(name, rows[name]))
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='Celeste game state capture tools.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('list', help='list rooms and run counts')
+    p.add_argument('captures', nargs='+')
+    p.set_defaults(func=cmd_list)
+
+    p = commands.add_parser('index', help='regenerate capture indices')
+    p.add_argument('captures', nargs='+')
+    p.set_defaults(func=cmd_index)
+
+    p = commands.add_parser('translate', help='convert captures to the compact .bin format')
+    p.add_argument('paths', nargs='+', help='captures, or directories to translate in parallel')
+    p.add_argument('--jobs', '-j', type=int, default=None)
+    p.add_argument('--force', action='store_true')
+    p.set_defaults(func=cmd_translate)
+
+    p = commands.add_parser('plot', help='plot the runs of rooms')
+    p.add_argument('capture')
+    p.add_argument('rooms', nargs='+')
+    p.add_argument('--output', '-o', default=None, help='save to an image instead of showing a window')
+    p.add_argument('--dpi', type=int, default=200)
+    p.add_argument('--lod', action='store_true', help='only draw the visible points, as tile densities when zoomed out')
+    p.add_argument('--geometry', action='store_true', help='draw walls and floors inferred from the runs behind them')
+    p.set_defaults(func=cmd_plot)
+
+    p = commands.add_parser('export', help='export run summaries or video edit lists')
+    p.add_argument('capture')
+    p.add_argument('--format', default='csv', choices=['csv', 'json', 'edl', 'ffconcat'])
+    p.add_argument('--video', nargs=2, action='append', default=None, metavar=('PATH', 'START'))
+    p.add_argument('--fps', type=float, default=60)
+    p.add_argument('--output', '-o', default=None)
+    p.set_defaults(func=cmd_export)
+
+    p = commands.add_parser('stats', help='per room attempt statistics')
+    p.add_argument('names', nargs='*', metavar='name',
+        help='data file then room names, or only room names with --history')
+    p.add_argument('--history', default=None, help='json file accumulating sessions across captures')
+    p.add_argument('--add', action='append', default=[], metavar='CAPTURE',
+        help='with --history, add a capture as a session, can be repeated')
+    p.add_argument('--sessions', action='store_true', help='with --history, one line per session of each room')
+    p.set_defaults(func=cmd_stats, parser=p)
+
+    return parser
+
+def main(argv):
+    args = make_parser().parse_args(argv[1:])
+    args.func(args)
+
+if __name__ == '__main__':
+    argv, run = profiling.parse_argv(sys.argv)
+    run(main, argv)
@@ -0,0 +1,210 @@
+"""
+Columnar (struct of arrays) view of runs, for the analyses that want to work on
+every frame of a room at once instead of walking Message objects.
+
+Frames of all runs are concatenated. Run i occupies frames
+offsets[i]:offsets[i+1] and run[k] is the run index of frame k.
+"""
+import numpy as np
+
+from model import state_to_idx, status_to_idx
+
+WALLS = {None: 0, 'WallL': 1, 'WallR': 2}
+
+TILE = 8
+
+class Columns():
+    def __init__(self, x, y, sx, sy, stamp, frame, state, status, wall, offsets, extra=None):
+        self.x = x
+        self.y = y
+        self.sx = sx
+        self.sy = sy
+        self.stamp = stamp
+        self.frame = frame
+        self.state = state
+        self.status = status
+        self.wall = wall
+        self.offsets = offsets
+        self.extra = {} if extra is None else extra
+
+        self.run = np.repeat(np.arange(len(offsets)-1, dtype=np.int32), np.diff(offsets))
+        #True on the first frame of every run, so transitions never cross runs
+        self.run_start = np.zeros(len(x), dtype=bool)
+        self.run_start[offsets[:-1][np.diff(offsets) > 0]] = True
+
+    def __len__(self):
+        return len(self.x)
+
+    def runs(self):
+        return len(self.offsets)-1
+
+    def get(self, name):
+        if name in self.extra:
+            return self.extra[name]
+        return getattr(self, name)
+
+    def run_slice(self, idx):
+        return slice(self.offsets[idx], self.offsets[idx+1])
+
+    def local_frame(self, idx):
+        """
+        Frame index within its own run for each global frame index
+        """
+        return idx - self.offsets[self.run[idx]]
+
+    @staticmethod
+    def from_runs(runs):
+        """
+        Build from decode.Run objects
+        """
+        x = []
+        y = []
+        sx = []
+        sy = []
+        stamp = []
+        frame = []
+        state = []
+        status = []
+        wall = []
+        offsets = [0]
+
+        state_bits = {k: 1<<v for k,v in state_to_idx.items()}
+        status_bits = {k: 1<<v for k,v in status_to_idx.items()}
+
+        for run in runs:
+            for msg in run.msgs:
+                x.append(msg.pos[0])
+                y.append(msg.pos[1])
+                sx.append(msg.speed[0])
+                sy.append(msg.speed[1])
+                stamp.append(msg.stamp)
+                frame.append(msg.frame)
+                mask = 0
+                for name in msg.state:
+                    mask |= state_bits.get(name, 0)
+                state.append(mask)
+                mask = 0
+                for name in msg.statuses:
+                    mask |= status_bits.get(name, 0)
+                status.append(mask)
+                wall.append(WALLS.get(msg.wall, 0))
+            offsets.append(len(x))
+
+        return Columns(
+            np.array(x, dtype=np.float32),
+            np.array(y, dtype=np.float32),
+            np.array(sx, dtype=np.float32),
+            np.array(sy, dtype=np.float32),
+            np.array(stamp, dtype=np.float64),
+            np.array(frame, dtype=np.int32),
+            np.array(state, dtype=np.uint32),
+            np.array(status, dtype=np.uint32),
+            np.array(wall, dtype=np.uint8),
+            np.array(offsets, dtype=np.int64),
+            )
+
+    @staticmethod
+    def from_rooms(rooms):
+        runs = []
+        for room in rooms:
+            runs.extend(room.runs)
+        return Columns.from_runs(runs)
+
+def state_mask(*names):
+    mask = 0
+    for name in names:
+        mask |= 1<<state_to_idx[name]
+    return mask
+
+def status_mask(*names):
+    mask = 0
+    for name in names:
+        mask |= 1<<status_to_idx[name]
+    return mask
+
+class Grid():
+    """
+    Tile grid in absolute tile coordinates, so grids from different sessions
+    can be lined up.
+    """
+    def __init__(self, x0, y0, width, height, tile=TILE):
+        self.x0 = int(x0)
+        self.y0 = int(y0)
+        self.width = int(width)
+        self.height = int(height)
+        self.tile = tile
+
+    @staticmethod
+    def covering(x, y, tile=TILE):
+        if len(x) == 0:
+            return Grid(0, 0, 1, 1, tile)
+        x0 = int(np.floor(x.min()/tile))
+        y0 = int(np.floor(y.min()/tile))
+        x1 = int(np.floor(x.max()/tile))
+        y1 = int(np.floor(y.max()/tile))
+        return Grid(x0, y0, x1-x0+1, y1-y0+1, tile)
+
+    def union(self, other):
+        x0 = min(self.x0, other.x0)
+        y0 = min(self.y0, other.y0)
+        x1 = max(self.x0+self.width, other.x0+other.width)
+        y1 = max(self.y0+self.height, other.y0+other.height)
+        return Grid(x0, y0, x1-x0, y1-y0, self.tile)
+
+    def tiles(self):
+        return self.width*self.height
+
+    def cell(self, x, y):
+        tx = np.floor(x/self.tile).astype(np.int64) - self.x0
+        ty = np.floor(y/self.tile).astype(np.int64) - self.y0
+        return ty*self.width + tx
+
+    def to_array(self):
+        return np.array([self.x0, self.y0, self.width, self.height, self.tile], dtype=np.int64)
+
+    @staticmethod
+    def from_array(arr):
+        return Grid(*[int(x) for x in arr])
+
+#array in every sidecar cache holding the decode.INDEX_VERSION it was built for
+CACHE_VERSION = 'index_version'
+
+def cache_valid(filename, infile):
+    """
+    True if the sidecar cache filename is newer than infile and was built from
+    the current run segmentation, whose run numbering it relies on
+    """
+    import os
+    from decode import INDEX_VERSION
+
+    if not os.path.exists(filename) or os.path.getmtime(filename) < os.path.getmtime(infile):
+        return False
+    with np.load(filename) as data:
+        return CACHE_VERSION in data.files and int(data[CACHE_VERSION]) == INDEX_VERSION
+
+def cache_version():
+    from decode import INDEX_VERSION
+
+    return {CACHE_VERSION: np.array(INDEX_VERSION)}
+
+def room_cache(filename, infile, room_name, marker, load, build):
+    """
+    Per room object cached in one npz next to infile, its arrays stored under
+    a '<room>/' prefix. marker is an array every cached room has, load is the
+    from_arrays(data, prefix) of the cached type and build() makes the object
+    when the room is missing. The file is ignored when it is stale, see
+    cache_valid.
+    """
+    arrays = {}
+    prefix = f'{room_name}/'
+    if cache_valid(filename, infile):
+        with np.load(filename) as data:
+            arrays = dict(data)
+        if f'{prefix}{marker}' in arrays:
+            return load(arrays, prefix)
+
+    result = build()
+    arrays.update(result.to_arrays(prefix))
+    arrays.update(cache_version())
+    np.savez(filename, **arrays)
+    return result
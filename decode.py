@@ -7,10 +7,14 @@ import re
 import itertools
 import json
 import os
+import io
 from collections import defaultdict
 
-from matplotlib import pyplot as plt
-from matplotlib import ticker, patches
+import blocks
+import profiling
+import scan
+import stats
+from model import state_to_idx, room_symbols, token_symbols
 
 class MessageId(enum.Enum):
     default = 0x00
@@ -27,7 +31,8 @@ class MessageId(enum.Enum):
     return_data = 0x31
     update_lines = 0x32
 
-OFFSETS = set()
+#stamp, message id, signature, data size
+HEADER = struct.Struct('=dBII')
 
 states = {
 'StNormal',
@@ -81,6 +86,8 @@ class Bounds():
             self.bounds[3] = max(self.bounds[3], other.bounds[3])
 
     def plot(self, ax, line='k', fill='none', zorder=-10):
+        from matplotlib import patches
+
         bounds = self.bounds        
         rect = patches.Rectangle(
                     (bounds[0], bounds[2]), bounds[1]-bounds[0], bounds[3]-bounds[2],
@@ -88,46 +95,53 @@ class Bounds():
                     )
         ax.add_patch(rect)
 
+LIFTBOOST_RE = re.compile(r'.*?\((.*)\): (.*?), (.*)')
+
 class Message():
-    def __init__(self, fp):
+    def __init__(self, fp, parse=True):
         self.file_start_idx = fp.tell()
 
-        self.stamp_raw = fp.read(8)
-        if len(self.stamp_raw) == 0:
+        head = fp.read(HEADER.size)
+        if len(head) == 0:
             raise RuntimeError('done')
 
-        self.stamp = struct.unpack('d', self.stamp_raw)[0]
-        self.id_raw = fp.read(1)
-        id_ = ord(self.id_raw)
+        self.stamp, id_, self.signature, self.size = HEADER.unpack(head)
+        self.stamp_raw = head[0:8]
+        self.id_raw = head[8:9]
         self.id = MessageId(id_)
-        self.sig_raw = fp.read(4)
-        self.signature = struct.unpack('I', self.sig_raw)[0]
-        self.size_raw = fp.read(4)
-        self.size = struct.unpack('I', self.size_raw)[0]
+        self.sig_raw = head[9:13]
+        self.size_raw = head[13:17]
         self.data = fp.read(self.size)
 
         self.file_end_idx = fp.tell()-1
 
-        self.parse()
+        if parse:
+            self.parse()
 
     def encode(self):
         stamp_raw = struct.pack('f', self.stamp)
         return stamp_raw + self.id_raw + self.sig_raw + self.size_raw + self.data
 
+    #decoded on first access, index generation never needs them
+    LAZY = {'speed', 'stamina', 'liftboost', 'retained', 'retain_value', 'statuses'}
+
+    def __getattr__(self, name):
+        if name in Message.LAZY and '_detail_lines' in self.__dict__:
+            self.decode_details()
+            #liftboost and stamina are only there if their line was
+            if name in self.__dict__:
+                return self.__dict__[name]
+        raise AttributeError(name)
+
     def parse(self):
+        """
+        Cheap first pass: position, room, frame, states and run ending
+        conditions. Everything else is decoded by decode_details() on first
+        access.
+        """
         self.is_state = False
         self.nocontrol = False
         self.dead = False
-        self.retained = False
-        self.retain_value = 0
-        self.statuses = []
-
-        try:
-            val = struct.unpack('>H', self.data[69:71])[0]
-            print(self.data[69:71])
-            OFFSETS.add(val)
-        except:
-            print(len(self.data))
 
         #find status string
         offset = self.data.find(b'Pos')
@@ -141,33 +155,35 @@ class Message():
             self.status_string = raw
 
         if len(self.status_string) == 0:
-            pass
+            self.retained = False
+            self.retain_value = 0
+            self.statuses = []
         else:
             self.decode_info_string()
 
-    def decode_status_line(self, line):
-        liftboost_re = '.*?\((.*)\): (.*?), (.*)'
+    def decode_states(self, line):
+        parts = line.split()
+        self.state = []
+        self.wall = None
+        for state in parts[2:]:
+            if 'St' in state:
+                if state == 'StIntroRespawn':
+                    self.dead = True
+                self.state.append(token_symbols.intern(state))
+            elif 'Wall' in state:
+                self.wall = token_symbols.intern(state)
+            else:
+                print(f'Unhandled state: {state}')
 
+    def decode_status_line(self, line):
         if line.startswith('Stamina'):
             parts = line.split()
             stam = parts[1]
             self.stamina = float(stam)
-            self.state = []
-            self.wall = None
-            for state in parts[2:]:
-                if 'St' in state:
-                    if state == 'StIntroRespawn':
-                        self.dead = True
-                    self.state.append(state)
-                elif 'Wall' in state:
-                    self.wall = state
-                else:
-                    print(f'Unhandled state: {state}')
         elif line.startswith('LiftBoost'):
-            m = re.match(liftboost_re, line)
-            self.liftboost = m .groups()
+            self.liftboost = LIFTBOOST_RE.match(line).groups()
         elif line.startswith('NoControl'):
-            self.nocontrol = True
+            pass
         elif line.startswith('Retained'):
             self.retained = True
             self.retain_value = float(line.split(' ')[-1])
@@ -176,42 +192,73 @@ class Message():
             for part in parts:
                 if '(' in part:
                     part = part.split('(')[0]
-                if part == 'Dead':
-                    self.dead=True
-                self.statuses.append(part)
+                self.statuses.append(token_symbols.intern(part))
 
     def decode_info_string(self):
-        lines = [x.strip() for x in self.status_string.split('\n')]
+        lines = self.status_string.split('\n')
 
         #position
         _, x, y = lines[0].split()
         self.pos = (float(x[:-1]), -float(y))
 
-        #speed
-        _, x, y = lines[1].split()       
-        self.speed = (float(x[:-1]), -float(y))
-
-        #velocity
-        _, x, y = lines[2].split()
-        self.speed = (float(x[:-1]), -float(y))
+        #the detail lines are decoded later, outside read_file's check for
+        #undecodable messages, so make sure here that they will decode
+        for line in lines[1:3]:
+            _, x, y = line.split()
+            float(x[:-1])
+            float(y)
 
+        self.state = []
+        self.wall = None
         for line in lines[3:-1]:
-            self.decode_status_line(line)
+            line = line.strip()
+            if line.startswith('Stamina'):
+                self.decode_states(line)
+                float(line.split()[1])
+            elif line.startswith('LiftBoost'):
+                if LIFTBOOST_RE.match(line) is None:
+                    raise ValueError(f'Bad LiftBoost line: {line}')
+            elif line.startswith('Retained'):
+                float(line.split(' ')[-1])
+            elif line.startswith('NoControl'):
+                self.nocontrol = True
+            elif 'Dead' in line:
+                for part in line.split():
+                    if part.split('(')[0] == 'Dead':
+                        self.dead = True
 
         try:
             #TODO: handle truncated lines
             room, _, time = lines[-1].split()
-            self.room = room[1:-1]
+            self.room = room_symbols.intern(room[1:-1])
             _, frame = time.split('(')
             frame = frame.split(')')[0]
             self.frame = int(frame)
         except:
-            self.room = lines[-1].split(']')[0][1:]
+            self.room = room_symbols.intern(lines[-1].strip().split(']')[0][1:])
             self.frame = -1
             print(lines[-1])
 
+        self._detail_lines = lines
         self.is_state=True
 
+    def decode_details(self):
+        lines = [x.strip() for x in self.__dict__.pop('_detail_lines')]
+        self.retained = False
+        self.retain_value = 0
+        self.statuses = []
+
+        #speed
+        _, x, y = lines[1].split()       
+        self.speed = (float(x[:-1]), -float(y))
+
+        #velocity
+        _, x, y = lines[2].split()
+        self.speed = (float(x[:-1]), -float(y))
+
+        for line in lines[3:-1]:
+            self.decode_status_line(line)
+
     def __str__(self):
         return f'{self.pos}'
 
@@ -219,6 +266,17 @@ class Message():
         return str(self)
 
 
+#frames the chapter timer may get ahead of the wall clock between two states
+#before it counts as a savestate load
+JUMP_SLACK = 60
+
+def timer_jump(dt, dframe):
+    """
+    True if the chapter timer moved in a way only a savestate load (or chapter
+    restart) explains: backwards, or forwards faster than real time
+    """
+    return dframe < 0 or dframe > dt*60 + JUMP_SLACK
+
 class Run():
     def __init__(self):
         self.msgs = []
@@ -230,11 +288,62 @@ class Run():
     def valid(self):
         return len(self.msgs) != 0
 
+    def summary(self):
+        first = self.msgs[0]
+        last = self.msgs[-1]
+
+        bounds = Bounds()
+        state_mask = 0
+        for msg in self.msgs:
+            bounds.update(*msg.pos)
+            for state in msg.state:
+                state_mask |= 1<<state_to_idx.get(state, 31)
+
+        if first.frame >= 0 and last.frame >= first.frame:
+            frames = last.frame - first.frame + 1
+        else:
+            frames = len(self.msgs)
+
+        return {
+            'start': first.file_start_idx,
+            'end': last.file_end_idx,
+            'start_stamp': first.stamp,
+            'end_stamp': last.stamp,
+            'dead': self.dead,
+            'nocontrol': self.nocontrol,
+            'savestate': self.savestate,
+            'msgs': len(self.msgs),
+            'frames': frames,
+            'xmin': bounds.bounds[0],
+            'xmax': bounds.bounds[1],
+            'ymin': bounds.bounds[2],
+            'ymax': bounds.bounds[3],
+            'states': state_mask,
+            }
+
+    @staticmethod
+    def from_msgs(msgs):
+        run = Run()
+        for msg in msgs:
+            if not msg.is_state:
+                continue
+            if run.add_msg(msg):
+                break
+        return run
+
     def add_msg(self, msg):
         if self.done:
             print('Cant add msg: run complete.')
             return self.done
 
+        #the state after a savestate load starts the next run instead
+        if self.valid():
+            last = self.msgs[-1]
+            if msg.frame >= 0 and last.frame >= 0 and timer_jump(msg.stamp-last.stamp, msg.frame-last.frame):
+                self.savestate = True
+                self.done = True
+                return self.done
+
         if msg.nocontrol:
             self.nocontrol = True
             self.done = True
@@ -339,7 +448,9 @@ class Run():
 
         def mscatter(x,y,ax=None, m=None, **kw):
             import matplotlib.markers as mmarkers
-            if not ax: ax=plt.gca()
+            if not ax:
+                from matplotlib import pyplot as plt
+                ax=plt.gca()
             sc = ax.scatter(x,y,**kw)
             if (m is not None) and (len(m)==len(x)):
                 paths = []
@@ -353,7 +464,7 @@ class Run():
                     paths.append(path)
                 sc.set_paths(paths)
             return sc
-        mscatter(xvals, yvals, s=sizes, c=colors, m=markers, zorder=zorder, alpha=alpha)
+        mscatter(xvals, yvals, ax=ax, s=sizes, c=colors, m=markers, zorder=zorder, alpha=alpha)
 #        sc = ax.scatter(xvals, yvals, s=sizes, c=colors, zorder=zorder, alpha = alpha)
 
         ax.scatter(xdeaths, ydeaths, s=8, marker='x', c='r')
@@ -424,7 +535,10 @@ class Room():
         if self.trun.done:
             if self.trun.valid():
                 self.runs.append(self.trun)
+            savestate = self.trun.savestate
             self.trun = Run()
+            if savestate:
+                self.trun.add_msg(msg)
 
         return False
 
@@ -435,48 +549,108 @@ class Room():
     def __repr__(self):
         return f'{self.name}: {len(self.runs)} runs\nBounds: {self.bounds}'
 
-def read_file(filename, start = 0, stop=None, limit = None):
+def read_file(filename, start = 0, stop=None, limit = None, skipped = None):
+    """
+    Damaged records are skipped and reported. Pass a list as skipped to collect
+    the skipped (start, end) file ranges. Block compressed captures only have
+    the blocks overlapping start to stop decompressed.
+    """
     msgs = []
 
-    with open(filename, 'rb') as fp:
-        fp.seek(start)
-        while True:
-            try:
-                msg = Message(fp)
-                msgs.append(msg)
-            except RuntimeError:
-                break
-            except Exception as e:
-                raise
-                print(e)
-                pass
-            if stop is not None and fp.tell() >= stop:
-                break
+    with profiling.stage('read') as st:
+        raw = blocks.read_capture(filename, start, None if stop is None else stop+1)
+        st.count(nbytes=len(raw))
+
+    #frame everything first and then parse, so the two stages can be timed
+    #separately without a clock read per record
+    scanner = scan.Scanner(raw, start)
+    with profiling.stage('frame') as st:
+        fp = io.BytesIO(raw)
+        for offset, end in scanner.records():
+            fp.seek(offset)
+            msg = Message(fp, parse=False)
+            msg.file_start_idx += start
+            msg.file_end_idx += start
+            msgs.append(msg)
             if limit is not None and len(msgs) > limit:
                 break
+        st.count(records=len(msgs), nbytes=len(raw))
+
+    for line in scanner.report(f'{filename}: '):
+        print(line)
+    if skipped is not None:
+        skipped.extend(scanner.skipped)
+        if scanner.truncated is not None:
+            skipped.append(scanner.truncated)
+
+    #a record can frame correctly and still hold a half updated message
+    bad = 0
+    with profiling.stage('decode') as st:
+        for msg in msgs:
+            try:
+                msg.parse()
+            except Exception:
+                msg.is_state = None
+                bad += 1
+        st.count(records=len(msgs))
 
-    boop = set()
-    for msg in msgs[:10]:
-        boop.update(msg.statuses)
-#        if not msg.is_state:
-        print(msg.data)
-    print(boop)
+    if bad > 0:
+        print(f'{filename}: ignored {bad} undecodable messages')
+        msgs = [x for x in msgs if x.is_state is not None]
 
     return msgs
 
+#bump whenever the index layout or the run segmentation changes so stale index
+#files and sidecar caches (columns.cache_valid) get regenerated
+INDEX_VERSION = 4
+
+RUN_FIELDS = [
+    'room', 'start', 'end', 'start_stamp', 'end_stamp', 'dead', 'nocontrol',
+    'savestate', 'msgs', 'frames', 'xmin', 'xmax', 'ymin', 'ymax', 'states',
+    ]
+
 def make_index(rooms):
     index = defaultdict(list)
     for room in rooms:
         index[room.name].append(room.index_data())
     return index
 
-def write_index(filename, index):
-    with open(filename, 'w') as fp:
-        json.dump(index, fp)
+def make_run_table(rooms):
+    """
+    One column per field, one row per run, in file order.
+    """
+    table = {x: [] for x in RUN_FIELDS}
+    for room in rooms:
+        for run in room.runs:
+            summary = run.summary()
+            summary['room'] = room.name
+            for key in RUN_FIELDS:
+                table[key].append(summary[key])
+    return table
+
+def write_index(filename, index, runs, extra=None):
+    """
+    extra holds additional cached sections (tech counts, etc) keyed by name
+    """
+    data = {
+        'version': INDEX_VERSION,
+        'rooms': index,
+        'runs': runs,
+        }
+    if extra is not None:
+        data.update(extra)
+    with profiling.stage('serialize'):
+        with open(filename, 'w') as fp:
+            json.dump(data, fp)
 
 def read_index(filename):
+    """
+    Returns None for index files written by an older layout.
+    """
     with open(filename, 'r') as fp:
         data = json.load(fp)
+    if data.get('version', None) != INDEX_VERSION:
+        return None
     return data
 
 def load_room_from_index(filename, index, room_name):
@@ -493,38 +667,59 @@ def load_room_from_index(filename, index, room_name):
 
 def extract_rooms(msgs):
 
-    troom = Room()
-    rooms = []
-    for msg in msgs:
-        troom.add_msg(msg)
-        if troom.done and troom.valid():
+    with profiling.stage('segment') as st:
+        troom = Room()
+        rooms = []
+        for msg in msgs:
+            troom.add_msg(msg)
+            if troom.done and troom.valid():
+                rooms.append(troom)
+                troom = Room()
+        if troom.valid() and  not troom in rooms:
             rooms.append(troom)
-            troom = Room()
-    if troom.valid() and  not troom in rooms:
-        rooms.append(troom)
+        st.count(records=len(msgs))
 
     return rooms
 
 
 
 class RoomSet():
-    def __init__(self, infile):
+    def __init__(self, infile, reindex=False):
         self.infile = infile
         idxfile= self.idxfile = os.path.splitext(infile)[0]+'_index.json'
         self.room_map = defaultdict(list)
-        if not os.path.exists(idxfile):
+        self.extra = {}
+        self.lod_layers = []
+        data = None
+        if os.path.exists(idxfile) and not reindex:
+            data = read_index(self.idxfile)
+        if data is None:
             self.generate_index()
         else:
-            self.index = read_index(self.idxfile)
+            self.index = data.pop('rooms')
+            self.runs = data.pop('runs')
+            data.pop('version')
+            self.extra = data
 
     def generate_index(self):
         print(f'Generating index...')
-        msgs = read_file(self.infile)
+        skipped = []
+        msgs = read_file(self.infile, skipped=skipped)
         rooms = extract_rooms(msgs)
-        index = self.index = make_index(rooms)
-        write_index(self.idxfile, self.index)
+        self.index = make_index(rooms)
+        if len(skipped) > 0:
+            self.extra['skipped'] = skipped
+        self.runs = make_run_table(rooms)
+        self.extra['stats'] = stats.index_section(self.runs)
+        if len(msgs) > 0:
+            import quality
+            self.extra['quality'] = quality.Report.from_msgs(msgs).summary()
+        self.save_index()
         for room in rooms:
-            self.room_map[room].append(room)
+            self.room_map[room.name].append(room)
+
+    def save_index(self):
+        write_index(self.idxfile, self.index, self.runs, self.extra)
 
     def get_room(self, room_name):
         if not room_name in self.room_map.keys():
@@ -532,13 +727,47 @@ class RoomSet():
             self.room_map[room_name] = rooms
         return self.room_map[room_name]
 
-    def plot_room(self, ax, room_name):
+    def load_run(self, start, end):
+        """
+        Load a single run from its byte range in the capture
+        """
+        return Run.from_msgs(read_file(self.infile, start, end))
+
+    def query(self):
+        """
+        Filter runs by their index summaries, see query.Query
+        """
+        from query import Query
+        return Query(self)
+
+    def plot_room(self, ax, room_name, lod=False, geometry=False):
+        """
+        lod=True draws through lod.LodLayer, which only renders the visible
+        points and switches to tile densities when zoomed out. geometry=True
+        draws the occupancy.Occupancy grid of the room behind the points.
+        """
         runs = 0
         bounds = Bounds()
-        for room in self.get_room(room_name):
-            room.plot(ax)
-            runs += len(room.runs)
-            bounds.expand(room.bounds)
+        rooms = self.get_room(room_name)
+        with profiling.stage('plot') as st:
+            if geometry:
+                from occupancy import room_occupancy
+
+                room_occupancy(self, room_name).draw(ax)
+            if lod:
+                from columns import Columns
+                from lod import LodLayer
+
+                all_runs = [x for room in rooms for x in room.runs]
+                layer = LodLayer(ax, Columns.from_runs(all_runs), [x.dead for x in all_runs])
+                #the layer only lives as long as something refers to it
+                self.lod_layers.append(layer)
+            for room in rooms:
+                if not lod:
+                    room.plot(ax)
+                runs += len(room.runs)
+                bounds.expand(room.bounds)
+            st.count(records=sum(len(x.msgs) for room in rooms for x in room.runs))
 
         title = f'{room_name}: {runs} runs '
 
@@ -556,6 +785,8 @@ class RoomSet():
         print('\n'.join(lines))
 
     def configure_ax(self, ax):
+        from matplotlib import ticker
+
         ax.set_aspect('equal')
         ax.xaxis.set_major_locator(ticker.MultipleLocator(base=8))
         ax.yaxis.set_major_locator(ticker.MultipleLocator(base=8))
@@ -563,20 +794,20 @@ class RoomSet():
         ax.set_axisbelow(True)
 
 
-if __name__ == '__main__':
-    infile = sys.argv[1]
+def main(argv):
+    from matplotlib import pyplot as plt
+
+    infile = argv[1]
     rooms = RoomSet(infile)
 
     rooms.print_rooms()
 
-    print(OFFSETS)
-
-    if len(sys.argv[2:]) == 0:
-        exit()
+    if len(argv[2:]) == 0:
+        return
 
 
     fig, ax = plt.subplots()
-    for name in sys.argv[2:]:
+    for name in argv[2:]:
         rooms.plot_room(ax, name)
 
     #for name in ['c-01','c-02', 'c-03', 'c-04', 'c-b1', 'c-06', 'c-07', 'e-02']:
@@ -587,3 +818,7 @@ if __name__ == '__main__':
     rooms.configure_ax(ax)
     plt.show()
 
+if __name__ == '__main__':
+    argv, run = profiling.parse_argv(sys.argv)
+    run(main, argv)
+
@@ -0,0 +1,280 @@
+"""
+Event timelines of runs, the room as sheet music.
+
+Events are onsets of conditions written in the tech.py expression language
+(dash start, jump, wall grab, landing, death, and input columns when they were
+recorded), found for every frame of every run at once. They are kept as one
+table sorted by run and frame, with an offset table per run:
+
+    run[i], frame[i], kind[i]   frame counted from the start of the run
+
+Sequences of two attempts are aligned by dynamic programming over their events:
+only events of the same kind can pair up, pairing costs the difference in
+frames and skipping an event costs GAP frames. Each row of the table is done
+with NumPy, so aligning every run of a room against a reference is quick.
+
+    events.py <room name> <data file> [data file ...] [--step N]
+"""
+import sys
+import os
+import argparse
+
+import numpy as np
+
+from columns import Columns, room_cache
+from tech import Compiler, Cond, state, status, flag
+
+first = Cond('first', lambda c: c.cols.run_start)
+
+def onset(cond):
+    #an event on the first frame of a run was already going on when it started
+    return cond.onset() & ~first
+
+EVENTS = [
+    ('dash', onset(state('StDash'))),
+    ('jump', onset(status('Jump'))),
+    ('grab', onset(state('StClimb'))),
+    ('land', onset(status('Coyote'))),
+    ('death', onset(status('Dead'))),
+    #only when a ducking column is supplied from recorded inputs
+    ('duck', onset(flag('ducking'))),
+    ]
+NAMES = [x[0] for x in EVENTS]
+
+#frames an unmatched event costs when aligning
+GAP = 30
+
+class Timeline():
+    def __init__(self, keys, dead, clear, length, run, frame, kind, offsets):
+        """
+        keys identify the runs, (capture, room, run index in the room), and
+        dead, clear and length (in frames) describe them. A clear left the room
+        without dying, losing control or loading a savestate, as in
+        query.Query.clears.
+        """
+        self.keys = keys
+        self.dead = dead
+        self.clear = clear
+        self.length = length
+        self.run = run
+        self.frame = frame
+        self.kind = kind
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.kind)
+
+    def runs(self):
+        return len(self.offsets)-1
+
+    @staticmethod
+    def build(cols, keys, dead, clear, events=None):
+        if events is None:
+            events = EVENTS
+        compiler = Compiler(cols)
+        idx = []
+        kind = []
+        for number, (_, cond) in enumerate(events):
+            found = np.flatnonzero(compiler.eval(cond))
+            idx.append(found)
+            kind.append(np.full(len(found), number, dtype=np.uint8))
+        idx = np.concatenate(idx)
+        kind = np.concatenate(kind)
+
+        run = cols.run[idx]
+        frame = cols.local_frame(idx).astype(np.int32)
+        order = np.lexsort((kind, frame, run))
+        run = run[order]
+        counts = np.bincount(run, minlength=cols.runs())
+        offsets = np.zeros(cols.runs()+1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        length = np.diff(cols.offsets).astype(np.int32)
+        return Timeline(list(keys), np.asarray(dead, dtype=bool), np.asarray(clear, dtype=bool),
+            length, run, frame[order], kind[order], offsets)
+
+    @staticmethod
+    def concatenate(timelines):
+        keys = []
+        for timeline in timelines:
+            keys.extend(timeline.keys)
+        base = np.cumsum([0]+[x.runs() for x in timelines])
+        offsets = np.cumsum([0]+[len(x) for x in timelines])
+        return Timeline(keys,
+            np.concatenate([x.dead for x in timelines]),
+            np.concatenate([x.clear for x in timelines]),
+            np.concatenate([x.length for x in timelines]),
+            np.concatenate([x.run+b for x, b in zip(timelines, base[:-1])]).astype(np.int32),
+            np.concatenate([x.frame for x in timelines]),
+            np.concatenate([x.kind for x in timelines]),
+            np.concatenate([x.offsets[:-1]+o for x, o in zip(timelines, offsets[:-1])]+[[offsets[-1]]]).astype(np.int64))
+
+    def sequence(self, run):
+        """
+        (frame, kind) arrays of one run
+        """
+        s = slice(self.offsets[run], self.offsets[run+1])
+        return self.frame[s], self.kind[s]
+
+    def select(self, name):
+        """
+        Mask of events of one kind
+        """
+        return self.kind == NAMES.index(name)
+
+    def counts(self, name):
+        """
+        Number of events of one kind in every run
+        """
+        return np.bincount(self.run[self.select(name)], minlength=self.runs())
+
+    def first(self, name):
+        """
+        Frame of the first event of one kind in every run, -1 if it has none
+        """
+        mask = self.select(name)
+        result = np.full(self.runs(), -1, dtype=np.int32)
+        runs, idx = np.unique(self.run[mask], return_index=True)
+        result[runs] = self.frame[mask][idx]
+        return result
+
+    def quantized(self, step):
+        """
+        Event frames snapped to a grid of step frames, e.g. the beat of a
+        rhythm the room is played to
+        """
+        return (self.frame+step//2)//step
+
+    def align(self, a, b, gap=GAP):
+        """
+        Align the events of run a with those of run b. Returns the cost and the
+        (index in a, index in b) pairs that were matched.
+        """
+        fa, ka = self.sequence(a)
+        fb, kb = self.sequence(b)
+        return align(fa, ka, fb, kb, gap)
+
+    def align_all(self, reference, gap=GAP):
+        """
+        Align every run to a reference run. Returns per run cost, fraction of
+        the reference's events matched and median frame offset of the matches.
+        """
+        cost = np.zeros(self.runs())
+        matched = np.zeros(self.runs())
+        shift = np.zeros(self.runs())
+        fr, kr = self.sequence(reference)
+        for run in range(self.runs()):
+            fa, ka = self.sequence(run)
+            cost[run], pairs = align(fr, kr, fa, ka, gap)
+            if len(pairs) > 0:
+                pairs = np.array(pairs)
+                matched[run] = len(pairs)/max(len(fr), 1)
+                shift[run] = np.median(fa[pairs[:,1]]-fr[pairs[:,0]])
+        return cost, matched, shift
+
+    def to_arrays(self, prefix=''):
+        return {
+            f'{prefix}keys': np.array(self.keys, dtype=str).reshape(-1, 3),
+            f'{prefix}dead': self.dead,
+            f'{prefix}clear': self.clear,
+            f'{prefix}length': self.length,
+            f'{prefix}run': self.run,
+            f'{prefix}frame': self.frame,
+            f'{prefix}kind': self.kind,
+            f'{prefix}offsets': self.offsets,
+            }
+
+    @staticmethod
+    def from_arrays(data, prefix=''):
+        keys = [tuple(x) for x in data[f'{prefix}keys']]
+        return Timeline(keys, *[data[f'{prefix}{x}'] for x in ['dead', 'clear', 'length', 'run', 'frame', 'kind', 'offsets']])
+
+def align(fa, ka, fb, kb, gap=GAP):
+    """
+    Alignment of two event sequences, see Timeline.align
+    """
+    n = len(fa)
+    m = len(fb)
+    j = np.arange(m+1)
+    #cost[i, j] aligns the first i events of a with the first j of b
+    cost = np.zeros((n+1, m+1))
+    cost[0] = j*gap
+    for i in range(1, n+1):
+        match = np.where(kb == ka[i-1], np.abs(fb-fa[i-1]), np.inf)
+        best = np.empty(m+1)
+        best[0] = cost[i-1, 0]+gap
+        best[1:] = np.minimum(cost[i-1, :-1]+match, cost[i-1, 1:]+gap)
+        #skipping events of b within the row is a running minimum
+        cost[i] = np.minimum.accumulate(best-j*gap)+j*gap
+
+    pairs = []
+    i, k = n, m
+    while i > 0 and k > 0:
+        if kb[k-1] == ka[i-1] and cost[i, k] == cost[i-1, k-1]+abs(fb[k-1]-fa[i-1]):
+            pairs.append((i-1, k-1))
+            i -= 1
+            k -= 1
+        elif cost[i, k] == cost[i-1, k]+gap:
+            i -= 1
+        else:
+            k -= 1
+    pairs.reverse()
+    return cost[n, m], pairs
+
+def events_file(roomset):
+    return os.path.splitext(roomset.infile)[0]+'_events.npz'
+
+def room_events(roomset, room_name):
+    """
+    Event timeline of every run of a room in one capture, cached in
+    <capture>_events.npz next to the index.
+    """
+    def build():
+        runs = []
+        for room in roomset.get_room(room_name):
+            runs.extend(room.runs)
+        keys = [(roomset.infile, room_name, str(idx)) for idx in range(len(runs))]
+        clear = [not (x.dead or x.nocontrol or x.savestate) for x in runs]
+        return Timeline.build(Columns.from_runs(runs), keys, [x.dead for x in runs], clear)
+
+    #rooms cached before runs had a clear flag are built again
+    return room_cache(events_file(roomset), roomset.infile, room_name, 'clear', Timeline.from_arrays, build)
+
+def format_sequence(timeline, run, step=None):
+    frames, kinds = timeline.sequence(run)
+    if step is not None:
+        frames = (frames+step//2)//step
+    return ' '.join(f'{NAMES[k]}@{f}' for f, k in zip(frames, kinds))
+
+def main(argv):
+    from decode import RoomSet
+
+    parser = argparse.ArgumentParser(description='Event timelines of the runs of a room.')
+    parser.add_argument('room')
+    parser.add_argument('captures', nargs='+')
+    parser.add_argument('--step', type=int, default=None, help='quantize event frames to this many frames')
+    args = parser.parse_args(argv[1:])
+
+    roomsets = [RoomSet(x) for x in args.captures]
+    roomsets = [x for x in roomsets if args.room in x.index]
+    if len(roomsets) == 0:
+        print(f'No runs of {args.room}')
+        return
+    timeline = Timeline.concatenate([room_events(x, args.room) for x in roomsets])
+    totals = ', '.join(f'{name}: {int((timeline.kind == idx).sum())}' for idx, name in enumerate(NAMES))
+    print(f'{timeline.runs()} runs, {len(timeline)} events ({totals})')
+
+    clears = np.flatnonzero(timeline.clear)
+    if len(clears) == 0:
+        return
+    #the fastest clear is the score the others are read against
+    reference = clears[int(np.argmin(timeline.length[clears]))]
+    print(f'reference run {reference}: {format_sequence(timeline, reference, args.step)}')
+
+    cost, matched, shift = timeline.align_all(reference)
+    for run in np.argsort(cost)[:10]:
+        source, _, idx = timeline.keys[run]
+        print(f'{os.path.basename(source)} run {idx}: cost {cost[run]:.0f}, '
+            + f'{matched[run]:.0%} of the reference matched, {shift[run]:+.0f} frames')
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,240 @@
+"""
+Per frame physics features derived in bulk from positions, speeds, states and
+statuses, cached as a columnar sidecar next to the capture or .bin file.
+
+    ax, ay      acceleration in px/s^2, from the speed change since the last frame
+    speed       magnitude of the speed in px/s
+    grounded    Coyote status, the player can jump off the ground
+    airtime     frames since the player was last grounded in this run
+    dash        dash direction while dashing, index into DASH_DIRECTIONS
+    distance    pixels travelled since the start of the run
+
+Every feature is computed for all frames at once. Runs are those of
+columns.Columns; .bin files are cut where the room changes, the timer jumps
+(decode.timer_jump) or after a death. The table is kept in <name>_features.npz
+next to a .bin (<name>_run_features.npz for a capture, which only has the frames
+of decode's runs) and rebuilt when the source is newer or decode's runs have
+changed (columns.cache_valid). FeatureTable.attach
+adds the features to a Columns so tech.py expressions can use them, e.g.
+field('airtime').
+
+    features.py <.bin or data file> [...]
+"""
+import sys
+import os
+import struct
+
+import numpy as np
+
+from columns import Columns, status_mask, state_mask, cache_valid, cache_version
+
+FEATURES = ['ax', 'ay', 'speed', 'grounded', 'airtime', 'dash', 'distance']
+
+#y is up, so the octants count anticlockwise from right
+DASH_DIRECTIONS = ['', 'R', 'UR', 'U', 'UL', 'L', 'DL', 'D', 'DR']
+
+#fixed part of a .bin record after its length, see translate.Message.serialize
+BIN_HEAD = np.dtype([
+    ('stamp', '<f8'), ('cruft', '<i4', 5),
+    ('x', '<f4'), ('y', '<f4'), ('sx', '<f4'), ('sy', '<f4'), ('vx', '<f4'), ('vy', '<f4'),
+    ('stamina', '<f4'), ('liftboost', 'u1'), ('liftboost_frames', '<u2'), ('liftboost_x', '<f4'), ('liftboost_y', '<f4'),
+    ('retained', 'u1'), ('retain_frame', '<u2'), ('retain_value', '<f4'),
+    ('wall', 'u1'), ('frame', '<u4'),
+    ])
+
+def ragged(buf, starts, counts, stride):
+    """
+    Byte at the start of each of counts[i] items of stride bytes from
+    starts[i], and the record each belongs to
+    """
+    record = np.repeat(np.arange(len(starts)), counts)
+    first = np.cumsum(counts)-counts
+    item = np.arange(counts.sum())-np.repeat(first, counts)
+    return buf[np.repeat(starts, counts)+item*stride], record
+
+def read_bin(filename):
+    """
+    Columns of every record of a .bin file and the room of each run. Only the
+    record boundaries are walked in Python, fields are gathered with NumPy.
+    """
+    from decode import JUMP_SLACK
+    from party import read_room_table
+
+    with open(filename, 'rb') as fp:
+        raw = fp.read()
+    names, size = read_room_table(raw)
+    starts = []
+    ends = []
+    pos = 0
+    while pos+4 <= size:
+        length = struct.unpack_from('<I', raw, pos)[0]
+        if pos+4+length > size:
+            break
+        starts.append(pos+4)
+        ends.append(pos+4+length)
+        pos += 4+length
+    starts = np.array(starts, dtype=np.int64)
+    ends = np.array(ends, dtype=np.int64)
+    buf = np.frombuffer(raw, dtype=np.uint8)
+
+    head = np.ascontiguousarray(buf[starts[:,None]+np.arange(BIN_HEAD.itemsize)]).view(BIN_HEAD).ravel()
+
+    pos = starts+BIN_HEAD.itemsize
+    count = buf[pos].astype(np.int64) | buf[pos+1].astype(np.int64)<<8
+    values, record = ragged(buf, pos+2, count, 1)
+    state = np.zeros(len(starts), dtype=np.uint32)
+    np.bitwise_or.at(state, record, np.left_shift(1, values.astype(np.uint32)))
+
+    if len(starts) > 0 and not state.any():
+        print(f'{filename}: no player states stored, translate it again with --force for the dash feature')
+
+    pos = pos+2+count
+    count = buf[pos].astype(np.int64) | buf[pos+1].astype(np.int64)<<8
+    values, record = ragged(buf, pos+2, count, 3)
+    status = np.zeros(len(starts), dtype=np.uint32)
+    np.bitwise_or.at(status, record, np.left_shift(1, values.astype(np.uint32)))
+
+    #room id or null terminated room name after the statuses
+    pos = pos+2+3*count
+    if names is not None:
+        ids = buf[pos].astype(np.int64) | buf[pos+1].astype(np.int64)<<8
+        room = np.array([x.encode('ascii') for x in names], dtype=bytes)[ids]
+    else:
+        room = np.array([raw[a:b-1] for a, b in zip(pos, ends)], dtype=bytes)
+
+    frame = head['frame'].astype(np.int64)
+    dt = np.diff(head['stamp'])
+    dframe = np.diff(frame)
+    cut = ((room[1:] != room[:-1]) | (dframe < 0) | (dframe > dt*60 + JUMP_SLACK)
+        | ((status[:-1] & status_mask('Dead')) != 0))
+    run_starts = np.concatenate([[0], np.flatnonzero(cut)+1]) if len(starts) > 0 else np.zeros(0, dtype=np.int64)
+    offsets = np.append(run_starts, len(starts)).astype(np.int64)
+
+    cols = Columns(head['x'].copy(), head['y'].copy(), head['sx'].copy(), head['sy'].copy(),
+        head['stamp'].copy(), frame.astype(np.int32), state, status, head['wall'].copy(), offsets)
+    return cols, [x.decode('ascii') for x in room[run_starts]]
+
+def read_capture_columns(filename):
+    from decode import read_file, extract_rooms
+
+    rooms = extract_rooms(read_file(filename))
+    runs = [x for room in rooms for x in room.runs]
+    return Columns.from_runs(runs), [room.name for room in rooms for x in room.runs]
+
+def derive(cols):
+    """
+    Feature columns of every frame of cols
+    """
+    n = len(cols)
+    idx = np.arange(n)
+    start = cols.run_start
+    #index of the first frame of each frame's run
+    first = cols.offsets[:-1][cols.run] if n > 0 else idx
+
+    dframe = np.ones(n)
+    dframe[1:] = np.maximum(np.diff(cols.frame), 1)
+    result = {}
+    for name, speed in [('ax', cols.sx), ('ay', cols.sy)]:
+        accel = np.zeros(n, dtype=np.float32)
+        accel[1:] = np.diff(speed)/(dframe[1:]/60)
+        accel[start] = 0
+        result[name] = accel
+    result['speed'] = np.hypot(cols.sx, cols.sy).astype(np.float32)
+
+    grounded = (cols.status & status_mask('Coyote')) != 0
+    result['grounded'] = grounded
+    last = np.maximum.accumulate(np.where(grounded | start, idx, 0)) if n > 0 else idx
+    result['airtime'] = np.where(grounded, 0, cols.frame-cols.frame[last]).astype(np.int32)
+
+    dashing = ((cols.state & state_mask('StDash')) != 0) & ((cols.sx != 0) | (cols.sy != 0))
+    octant = np.rint(np.arctan2(cols.sy, cols.sx)/(np.pi/4)).astype(np.int64)%8
+    result['dash'] = np.where(dashing, octant+1, 0).astype(np.uint8)
+
+    step = np.zeros(n)
+    step[1:] = np.hypot(np.diff(cols.x), np.diff(cols.y))
+    step[start] = 0
+    travelled = np.cumsum(step)
+    result['distance'] = (travelled-travelled[first]).astype(np.float32)
+    return result
+
+class FeatureTable():
+    def __init__(self, columns, offsets, rooms):
+        """
+        columns maps feature names to per frame arrays, run i has frames
+        offsets[i]:offsets[i+1] and is in room rooms[i]
+        """
+        self.columns = columns
+        self.offsets = offsets
+        self.rooms = rooms
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def runs(self):
+        return len(self.offsets)-1
+
+    def run_slice(self, idx):
+        return slice(self.offsets[idx], self.offsets[idx+1])
+
+    def attach(self, cols):
+        """
+        Add the features to the extra columns of cols, which must hold the
+        same frames
+        """
+        if len(cols) != len(self):
+            raise RuntimeError(f'Feature table has {len(self)} frames, columns have {len(cols)}')
+        cols.extra.update(self.columns)
+        return cols
+
+    @staticmethod
+    def build(cols, rooms):
+        return FeatureTable(derive(cols), cols.offsets, list(rooms))
+
+    def to_arrays(self):
+        arrays = {f'feature/{k}': v for k, v in self.columns.items()}
+        arrays['offsets'] = self.offsets
+        arrays['rooms'] = np.array(self.rooms, dtype=str)
+        return arrays
+
+    @staticmethod
+    def from_arrays(data):
+        columns = {k.split('/', 1)[1]: data[k] for k in data.files if k.startswith('feature/')}
+        return FeatureTable(columns, data['offsets'], [str(x) for x in data['rooms']])
+
+def features_file(source):
+    base, ext = os.path.splitext(source)
+    if ext == '.bin':
+        return base+'_features.npz'
+    #a capture only has the frames that are part of decode's runs
+    return base+'_run_features.npz'
+
+def source_columns(source):
+    if os.path.splitext(source)[1] == '.bin':
+        return read_bin(source)
+    return read_capture_columns(source)
+
+def load(source, rebuild=False):
+    """
+    Feature table of a .bin file or capture, from <source>_features.npz if it
+    is newer than the source
+    """
+    filename = features_file(source)
+    if not rebuild and cache_valid(filename, source):
+        with np.load(filename) as data:
+            if set(FEATURES) <= {k.split('/', 1)[1] for k in data.files if k.startswith('feature/')}:
+                return FeatureTable.from_arrays(data)
+
+    table = FeatureTable.build(*source_columns(source))
+    np.savez(filename, **table.to_arrays(), **cache_version())
+    return table
+
+if __name__ == '__main__':
+    for source in sys.argv[1:]:
+        table = load(source)
+        dashes = np.bincount(table['dash'], minlength=len(DASH_DIRECTIONS))[1:]
+        print(f'{source}: {len(table)} frames in {table.runs()} runs, '
+            + f'{table["grounded"].mean():.0%} grounded, longest airtime {table["airtime"].max() if len(table) else 0} frames')
+        print(f'{source}: dash frames ' + ', '.join(f'{d}: {c}' for d, c in zip(DASH_DIRECTIONS[1:], dashes)))
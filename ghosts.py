@@ -0,0 +1,147 @@
+"""
+Animated ghost replay of the runs of a room.
+
+All runs start together and advance one game frame per animation frame. Positions
+and state colours are preloaded into (runs, frames) arrays, so each animation
+frame is one slice and a single set_offsets on one scatter. The grid, room
+outline and faint run paths are drawn once and restored by blitting.
+
+    ghosts.py <data file> <room name> [--output ghosts.mp4]
+"""
+import sys
+import argparse
+
+import numpy as np
+
+from columns import Columns, state_mask
+
+#checked in order, first match wins
+STATE_COLORS = [
+    ('StDreamDash', '#ffff00'),
+    ('StRedDash', '#ff0000'),
+    ('StBoost', '#ff8800'),
+    ('StDash', '#ff00ff'),
+    ('StClimb', '#00aa00'),
+    ('StSwim', '#0000ff'),
+    ('StStarFly', '#00ffff'),
+    ]
+DEFAULT_COLOR = '#000000'
+DEAD_COLOR = '#888888'
+
+class Ghosts():
+    def __init__(self, cols, dead=None):
+        from matplotlib import colors
+
+        runs = cols.runs()
+        lengths = np.diff(cols.offsets)
+        self.frames = int(lengths.max()) if runs > 0 else 0
+        self.runs = runs
+
+        self.x = np.full((runs, self.frames), np.nan, dtype=np.float32)
+        self.y = np.full((runs, self.frames), np.nan, dtype=np.float32)
+        self.color = np.zeros((runs, self.frames), dtype=np.uint8)
+
+        self.palette = np.array([colors.to_rgba(DEFAULT_COLOR)]
+            + [colors.to_rgba(c) for _, c in STATE_COLORS]
+            + [colors.to_rgba(DEAD_COLOR)])
+
+        code = np.zeros(len(cols), dtype=np.uint8)
+        for idx, (name, _) in reversed(list(enumerate(STATE_COLORS))):
+            code[(cols.state & np.uint32(state_mask(name))) != 0] = idx+1
+
+        row = cols.run
+        col = cols.local_frame(np.arange(len(cols)))
+        self.x[row, col] = cols.x
+        self.y[row, col] = cols.y
+        self.color[row, col] = code
+
+        #finished runs stay where they ended, greyed out if they died
+        for idx in range(runs):
+            if lengths[idx] == 0 or lengths[idx] == self.frames:
+                continue
+            end = lengths[idx]
+            self.x[idx, end:] = self.x[idx, end-1]
+            self.y[idx, end:] = self.y[idx, end-1]
+            self.color[idx, end:] = len(self.palette)-1 if dead is not None and dead[idx] else self.color[idx, end-1]
+
+        self.offsets = np.stack([self.x, self.y], axis=-1)
+
+    def frame(self, idx):
+        return self.offsets[:, idx], self.palette[self.color[:, idx]]
+
+def draw_background(ax, cols):
+    ax.scatter(cols.x, cols.y, s=1, c='k', alpha=0.05, zorder=-5, rasterized=True)
+
+def animate(fig, ax, ghosts, speed=1, fps=60, size=20):
+    """
+    Set up the blitted animation. speed > 1 skips game frames.
+    """
+    from matplotlib.animation import FuncAnimation
+
+    offsets, facecolors = ghosts.frame(0)
+    sc = ax.scatter(offsets[:,0], offsets[:,1], s=size, c=facecolors, zorder=20, animated=True)
+    label = ax.text(0.01, 0.99, '', transform=ax.transAxes, va='top', fontsize=8, animated=True)
+
+    steps = max(1, int(round(speed)))
+    frames = range(0, ghosts.frames, steps)
+
+    def update(idx):
+        offsets, facecolors = ghosts.frame(idx)
+        sc.set_offsets(offsets)
+        sc.set_facecolor(facecolors)
+        label.set_text(f'frame {idx}')
+        return sc, label
+
+    return FuncAnimation(fig, update, frames=frames, interval=1000/fps, blit=True, cache_frame_data=False)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Replay the runs of a room as ghosts.')
+    parser.add_argument('capture')
+    parser.add_argument('room')
+    parser.add_argument('--output', '-o', default=None, help='render to a video (.mp4 needs ffmpeg, .gif uses pillow)')
+    parser.add_argument('--speed', type=float, default=1, help='game frames per animation frame')
+    parser.add_argument('--fps', type=float, default=60)
+    parser.add_argument('--runs', type=int, default=None, help='only the last N runs')
+    parser.add_argument('--dpi', type=int, default=100)
+    args = parser.parse_args(argv[1:])
+
+    import matplotlib
+    if args.output is not None:
+        matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+    from decode import RoomSet
+
+    roomset = RoomSet(args.capture)
+    if args.room not in roomset.index:
+        sys.exit(f'{args.room} is not in {args.capture}')
+    runs = []
+    for room in roomset.get_room(args.room):
+        runs.extend(room.runs)
+    if args.runs is not None:
+        runs = runs[max(len(runs)-args.runs, 0):]
+
+    cols = Columns.from_runs(runs)
+    if len(cols) == 0:
+        sys.exit(f'No runs of {args.room} to show')
+    ghosts = Ghosts(cols, [x.dead for x in runs])
+
+    fig, ax = plt.subplots()
+    draw_background(ax, cols)
+    roomset.configure_ax(ax)
+    ax.set_title(f'{args.room}: {len(runs)} runs', fontsize=8)
+
+    anim = animate(fig, ax, ghosts, args.speed, args.fps)
+
+    if args.output is None:
+        plt.show()
+    else:
+        from matplotlib import animation
+        if args.output.endswith('.gif'):
+            writer = animation.PillowWriter(fps=args.fps)
+        else:
+            writer = animation.FFMpegWriter(fps=args.fps)
+        anim.save(args.output, writer=writer, dpi=args.dpi)
+        print(f'Wrote {args.output}')
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,178 @@
+"""
+Input timelines from tuw.py captures and export to CelesteTAS .tas files.
+
+All states of a capture are unpacked into columns once. Runs are cut where the
+room or death count changes or the game timer jumps (decode.timer_jump), and
+inputs are run length encoded for every run at once: a segment starts wherever
+the packed input changes or a run starts, and lasts until the game frame of the
+next segment. Frames the recorder missed count towards the input before them.
+
+    inputs.py <capture.tuw> [--room <room name>] [--output <file.tas>]
+"""
+import sys
+import argparse
+
+import numpy as np
+
+import tuw
+from decode import JUMP_SLACK
+
+#CelesteTAS actions for the tuw.BUTTONS and tuw.DIRECTIONS bits
+BUTTON_ACTIONS = {'jump': 'J', 'dash': 'X', 'grab': 'G', 'demo': 'Z'}
+DIRECTION_ACTIONS = {'right': 'R', 'left': 'L', 'up': 'U', 'down': 'D'}
+
+#aim within this of the origin counts as no analog input
+DEADZONE = 0.1
+
+DTYPES = [np.float64, np.float64, np.int32, str, np.uint8, np.uint8, np.float32, np.float32]
+
+class InputColumns():
+    def __init__(self, stamp, frame, deaths, room, buttons, directions, aim_x, aim_y):
+        self.stamp = stamp
+        self.frame = frame
+        self.deaths = deaths
+        self.room = room
+        self.buttons = buttons
+        self.directions = directions
+        self.aim_x = aim_x
+        self.aim_y = aim_y
+
+    def __len__(self):
+        return len(self.stamp)
+
+    @staticmethod
+    def from_file(filename):
+        rows = []
+        for stamp, raw in tuw.read_records(filename):
+            try:
+                sequence, timestamp, gametime, deaths, room, player_state, input_state = tuw.parse(raw)
+            except Exception:
+                continue
+            rows.append((stamp, gametime, deaths, room, *input_state))
+
+        fields = zip(*rows) if len(rows) > 0 else [[]]*len(DTYPES)
+        stamp, gametime, deaths, room, buttons, directions, aim_x, aim_y = [
+            np.array(x, dtype=d) for x, d in zip(fields, DTYPES)]
+        #game time is in 100 ns ticks
+        frame = np.rint(gametime*60/1e7).astype(np.int64)
+        return InputColumns(stamp, frame, deaths, room, buttons, directions, aim_x, aim_y)
+
+    def analog(self):
+        """
+        Feather angle in whole degrees clockwise from up, or -1 where there
+        is no analog aim or the digital directions already cover it
+        """
+        angle = np.rint(np.degrees(np.arctan2(self.aim_x, self.aim_y))).astype(np.int64)%360
+        live = (np.hypot(self.aim_x, self.aim_y) > DEADZONE) & (self.directions == 0)
+        return np.where(live, angle, -1)
+
+    def run_starts(self):
+        """
+        Indices where a run starts
+        """
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.int64)
+        dt = np.diff(self.stamp)
+        dframe = np.diff(self.frame)
+        cut = ((self.room[1:] != self.room[:-1]) | (self.deaths[1:] != self.deaths[:-1])
+            | (dframe < 0) | (dframe > dt*60 + JUMP_SLACK))
+        return np.concatenate([[0], np.flatnonzero(cut)+1])
+
+class Segments():
+    """
+    Run length encoded inputs of many runs. Run i has segments
+    offsets[i]:offsets[i+1].
+    """
+    def __init__(self, columns, run_starts, index, frames, angle, offsets):
+        """
+        index is the state each segment starts at, frames how long it lasts
+        and angle its feather angle or -1
+        """
+        self.columns = columns
+        self.run_starts = run_starts
+        self.index = index
+        self.frames = frames
+        self.angle = angle
+        self.offsets = offsets
+
+    def runs(self):
+        return len(self.run_starts)
+
+    def room(self, run):
+        return self.columns.room[self.run_starts[run]]
+
+    def line(self, idx):
+        cols = self.columns
+        state = self.index[idx]
+        actions = [DIRECTION_ACTIONS[name] for bit, name in enumerate(tuw.DIRECTIONS) if cols.directions[state] & (1<<bit)]
+        actions += [BUTTON_ACTIONS[name] for bit, name in enumerate(tuw.BUTTONS) if cols.buttons[state] & (1<<bit)]
+        if self.angle[idx] >= 0:
+            actions += ['F', str(self.angle[idx])]
+        return ','.join([f'{self.frames[idx]:>4}'] + actions)
+
+    def tas_lines(self, run):
+        return [self.line(idx) for idx in range(self.offsets[run], self.offsets[run+1])]
+
+def encode(columns, run_starts=None):
+    """
+    Run length encode the inputs of every run in one pass
+    """
+    if run_starts is None:
+        run_starts = columns.run_starts()
+    n = len(columns)
+    angle = columns.analog()
+    if n == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return Segments(columns, empty, empty, empty, empty, np.zeros(1, dtype=np.int64))
+    key = ((columns.buttons.astype(np.int64) << 8 | columns.directions) << 10) | (angle+1)
+
+    change = np.zeros(n, dtype=bool)
+    change[1:] = key[1:] != key[:-1]
+    change[run_starts] = True
+    index = np.flatnonzero(change)
+
+    #a segment lasts until the frame the next one starts on, the last one of
+    #a run until its last state
+    run_ends = np.append(run_starts[1:], n)
+    run_of = np.searchsorted(run_starts, index, side='right')-1
+    following = np.append(index[1:], n-1)
+    last = np.append(run_of[1:] != run_of[:-1], True)
+    end_frame = np.where(last, columns.frame[run_ends[run_of]-1]+1, columns.frame[following])
+    #never less than a frame, a duplicate state can't shorten an input to zero
+    frames = np.maximum(end_frame-columns.frame[index], 1)
+
+    offsets = np.append(np.searchsorted(index, run_starts), len(index))
+    return Segments(columns, run_starts, index, frames, angle[index], offsets)
+
+def write_tas(fp, segments, runs):
+    for run in runs:
+        start = segments.run_starts[run]
+        fp.write(f'#{segments.room(run)} run {run} frame {segments.columns.frame[start]}\n')
+        for line in segments.tas_lines(run):
+            fp.write(line+'\n')
+        fp.write('\n')
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Export recorded inputs as CelesteTAS input files.')
+    parser.add_argument('capture', help=f'{tuw.EXTENSION} file written by tuw.py --output')
+    parser.add_argument('--room', default=None, help='only runs in this room')
+    parser.add_argument('--output', '-o', default=None, help='.tas file to write, stdout by default')
+    args = parser.parse_args(argv[1:])
+
+    columns = InputColumns.from_file(args.capture)
+    segments = encode(columns)
+    runs = [x for x in range(segments.runs()) if args.room is None or segments.room(x) == args.room]
+    if len(runs) == 0:
+        print(f'No runs{"" if args.room is None else " in "+args.room} in {args.capture}', file=sys.stderr)
+        return
+
+    if args.output is None:
+        write_tas(sys.stdout, segments, runs)
+    else:
+        with open(args.output, 'w') as fp:
+            write_tas(fp, segments, runs)
+        lines = sum(segments.offsets[x+1]-segments.offsets[x] for x in runs)
+        print(f'{len(runs)} runs, {lines} input lines from {len(columns)} states')
+
+if __name__ == '__main__':
+    main(sys.argv)
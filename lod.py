@@ -0,0 +1,159 @@
+"""
+Level of detail rendering of a room's points for interactive pan and zoom.
+
+Points are kept twice: sorted by tile in a SpatialIndex, so the visible ones can
+be sliced out quickly, and as a pyramid of per tile counts (8 px tiles, then 16,
+32, ...) built by summing 2x2 blocks. When few enough points are visible they are
+drawn as a plain scatter, otherwise the coarsest pyramid level that still has at
+least one cell per screen pixel is drawn as a single image. Work is only done
+when the axis limits change: the visible points are pushed to the scatters, or
+another level's image shown.
+"""
+import numpy as np
+
+from spatial import SpatialIndex
+
+#most points drawn individually before switching to the tile image
+POINT_BUDGET = 20000
+
+CLEAR_COLOR = (1, 0, 1)
+DEAD_COLOR = (0, 0, 0)
+
+def halve(counts):
+    """
+    Sum 2x2 blocks, padding odd edges
+    """
+    h, w = counts.shape
+    if h%2 or w%2:
+        counts = np.pad(counts, ((0, h%2), (0, w%2)))
+    h, w = counts.shape
+    return counts.reshape(h//2, 2, w//2, 2).sum(axis=(1, 3))
+
+def density_image(dead, clear):
+    """
+    RGBA image of per cell point counts, clears in magenta over deaths in black
+    with log scaled opacity
+    """
+    total = (dead+clear).astype(np.float32)
+    peak = max(total.max(), 1)
+
+    rgba = np.zeros(dead.shape+(4,), dtype=np.float32)
+    rgba[..., :3] = np.where((clear > 0)[..., None], CLEAR_COLOR, DEAD_COLOR)
+    rgba[..., 3] = np.log1p(total)/np.log1p(peak)
+    return rgba
+
+class Pyramid():
+    def __init__(self, grid, dead_counts, clear_counts):
+        self.grid = grid
+        self.levels = [(dead_counts, clear_counts)]
+        while max(self.levels[-1][0].shape) > 1:
+            dead, clear = self.levels[-1]
+            self.levels.append((halve(dead), halve(clear)))
+
+    def cell_size(self, level):
+        return self.grid.tile*(1<<level)
+
+    def image(self, level):
+        """
+        RGBA image of a level and its extent, see density_image
+        """
+        dead, clear = self.levels[level]
+        rgba = density_image(dead, clear)
+
+        size = self.cell_size(level)
+        h, w = dead.shape
+        x0 = self.grid.x0*self.grid.tile
+        y0 = self.grid.y0*self.grid.tile
+        return rgba, (x0, x0+w*size, y0, y0+h*size)
+
+class LodLayer():
+    def __init__(self, ax, cols, dead, budget=POINT_BUDGET):
+        """
+        cols holds every run of the room, dead says whether each run died
+        """
+        self.ax = ax
+        self.budget = budget
+        dead = np.asarray(dead, dtype=bool)
+
+        self.index = SpatialIndex.build(cols)
+        self.point_dead = dead[self.index.run]
+
+        grid = self.index.grid
+        cells = grid.cell(self.index.x, self.index.y)
+        shape = (grid.height, grid.width)
+        dead_counts = np.bincount(cells[self.point_dead], minlength=grid.tiles()).reshape(shape)
+        clear_counts = np.bincount(cells[~self.point_dead], minlength=grid.tiles()).reshape(shape)
+        self.pyramid = Pyramid(grid, dead_counts, clear_counts)
+
+        #one colour per scatter keeps matplotlib on its fast marker path
+        self.clear_points = ax.scatter([], [], s=1, color=CLEAR_COLOR, zorder=0)
+        self.dead_points = ax.scatter([], [], s=1, color=DEAD_COLOR, alpha=0.25, zorder=0)
+        self.images = {}
+        self.level = None
+
+        x0 = grid.x0*grid.tile
+        y0 = grid.y0*grid.tile
+        ax.update_datalim([(x0, y0), (x0+grid.width*grid.tile, y0+grid.height*grid.tile)])
+        ax.autoscale_view()
+
+        self.last = None
+        ax.callbacks.connect('xlim_changed', self.on_limits)
+        ax.callbacks.connect('ylim_changed', self.on_limits)
+        self.update()
+
+    def on_limits(self, ax):
+        #panning fires both callbacks, skip the second if nothing moved
+        view = (ax.get_xlim(), ax.get_ylim())
+        if view == self.last:
+            return
+        self.update()
+        ax.figure.canvas.draw_idle()
+
+    def pixels(self):
+        bbox = self.ax.get_window_extent()
+        return max(bbox.width, 1), max(bbox.height, 1)
+
+    def update(self):
+        self.last = (self.ax.get_xlim(), self.ax.get_ylim())
+        xmin, xmax = sorted(self.ax.get_xlim())
+        ymin, ymax = sorted(self.ax.get_ylim())
+
+        hits = self.index.rect(xmin, xmax, ymin, ymax)
+        if len(hits) <= self.budget:
+            self.level = 0
+            idx = hits.idx
+            dead = self.point_dead[idx]
+            for points, sel in [(self.clear_points, idx[~dead]), (self.dead_points, idx[dead])]:
+                points.set_offsets(np.stack([self.index.x[sel], self.index.y[sel]], axis=-1))
+                points.set_visible(True)
+            self.show_image(None)
+            return
+
+        #coarsest level with cells no bigger than a screen pixel
+        width, height = self.pixels()
+        pixel = max((xmax-xmin)/width, (ymax-ymin)/height)
+        level = 0
+        while level+1 < len(self.pyramid.levels) and self.pyramid.cell_size(level+1) <= pixel:
+            level += 1
+
+        self.clear_points.set_visible(False)
+        self.dead_points.set_visible(False)
+        self.level = level+1
+        self.show_image(level)
+
+    def show_image(self, level):
+        """
+        One image per pyramid level, made the first time it is needed. They are
+        added directly rather than through imshow so they don't move the data
+        limits, and matplotlib only resamples the visible part when drawing.
+        """
+        from matplotlib.image import AxesImage
+
+        if level is not None and level not in self.images:
+            rgba, extent = self.pyramid.image(level)
+            image = AxesImage(self.ax, origin='lower', interpolation='nearest', extent=extent, zorder=-1)
+            image.set_data(rgba)
+            self.ax.add_image(image)
+            self.images[level] = image
+        for key, image in self.images.items():
+            image.set_visible(key == level)
@@ -5,7 +5,11 @@ import mmap
 import enum
 import re
 import itertools
-from matplotlib import pyplot as plt
+import argparse
+import signal
+
+import blocks
+import sources
 
 class MessageId(enum.Enum):
     default = 0x00
@@ -83,36 +87,113 @@ class Message():
     def __repr__(self):
         return str(self)
 
-#outfile = 'test.bin'
-outfile = time.strftime('%Y-%m-%d-%H%M%S.dat')
-
-try:
-    buffersize = 0x100000
-    with mmap.mmap(-1, buffersize, 'CelesteTAS') as fp:
-        last_msg = Message(fp)
-        last_unique = None
-        msg = None
-        while True:
-            time.sleep(.001)
-            try:
-                msg = Message(fp)
-            except ValueError:
-                print(f'Error: {msg}')
-                continue
-
-            if msg.data != last_msg.data:
-                if last_unique is not None:
-                    delta = (msg.stamp - last_unique.stamp)*60
-                    if delta > 1.05:
-                        print(delta)
-                with open(outfile, 'ab') as fpo:
-                    fpo.write(msg.encode())
-                last_unique = msg
-
-
-            last_msg = msg
-except KeyboardInterrupt:
-    pass
-
-
+class Stats():
+    def __init__(self):
+        self.start = time.time()
+        self.cpu_start = time.process_time()
+        self.polls = 0
+        self.unique = 0
+        self.errors = 0
+        self.gaps = 0
+        self.missed = 0
 
+    def __str__(self):
+        wall = time.time()-self.start
+        cpu = time.process_time()-self.cpu_start
+        return (f'{self.unique} states captured in {wall:.1f} s over {self.polls} polls, '
+            + f'{self.gaps} slow frames, about {self.missed} frames missed, {self.errors} read errors, '
+            + f'{cpu:.2f} s cpu ({cpu/max(wall, 1e-9)*100:.1f}%)')
+
+class RawWriter():
+    """
+    Appends each record to a plain .dat capture as soon as it arrives
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+    def write(self, record):
+        with open(self.filename, 'ab') as fpo:
+            fpo.write(record)
+
+    def close(self):
+        pass
+
+def record(fp, writer, stats, quiet=False):
+    last_msg = Message(fp)
+    last_unique = None
+    msg = None
+    while True:
+        time.sleep(.001)
+        stats.polls += 1
+        try:
+            msg = Message(fp)
+        except ValueError:
+            stats.errors += 1
+            print(f'Error: {msg}')
+            continue
+
+        if msg.data != last_msg.data:
+            if last_unique is not None:
+                delta = (msg.stamp - last_unique.stamp)*60
+                if delta > 1.05:
+                    stats.gaps += 1
+                    stats.missed += round(delta)-1
+                    if not quiet:
+                        print(delta)
+            writer.write(msg.encode())
+            stats.unique += 1
+            last_unique = msg
+
+
+        last_msg = msg
+
+def stop(signum, frame):
+    raise KeyboardInterrupt
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Record CelesteTAS game state.')
+    parser.add_argument('--source', default=None,
+        help='file backed shared memory to read instead of the CelesteTAS mmap, e.g. from replay.py')
+    parser.add_argument('--output', '-o', default=None)
+    parser.add_argument('--quiet', '-q', action='store_true', help='do not print slow frames')
+    parser.add_argument('--compress', default=None, choices=list(blocks.CODECS.keys()),
+        help='write a block compressed capture, see blocks.py')
+    parser.add_argument('--block', type=int, default=blocks.BLOCK_RECORDS,
+        help='records per compressed block, at most this many are lost if the recorder dies')
+    parser.add_argument('--no-report', action='store_true',
+        help='do not index the capture and print its quality report when stopping')
+    args = parser.parse_args(argv[1:])
+
+    #outfile = 'test.bin'
+    outfile = args.output
+    if outfile is None:
+        ext = '.dat' if args.compress is None else blocks.EXTENSION
+        outfile = time.strftime('%Y-%m-%d-%H%M%S')+ext
+
+    if args.compress is None:
+        writer = RawWriter(outfile)
+    else:
+        writer = blocks.BlockWriter(outfile, blocks.CODECS[args.compress], args.block)
+
+    #stop cleanly when killed by a test harness too
+    signal.signal(signal.SIGTERM, stop)
+
+    stats = Stats()
+    try:
+        with sources.open_celestetas(args.source) as fp:
+            record(fp, writer, stats, args.quiet)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
+    print(stats)
+
+    if stats.unique > 0 and not args.no_report:
+        import quality
+        from decode import RoomSet
+
+        for line in quality.format_summary(quality.session_report(RoomSet(outfile))):
+            print(line)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -65,6 +65,37 @@ statuses = [
 idx_to_status = dict(enumerate(statuses))
 status_to_idx = {v:k for k,v in idx_to_status.items()}
 
+class Symbols():
+    """
+    Interned names with small integer ids. Every occurrence of a name shares
+    one string object, and the id can be stored in its place.
+    """
+    def __init__(self, names=()):
+        self.names = []
+        self.ids = {}
+        for name in names:
+            self.id(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, idx):
+        return self.names[idx]
+
+    def id(self, name):
+        idx = self.ids.get(name, None)
+        if idx is None:
+            idx = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return idx
+
+    def intern(self, name):
+        return self.names[self.id(name)]
+
+#shared by everything decoded in this process
+room_symbols = Symbols()
+token_symbols = Symbols(states+statuses)
+
 class Status:
     def __init__(self, idx, frames):
         self.status = idx_to_status[idx]
@@ -0,0 +1,169 @@
+"""
+Room geometry inferred from where the player has been.
+
+Every frame marks tiles in one flag per tile grid:
+
+    VISITED     the tile the player's position (bottom centre of the hitbox) is in
+    WALL        the tile beside the hitbox on frames with a WallL/WallR state
+    FLOOR       the tile under the feet on grounded (Coyote) frames
+
+Tiles touched as walls or floors but never visited are almost certainly solid,
+so with enough runs the grid draws the room. Grids are built from the columns
+of all runs at once with np.bitwise_or.at, cached per room in
+<capture>_occupancy.npz, and drawn as a single image behind the points.
+
+    occupancy.py <data file> <room name> [room name ...] [--output <image>]
+"""
+import sys
+import os
+import argparse
+
+import numpy as np
+
+from columns import Columns, Grid, WALLS, status_mask, room_cache
+
+VISITED = 1
+WALL = 2
+FLOOR = 4
+
+#player hitbox in pixels, y is up after decode flips it
+HALF_WIDTH = 4
+HEIGHT = 11
+
+#rgba per kind of tile, solid tiles over visited ones
+VISITED_COLOR = (0.85, 0.85, 0.85, 0.5)
+WALL_COLOR = (0.25, 0.3, 0.45, 0.9)
+FLOOR_COLOR = (0.4, 0.3, 0.2, 0.9)
+
+class Occupancy():
+    def __init__(self, grid, flags):
+        """
+        flags is a (height, width) uint8 array of VISITED | WALL | FLOOR bits
+        """
+        self.grid = grid
+        self.flags = flags
+
+    @staticmethod
+    def build(cols):
+        walls = cols.wall != 0
+        floors = (cols.status & status_mask('Coyote')) != 0
+
+        #the tile next to the middle of the hitbox on the side of the wall
+        side = np.where(cols.wall[walls] == WALLS['WallL'], -1, 1)
+        wall_x = cols.x[walls] + side*(HALF_WIDTH+1)
+        wall_y = cols.y[walls] + HEIGHT/2
+        floor_x = cols.x[floors]
+        floor_y = cols.y[floors] - 1
+
+        points = [(cols.x, cols.y, VISITED), (wall_x, wall_y, WALL), (floor_x, floor_y, FLOOR)]
+        grid = Grid.covering(np.concatenate([x for x, _, _ in points]), np.concatenate([y for _, y, _ in points]))
+        flags = np.zeros(grid.tiles(), dtype=np.uint8)
+        for x, y, bit in points:
+            np.bitwise_or.at(flags, grid.cell(x, y), bit)
+        return Occupancy(grid, flags.reshape(grid.height, grid.width))
+
+    @staticmethod
+    def merge(grids):
+        """
+        Combine grids of the same room, e.g. from several captures
+        """
+        grid = grids[0].grid
+        for other in grids[1:]:
+            grid = grid.union(other.grid)
+        flags = np.zeros((grid.height, grid.width), dtype=np.uint8)
+        for other in grids:
+            x = other.grid.x0-grid.x0
+            y = other.grid.y0-grid.y0
+            flags[y:y+other.grid.height, x:x+other.grid.width] |= other.flags
+        return Occupancy(grid, flags)
+
+    def layer(self, bit):
+        return (self.flags & bit) != 0
+
+    def solid(self):
+        """
+        Tiles touched as a wall or floor that the player was never in
+        """
+        return ((self.flags & (WALL | FLOOR)) != 0) & ~self.layer(VISITED)
+
+    def extent(self):
+        g = self.grid
+        x0 = g.x0*g.tile
+        y0 = g.y0*g.tile
+        return (x0, x0+g.width*g.tile, y0, y0+g.height*g.tile)
+
+    def image(self):
+        rgba = np.zeros(self.flags.shape+(4,), dtype=np.float32)
+        rgba[self.layer(VISITED)] = VISITED_COLOR
+        solid = self.solid()
+        rgba[solid & self.layer(WALL)] = WALL_COLOR
+        rgba[solid & self.layer(FLOOR)] = FLOOR_COLOR
+        return rgba
+
+    def draw(self, ax, zorder=-20):
+        """
+        Add the grid to ax as one image. It is added directly rather than
+        through imshow so it doesn't move the data limits.
+        """
+        from matplotlib.image import AxesImage
+
+        image = AxesImage(ax, origin='lower', interpolation='nearest', extent=self.extent(), zorder=zorder)
+        image.set_data(self.image())
+        ax.add_image(image)
+        return image
+
+    def to_arrays(self, prefix=''):
+        return {
+            f'{prefix}grid': self.grid.to_array(),
+            f'{prefix}flags': self.flags,
+            }
+
+    @staticmethod
+    def from_arrays(data, prefix=''):
+        return Occupancy(Grid.from_array(data[f'{prefix}grid']), data[f'{prefix}flags'])
+
+def occupancy_file(roomset):
+    return os.path.splitext(roomset.infile)[0]+'_occupancy.npz'
+
+def room_occupancy(roomset, room_name):
+    """
+    Occupancy grid of a room in one capture, cached in <capture>_occupancy.npz
+    next to the index.
+    """
+    def build():
+        return Occupancy.build(Columns.from_rooms(roomset.get_room(room_name)))
+
+    return room_cache(occupancy_file(roomset), roomset.infile, room_name, 'grid', Occupancy.from_arrays, build)
+
+def main(argv):
+    import matplotlib
+
+    parser = argparse.ArgumentParser(description='Draw room geometry inferred from wall and floor contacts.')
+    parser.add_argument('capture')
+    parser.add_argument('rooms', nargs='+')
+    parser.add_argument('--output', '-o', default=None, help='save to an image instead of showing a window')
+    args = parser.parse_args(argv[1:])
+
+    if args.output is not None:
+        matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+    from decode import RoomSet
+
+    roomset = RoomSet(args.capture)
+    fig, ax = plt.subplots()
+    for name in args.rooms:
+        occupancy = room_occupancy(roomset, name)
+        occupancy.draw(ax)
+        x0, x1, y0, y1 = occupancy.extent()
+        ax.update_datalim([(x0, y0), (x1, y1)])
+        print(f'{name}: {occupancy.layer(VISITED).sum()} tiles visited, {occupancy.solid().sum()} solid')
+    ax.autoscale_view()
+    roomset.configure_ax(ax)
+
+    if args.output is None:
+        plt.show()
+    else:
+        fig.savefig(args.output, dpi=200)
+
+if __name__ == '__main__':
+    main(sys.argv)
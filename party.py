@@ -1,13 +1,49 @@
 import struct
-
-from model import MessageId, state_to_idx, status_to_idx, states, statuses, Status
+import io
+
+from model import MessageId, state_to_idx, status_to_idx, idx_to_state, states, statuses, Status
+
+#.bin files written with a room table end in it: records give a 2 byte room id
+#instead of the name, and the names follow the last record as (2 byte length,
+#ascii name) pairs, then the footer (table offset, room count, magic)
+ROOM_TABLE_MAGIC = b'CMONROOM'
+ROOM_FOOTER = struct.Struct('=QI8s')
+ROOM_NAME = struct.Struct('=H')
+
+def write_room_table(fp, rooms):
+    """
+    rooms is the model.Symbols the records were serialized with
+    """
+    offset = fp.tell()
+    for name in rooms.names:
+        raw = name.encode('ascii')
+        fp.write(ROOM_NAME.pack(len(raw)) + raw)
+    fp.write(ROOM_FOOTER.pack(offset, len(rooms), ROOM_TABLE_MAGIC))
+
+def read_room_table(raw):
+    """
+    Room names and the end of the records, or None and the file size for .bin
+    files that store the name in every record
+    """
+    if len(raw) < ROOM_FOOTER.size:
+        return None, len(raw)
+    offset, count, magic = ROOM_FOOTER.unpack_from(raw, len(raw)-ROOM_FOOTER.size)
+    if magic != ROOM_TABLE_MAGIC:
+        return None, len(raw)
+    names = []
+    pos = offset
+    for _ in range(count):
+        length = ROOM_NAME.unpack_from(raw, pos)[0]
+        names.append(raw[pos+2:pos+2+length].decode('ascii'))
+        pos += 2+length
+    return names, offset
 
 
 class GameState:
     def __init__(self):
         pass
 
-    def read(self, fp):
+    def read(self, fp, rooms=None):
         length_raw = fp.read(4)
         if len(length_raw) == 0:
             raise RuntimeError('Done')
@@ -15,9 +51,9 @@ class GameState:
         length = struct.unpack('I', length_raw)[0]
         raw_data = fp.read(length)
 
-        self.deserialize(raw_data)
+        self.deserialize(raw_data, rooms)
 
-    def deserialize(self, raw):
+    def deserialize(self, raw, rooms=None):
     
         head_fmt = ( '=d' #stamp
                 +'iiiii' #cruft
@@ -47,7 +83,10 @@ class GameState:
         offset += status_len
 
 
-        self.room = raw[offset:-1].decode('ascii')
+        if rooms is None:
+            self.room = raw[offset:-1].decode('ascii')
+        else:
+            self.room = rooms[ROOM_NAME.unpack_from(raw, offset)[0]]
 
         #deserialize head
         head_data = struct.unpack(head_fmt, head_raw)
@@ -73,3 +112,19 @@ class GameState:
             self.statuses.append(st)
 
 
+
+def read_states(filename):
+    """
+    Yields every GameState in a .bin file
+    """
+    with open(filename, 'rb') as fp:
+        raw = fp.read()
+    rooms, end = read_room_table(raw)
+    fp = io.BytesIO(raw[:end])
+    while True:
+        gs = GameState()
+        try:
+            gs.read(fp, rooms)
+        except RuntimeError:
+            return
+        yield gs
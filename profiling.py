@@ -0,0 +1,192 @@
+"""
+Opt-in instrumentation for the processing pipeline.
+
+Stages are timed per batch (a whole file read, a whole segmentation pass, etc)
+rather than per record, so the cost when enabled is a handful of clock reads.
+When disabled, stage() hands back a shared do-nothing context and count() returns
+immediately.
+
+Enable with the CELESTE_MON_PROFILE environment variable or enable().
+"""
+import sys
+import time
+import os
+import json
+from collections import defaultdict
+
+STAGES = ['read', 'frame', 'decode', 'segment', 'serialize', 'plot']
+
+class _NullStage():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def count(self, records=0, nbytes=0):
+        pass
+
+NULL_STAGE = _NullStage()
+
+class _Stage():
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.records = 0
+        self.nbytes = 0
+
+    def count(self, records=0, nbytes=0):
+        self.records += records
+        self.nbytes += nbytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        end = time.perf_counter()
+        self.profiler.record(self.name, self.start, end, self.records, self.nbytes)
+        return False
+
+class Profiler():
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.records = defaultdict(int)
+        self.nbytes = defaultdict(int)
+        self.events = []
+        self.origin = time.perf_counter()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def stage(self, name):
+        if not self.enabled:
+            return NULL_STAGE
+        return _Stage(self, name)
+
+    def count(self, name, records=0, nbytes=0):
+        if not self.enabled:
+            return
+        self.records[name] += records
+        self.nbytes[name] += nbytes
+
+    def record(self, name, start, end, records=0, nbytes=0):
+        self.times[name] += end-start
+        self.calls[name] += 1
+        self.records[name] += records
+        self.nbytes[name] += nbytes
+        self.events.append((name, start, end))
+
+    def summary(self):
+        total = sum(self.times.values())
+        names = [x for x in STAGES if x in self.calls]
+        names.extend(sorted(x for x in self.calls if not x in STAGES))
+        names.extend(sorted(x for x in self.records if not x in self.calls))
+
+        lines = [f'{"stage":<10} {"calls":>6} {"time (s)":>9} {"share":>6} {"records":>10} {"rec/s":>10} {"MB/s":>8}']
+        for name in names:
+            dt = self.times.get(name, 0)
+            records = self.records.get(name, 0)
+            nbytes = self.nbytes.get(name, 0)
+            share = dt/total*100 if total > 0 else 0
+            rate = f'{records/dt:.0f}' if dt > 0 and records else '-'
+            brate = f'{nbytes/dt/1e6:.2f}' if dt > 0 and nbytes else '-'
+            lines.append(f'{name:<10} {self.calls.get(name, 0):>6} {dt:>9.3f} {share:>5.1f}% {records:>10} {rate:>10} {brate:>8}')
+        return '\n'.join(lines)
+
+    def print_summary(self):
+        if not self.enabled:
+            return
+        print(self.summary())
+
+    def write_chrome_trace(self, filename):
+        """
+        Write the recorded stage spans in the Chrome trace event format. Load
+        the result in chrome://tracing or https://ui.perfetto.dev
+        """
+        pid = os.getpid()
+        events = []
+        for name, start, end in self.events:
+            events.append({
+                'name': name,
+                'cat': 'stage',
+                'ph': 'X',
+                'ts': (start-self.origin)*1e6,
+                'dur': (end-start)*1e6,
+                'pid': pid,
+                'tid': 0,
+                })
+        with open(filename, 'w') as fp:
+            json.dump({'traceEvents': events}, fp)
+
+PROFILER = Profiler()
+if os.environ.get('CELESTE_MON_PROFILE'):
+    PROFILER.enable()
+
+def stage(name):
+    return PROFILER.stage(name)
+
+def count(name, records=0, nbytes=0):
+    PROFILER.count(name, records, nbytes)
+
+def enable():
+    PROFILER.enable()
+
+def parse_argv(argv):
+    """
+    Strip the profiling flags out of argv and apply them.
+
+    --profile               print a stage summary on exit
+    --trace <file>          also write a chrome trace of the stages
+    --pstats <file>         also run the whole thing under cProfile
+
+    Returns the remaining argv and a function wrapping the entry point.
+    """
+    argv = list(argv)
+    trace_file = None
+    pstats_file = None
+
+    if '--profile' in argv:
+        argv.remove('--profile')
+        enable()
+    for flag in ['--trace', '--pstats']:
+        if flag in argv:
+            idx = argv.index(flag)
+            if idx+1 >= len(argv):
+                sys.exit(f'{flag} needs a file name')
+            value = argv[idx+1]
+            del argv[idx:idx+2]
+            enable()
+            if flag == '--trace':
+                trace_file = value
+            else:
+                pstats_file = value
+
+    def run(func, *args, **kwargs):
+        #a run that fails still gets its profile
+        try:
+            if pstats_file is not None:
+                import cProfile
+                profile = cProfile.Profile()
+                try:
+                    profile.runcall(func, *args, **kwargs)
+                finally:
+                    profile.dump_stats(pstats_file)
+                    print(f'Wrote cProfile stats to {pstats_file}')
+            else:
+                func(*args, **kwargs)
+        finally:
+            PROFILER.print_summary()
+            if trace_file is not None:
+                PROFILER.write_chrome_trace(trace_file)
+                print(f'Wrote chrome trace to {trace_file}')
+
+    return argv, run
@@ -0,0 +1,146 @@
+"""
+Capture quality report.
+
+Works on two columns of a whole capture, the recorder's wall clock stamp and
+the chapter timer frame of each state, with vectorized diffs between
+consecutive states:
+
+    dropped     timer advanced by more than one frame between two states
+    duplicate   timer did not advance, the same game frame was stored twice
+    slow        more than 1.05 frames of wall clock between two states, what
+                main.py prints while recording
+    jitter      spread of the wall clock interval of single frame steps
+    savestate   timer went backwards or ran ahead of the wall clock, see
+                decode.timer_jump. Runs are split there.
+    restart     a backwards jump to the start of a chapter
+
+Each capture is one session. The report is kept in the index under 'quality'.
+
+    quality.py <data file> [data file ...]
+"""
+import sys
+
+import numpy as np
+
+from decode import JUMP_SLACK
+
+#slower than this many frames between states is a slow frame, as in main.py
+GAP = 1.05
+#a backwards jump landing this close to the start of the chapter is a restart
+RESTART_FRAMES = 10
+
+def session_columns(msgs):
+    states = [x for x in msgs if x.is_state]
+    stamp = np.fromiter((x.stamp for x in states), dtype=np.float64, count=len(states))
+    frame = np.fromiter((x.frame for x in states), dtype=np.int64, count=len(states))
+    offset = np.fromiter((x.file_start_idx for x in states), dtype=np.int64, count=len(states))
+    return stamp, frame, offset
+
+class Report():
+    def __init__(self, stamp, frame, offset=None):
+        """
+        stamp and frame of every state in capture order, offset its byte
+        offset in the capture if known
+        """
+        self.states = len(stamp)
+        if offset is None:
+            offset = np.arange(len(stamp))
+        self.duration = float(stamp[-1]-stamp[0]) if len(stamp) > 1 else 0
+
+        dt = np.diff(stamp)
+        dframe = np.diff(frame)
+        #states without a readable timer have frame -1
+        timed = (frame[:-1] >= 0) & (frame[1:] >= 0)
+
+        jump = timed & ((dframe < 0) | (dframe > dt*60 + JUMP_SLACK))
+        steady = timed & ~jump
+
+        dropped = steady & (dframe > 1)
+        self.dropped = int(dropped.sum())
+        self.missed = int((dframe[dropped]-1).sum())
+        self.duplicates = int((steady & (dframe == 0)).sum())
+        self.slow = int((dt*60 > GAP).sum())
+        self.clock_steps = int((dt < 0).sum())
+        self.untimed = int((frame < 0).sum())
+
+        single = dt[steady & (dframe == 1)]*1000
+        if len(single) > 0:
+            self.interval = {
+                'mean': float(single.mean()),
+                'std': float(single.std()),
+                'p50': float(np.percentile(single, 50)),
+                'p99': float(np.percentile(single, 99)),
+                'max': float(single.max()),
+                }
+        else:
+            self.interval = None
+
+        idx = np.flatnonzero(jump)
+        restart = (dframe[idx] < 0) & (frame[idx+1] < RESTART_FRAMES)
+        self.jumps = [{
+            'offset': int(offset[i+1]),
+            'stamp': float(stamp[i+1]),
+            'from': int(frame[i]),
+            'to': int(frame[i+1]),
+            'kind': 'restart' if r else 'savestate',
+            } for i, r in zip(idx, restart)]
+
+    @staticmethod
+    def from_msgs(msgs):
+        return Report(*session_columns(msgs))
+
+    def savestates(self):
+        return sum(1 for x in self.jumps if x['kind'] == 'savestate')
+
+    def restarts(self):
+        return sum(1 for x in self.jumps if x['kind'] == 'restart')
+
+    def summary(self):
+        """
+        json-able form stored in the index
+        """
+        return {
+            'states': self.states,
+            'duration': self.duration,
+            'dropped': self.dropped,
+            'missed': self.missed,
+            'duplicates': self.duplicates,
+            'slow': self.slow,
+            'clock_steps': self.clock_steps,
+            'untimed': self.untimed,
+            'interval': self.interval,
+            'jumps': self.jumps,
+            }
+
+def format_summary(summary, name=''):
+    lines = [
+        f'{name}{summary["states"]} states over {summary["duration"]:.1f} s',
+        f'{name}{summary["dropped"]} gaps dropping {summary["missed"]} frames, {summary["duplicates"]} duplicate frames, '
+        + f'{summary["slow"]} slow frames, {summary["clock_steps"]} wall clock steps backwards, {summary["untimed"]} states without a timer',
+        ]
+    interval = summary['interval']
+    if interval is not None:
+        lines.append(f'{name}frame interval {interval["mean"]:.2f} ms mean, {interval["std"]:.2f} ms std, '
+            + f'{interval["p50"]:.2f} ms median, {interval["p99"]:.2f} ms p99, {interval["max"]:.2f} ms max')
+    kinds = [x['kind'] for x in summary['jumps']]
+    lines.append(f'{name}{kinds.count("savestate")} savestate loads, {kinds.count("restart")} chapter restarts')
+    return lines
+
+def session_report(roomset):
+    """
+    Quality summary of a capture, from the index or computed from the capture
+    """
+    summary = roomset.extra.get('quality', None)
+    if summary is None:
+        from decode import read_file
+
+        summary = roomset.extra['quality'] = Report.from_msgs(read_file(roomset.infile)).summary()
+        roomset.save_index()
+    return summary
+
+if __name__ == '__main__':
+    from decode import RoomSet
+
+    for infile in sys.argv[1:]:
+        for line in format_summary(session_report(RoomSet(infile)), f'{infile}: '):
+            print(line)
@@ -0,0 +1,179 @@
+"""
+Run selection against the per-run summary table stored in the capture index.
+
+Filters only touch the summary columns. Matching runs are loaded from their byte
+ranges in the capture when asked for, so a query never reparses the whole file.
+
+    clears = roomset.query().room('c-b1').clears().frames(max=300)
+    for run in clears.runs():
+        run.plot(ax)
+"""
+import sys
+import argparse
+
+import numpy as np
+
+from model import state_to_idx
+
+class Query():
+    def __init__(self, roomset, mask=None):
+        self.roomset = roomset
+        self.table = summary_columns(roomset)
+        if mask is None:
+            mask = np.ones(len(self.table['start']), dtype=bool)
+        self.mask = mask
+
+    def _filter(self, mask):
+        return Query(self.roomset, self.mask & mask)
+
+    def room(self, *names):
+        return self._filter(np.isin(self.table['room'], names))
+
+    def dead(self, value=True):
+        return self._filter(self.table['dead'] == value)
+
+    def nocontrol(self, value=True):
+        return self._filter(self.table['nocontrol'] == value)
+
+    def savestate(self, value=True):
+        return self._filter(self.table['savestate'] == value)
+
+    def clears(self):
+        """
+        Runs that left the room, i.e. did not end in a death, lost control or a
+        savestate load
+        """
+        return self._filter(~self.table['dead'] & ~self.table['nocontrol'] & ~self.table['savestate'])
+
+    def frames(self, min=None, max=None):
+        mask = np.ones_like(self.mask)
+        if min is not None:
+            mask &= self.table['frames'] >= min
+        if max is not None:
+            mask &= self.table['frames'] <= max
+        return self._filter(mask)
+
+    def has_state(self, *names):
+        """
+        Runs that were in every one of the given states at some point
+        """
+        bits = state_bits(names)
+        return self._filter((self.table['states'] & bits) == bits)
+
+    def without_state(self, *names):
+        bits = state_bits(names)
+        return self._filter((self.table['states'] & bits) == 0)
+
+    def region(self, xmin, xmax, ymin, ymax, inside=False):
+        """
+        Runs whose bounds overlap the rectangle, or lie entirely inside it if
+        inside is set.
+        """
+        t = self.table
+        if inside:
+            mask = (t['xmin'] >= xmin) & (t['xmax'] <= xmax) & (t['ymin'] >= ymin) & (t['ymax'] <= ymax)
+        else:
+            mask = (t['xmax'] >= xmin) & (t['xmin'] <= xmax) & (t['ymax'] >= ymin) & (t['ymin'] <= ymax)
+        return self._filter(mask)
+
+    def between(self, start=None, end=None):
+        """
+        Runs that started at or after start and ended before end, in capture
+        timestamps
+        """
+        mask = np.ones_like(self.mask)
+        if start is not None:
+            mask &= self.table['start_stamp'] >= start
+        if end is not None:
+            mask &= self.table['end_stamp'] < end
+        return self._filter(mask)
+
+    def indices(self):
+        return np.flatnonzero(self.mask)
+
+    def __len__(self):
+        return int(self.mask.sum())
+
+    def summaries(self):
+        """
+        Summary rows of the matching runs as dicts
+        """
+        result = []
+        for idx in self.indices():
+            result.append({k: v[idx].item() for k,v in self.table.items()})
+        return result
+
+    def runs(self):
+        """
+        Lazily load the matching runs from the capture
+        """
+        for idx in self.indices():
+            yield self.roomset.load_run(int(self.table['start'][idx]), int(self.table['end'][idx]))
+
+def state_bits(names):
+    bits = 0
+    for name in names:
+        bits |= 1<<state_to_idx[name]
+    return np.int64(bits)
+
+def summary_columns(roomset):
+    """
+    NumPy view of the index run table, built once per RoomSet
+    """
+    table = getattr(roomset, '_summary_columns', None)
+    if table is None:
+        runs = roomset.runs
+        table = {
+            'room': np.array(runs['room'], dtype=str),
+            'start': np.array(runs['start'], dtype=np.int64),
+            'end': np.array(runs['end'], dtype=np.int64),
+            'start_stamp': np.array(runs['start_stamp'], dtype=np.float64),
+            'end_stamp': np.array(runs['end_stamp'], dtype=np.float64),
+            'dead': np.array(runs['dead'], dtype=bool),
+            'nocontrol': np.array(runs['nocontrol'], dtype=bool),
+            'savestate': np.array(runs['savestate'], dtype=bool),
+            'msgs': np.array(runs['msgs'], dtype=np.int64),
+            'frames': np.array(runs['frames'], dtype=np.int64),
+            'xmin': np.array(runs['xmin'], dtype=np.float64),
+            'xmax': np.array(runs['xmax'], dtype=np.float64),
+            'ymin': np.array(runs['ymin'], dtype=np.float64),
+            'ymax': np.array(runs['ymax'], dtype=np.float64),
+            'states': np.array(runs['states'], dtype=np.int64),
+            }
+        roomset._summary_columns = table
+    return table
+
+def main(argv):
+    from decode import RoomSet
+
+    parser = argparse.ArgumentParser(description='List runs matching a filter.')
+    parser.add_argument('capture')
+    parser.add_argument('--room', nargs='+', default=None)
+    parser.add_argument('--dead', action='store_true')
+    parser.add_argument('--clears', action='store_true')
+    parser.add_argument('--min-frames', type=int, default=None)
+    parser.add_argument('--max-frames', type=int, default=None)
+    parser.add_argument('--state', nargs='+', default=None)
+    parser.add_argument('--region', nargs=4, type=float, default=None, metavar=('XMIN', 'XMAX', 'YMIN', 'YMAX'))
+    args = parser.parse_args(argv[1:])
+
+    q = RoomSet(args.capture).query()
+    if args.room is not None:
+        q = q.room(*args.room)
+    if args.dead:
+        q = q.dead()
+    if args.clears:
+        q = q.clears()
+    q = q.frames(args.min_frames, args.max_frames)
+    if args.state is not None:
+        q = q.has_state(*args.state)
+    if args.region is not None:
+        q = q.region(*args.region)
+
+    for row in q.summaries():
+        outcome = 'dead' if row['dead'] else 'nocontrol' if row['nocontrol'] else 'savestate' if row['savestate'] else 'clear'
+        print(f"{row['room']}: {row['frames']} frames, {outcome}, bytes {row['start']}-{row['end']}")
+    print(f'{len(q)} runs')
+
+if __name__ == '__main__':
+    main(sys.argv)
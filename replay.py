@@ -0,0 +1,179 @@
+"""
+Replay a capture into a file backed shared memory region so the recorders can be
+exercised without the game.
+
+    replay.py <capture> --target /dev/shm/celestetas --layout celestetas [--speed 4]
+    main.py --source /dev/shm/celestetas -o replayed.dat
+
+The celestetas layout writes the original CelesteTAS message bytes and needs a raw
+.dat capture. The tuw layout is rebuilt from decoded states and works from .dat
+or .bin files. Inputs are not part of either capture, so the tuw input block is
+left zeroed.
+"""
+import sys
+import os
+import time
+import struct
+import argparse
+
+import blocks
+import scan
+import sources
+import tuw
+from model import state_to_idx
+
+class Frame():
+    def __init__(self, stamp, payload):
+        self.stamp = stamp
+        self.payload = payload
+
+def celestetas_frames(filename):
+    raw = blocks.read_capture(filename)
+    scanner = scan.Scanner(raw)
+    for start, end in scanner.records():
+        stamp = scanner.stamp(start)
+        #everything after the stamp is exactly what was read out of the mmap
+        yield Frame(stamp, raw[start+8:end])
+
+def tuw_payload(sequence, stamp, frame, deaths, room, pos, speed, stamina, liftboost, state, dashes, control):
+    head = struct.pack(tuw.HEAD_FMT, sequence, stamp, int(frame*1e7/60), deaths)
+    player = struct.pack(tuw.PLAYER_STATE_FMT,
+        pos[0], -pos[1], speed[0], -speed[1], stamina, liftboost[0], liftboost[1],
+        state, dashes, control, 0)
+    inputs = struct.pack(tuw.INPUT_STATE_FMT, 0, 0, 0, 0)
+    return head + room.encode('ascii') + b'\x00' + player + inputs
+
+def first_state(names):
+    for name in names:
+        if name in state_to_idx:
+            return state_to_idx[name]
+    return 0
+
+def tuw_frames_dat(filename):
+    from decode import read_file
+
+    deaths = 0
+    sequence = 0
+    was_dead = False
+    for msg in read_file(filename):
+        if not msg.is_state:
+            continue
+        if msg.dead and not was_dead:
+            deaths += 1
+        was_dead = msg.dead
+        sequence += 1
+        payload = tuw_payload(sequence, msg.stamp, max(msg.frame, 0), deaths, msg.room,
+            msg.pos, msg.speed, msg.stamina, (0, 0), first_state(msg.state),
+            int('CanDash' in msg.statuses), int(not msg.nocontrol))
+        yield Frame(msg.stamp, payload)
+
+def tuw_frames_bin(filename):
+    from party import read_states
+
+    deaths = 0
+    sequence = 0
+    was_dead = False
+    for gs in read_states(filename):
+        statuses = {x.status for x in gs.statuses}
+        dead = 'Dead' in statuses or 'StIntroRespawn' in gs.states
+        if dead and not was_dead:
+            deaths += 1
+        was_dead = dead
+        sequence += 1
+        #pos and speed are stored with y flipped, tuw_payload flips them back
+        payload = tuw_payload(sequence, gs.stamp, gs.frame, deaths, gs.room,
+            gs.pos, gs.vel, gs.stamina, gs.liftboost[2:4], first_state(gs.states),
+            int('CanDash' in statuses), int(not 'NoControl' in statuses))
+        yield Frame(gs.stamp, payload)
+
+def load_frames(filename, layout):
+    ext = os.path.splitext(filename)[1]
+    if layout == 'celestetas':
+        if ext == '.bin':
+            raise RuntimeError('The celestetas layout needs the raw .dat capture, .bin files no longer hold the original message bytes')
+        return list(celestetas_frames(filename))
+    if ext == '.bin':
+        return list(tuw_frames_bin(filename))
+    return list(tuw_frames_dat(filename))
+
+def write_celestetas(fp, frame):
+    fp[0:len(frame.payload)] = frame.payload
+
+def write_tuw(fp, frame):
+    #size goes in last so a reader never sees a new size over an old payload
+    fp[2:2+len(frame.payload)] = frame.payload
+    fp[0:2] = struct.pack('=H', len(frame.payload))
+
+class Stats():
+    def __init__(self):
+        self.frames = 0
+        self.late = 0
+        self.worst = 0
+
+def replay(fp, frames, write, speed=1, fps=None, stats=None):
+    """
+    Write frames at their original spacing divided by speed, or at a fixed fps
+    times speed. The schedule is absolute, so a late frame doesn't push back
+    the ones after it.
+    """
+    if stats is None:
+        stats = Stats()
+    if len(frames) == 0:
+        return stats
+
+    first = frames[0].stamp
+    start = time.perf_counter()
+    for idx, frame in enumerate(frames):
+        if fps is None:
+            offset = (frame.stamp-first)/speed
+        else:
+            offset = idx/(fps*speed)
+        target = start+offset
+        now = time.perf_counter()
+        if target > now:
+            time.sleep(target-now)
+        else:
+            lag = now-target
+            if lag > 1/60:
+                stats.late += 1
+            stats.worst = max(stats.worst, lag)
+        write(fp, frame)
+        stats.frames += 1
+    return stats
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Replay a capture into shared memory.')
+    parser.add_argument('capture')
+    parser.add_argument('--target', required=True, help='file to map, e.g. /dev/shm/celestetas')
+    parser.add_argument('--layout', default='celestetas', choices=['celestetas', 'tuw'])
+    parser.add_argument('--speed', type=float, default=1, help='playback speed multiplier')
+    parser.add_argument('--fps', type=float, default=None,
+        help='ignore the captured timing and play at this frame rate (times --speed)')
+    parser.add_argument('--loop', type=int, default=1, help='number of times to play the capture')
+    args = parser.parse_args(argv[1:])
+
+    frames = load_frames(args.capture, args.layout)
+    print(f'Loaded {len(frames)} frames')
+
+    if args.layout == 'celestetas':
+        fp = sources.open_celestetas(args.target)
+        write = write_celestetas
+    else:
+        fp = sources.open_tuw(args.target, create=True)
+        write = write_tuw
+
+    stats = Stats()
+    start = time.perf_counter()
+    try:
+        for _ in range(args.loop):
+            replay(fp, frames, write, args.speed, args.fps, stats)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fp.close()
+    wall = time.perf_counter()-start
+    print(f'{stats.frames} frames in {wall:.1f} s ({stats.frames/max(wall, 1e-9):.1f} fps), '
+        + f'{stats.late} late by more than a frame, worst {stats.worst*1000:.1f} ms')
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,270 @@
+"""
+Self contained HTML report of a session: per room stats and a map of every run.
+
+Run positions are decimated and quantized before they are embedded:
+
+    coordinates are int16 steps of RESOLUTION pixels from the room's lower left
+    tile corner, consecutive points that quantize to the same step are
+    dropped (the first and last point of a run are always kept), and each run
+    is delta encoded from its first point.
+
+All runs of a room go into one base64 int16 array with a point offset table,
+which the page decodes with an Int16Array and a running sum, so a multi-hour
+session stays a few MB. Rooms are encoded in parallel across a process pool and
+drawn on a canvas once they scroll into view.
+
+    report.py <data file> [data file ...] [--output <file.html>] [--jobs N]
+"""
+import sys
+import os
+import json
+import base64
+import argparse
+
+import numpy as np
+
+from columns import Columns, Grid
+
+#pixels per quantization step
+RESOLUTION = 2
+
+#how a run ended, only clears are drawn in the clear colour, as in the stats
+OUTCOMES = ['clear', 'dead', 'nocontrol', 'savestate']
+
+def outcome(run):
+    if run.dead:
+        return OUTCOMES.index('dead')
+    if run.savestate:
+        return OUTCOMES.index('savestate')
+    if run.nocontrol:
+        return OUTCOMES.index('nocontrol')
+    return OUTCOMES.index('clear')
+
+def quantize(cols):
+    """
+    Decimated, quantized and delta encoded points of every run of cols.
+    Returns the grid origin, int16 deltas and the point offset of each run.
+    """
+    grid = Grid.covering(cols.x, cols.y)
+    qx = np.rint((cols.x - grid.x0*grid.tile)/RESOLUTION).astype(np.int64)
+    qy = np.rint((cols.y - grid.y0*grid.tile)/RESOLUTION).astype(np.int64)
+    if len(cols) > 0 and max(qx.max(), qy.max()) > np.iinfo(np.int16).max:
+        raise RuntimeError(f'Room is too large for int16 coordinates at {RESOLUTION} px')
+
+    keep = cols.run_start.copy()
+    keep[1:] |= (qx[1:] != qx[:-1]) | (qy[1:] != qy[:-1])
+    ends = cols.offsets[1:][np.diff(cols.offsets) > 0]-1
+    keep[ends] = True
+    idx = np.flatnonzero(keep)
+    qx = qx[idx]
+    qy = qy[idx]
+
+    dx = np.diff(qx, prepend=0)
+    dy = np.diff(qy, prepend=0)
+    #runs start from absolute positions
+    first = cols.run_start[idx]
+    dx[first] = qx[first]
+    dy[first] = qy[first]
+
+    points = np.stack([dx, dy], axis=-1).astype('<i2')
+    offsets = np.searchsorted(idx, cols.offsets)
+    return grid, points, offsets
+
+def room_data(infile, room_name):
+    """
+    Everything the page needs for one room, run in a worker process
+    """
+    from decode import RoomSet
+
+    roomset = RoomSet(infile)
+    runs = [x for room in roomset.get_room(room_name) for x in room.runs]
+    cols = Columns.from_runs(runs)
+    grid, points, offsets = quantize(cols)
+    return {
+        'name': room_name,
+        'origin': [grid.x0*grid.tile, grid.y0*grid.tile],
+        'size': [grid.width*grid.tile//RESOLUTION+1, grid.height*grid.tile//RESOLUTION+1],
+        'outcome': [outcome(x) for x in runs],
+        'frames': [len(x.msgs) for x in runs],
+        'offsets': offsets.tolist(),
+        'points': base64.b64encode(points.tobytes()).decode('ascii'),
+        }
+
+def session_data(infile, jobs=None):
+    from concurrent.futures import ProcessPoolExecutor
+    from decode import RoomSet
+    import quality
+    import stats
+
+    #anything cached in the index is filled in before the workers read it
+    roomset = RoomSet(infile)
+    rows = stats.room_stats(roomset)
+    summary = quality.session_report(roomset)
+    names = list(roomset.index.keys())
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        rooms = list(pool.map(room_data, [infile]*len(names), names))
+    for room in rooms:
+        room['stats'] = stats.describe(rows[room['name']])
+    return {
+        'capture': os.path.basename(infile),
+        'resolution': RESOLUTION,
+        'outcomes': OUTCOMES,
+        'quality': quality.format_summary(summary),
+        'rooms': rooms,
+        }
+
+def report_file(infile):
+    return os.path.splitext(infile)[0]+'_report.html'
+
+def write_report(fp, data):
+    #keep a room name from closing the script element
+    payload = json.dumps(data, separators=(',', ':')).replace('</', '<\\/')
+    fp.write(TEMPLATE.replace('{{title}}', data['capture']).replace('{{data}}', payload))
+
+TEMPLATE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{{title}}</title>
+<style>
+body { font-family: sans-serif; font-size: 13px; margin: 1em 2em; }
+table { border-collapse: collapse; }
+td, th { padding: 2px 8px; text-align: right; }
+th { border-bottom: 1px solid #888; }
+td:first-child, th:first-child { text-align: left; }
+.room { margin: 2em 0; }
+canvas { border: 1px solid #ccc; background: #fff; max-width: 100%; }
+.quality { color: #555; white-space: pre; }
+</style>
+</head>
+<body>
+<h1>{{title}}</h1>
+<div class="quality" id="quality"></div>
+<table id="summary"><tr><th>room</th><th>runs</th><th>deaths</th><th>death rate</th>
+<th>clears</th><th>best</th><th>median</th><th>first clear</th></tr></table>
+<div id="rooms"></div>
+<script>
+const DATA = {{data}};
+
+//runs cut short by a savestate load or lost control are neither deaths nor clears
+const STYLES = {
+    clear: 'rgba(255, 0, 255, 0.8)',
+    dead: 'rgba(0, 0, 0, 0.25)',
+    nocontrol: 'rgba(0, 0, 255, 0.25)',
+    savestate: 'rgba(0, 0, 255, 0.25)',
+};
+
+function decode(room) {
+    const raw = atob(room.points);
+    const bytes = new Uint8Array(raw.length);
+    for (let i = 0; i < raw.length; i++) bytes[i] = raw.charCodeAt(i);
+    const deltas = new Int16Array(bytes.buffer);
+    const points = new Int32Array(deltas.length);
+    for (let run = 0; run + 1 < room.offsets.length; run++) {
+        let x = 0, y = 0;
+        for (let i = room.offsets[run]; i < room.offsets[run + 1]; i++) {
+            x += deltas[2 * i];
+            y += deltas[2 * i + 1];
+            points[2 * i] = x;
+            points[2 * i + 1] = y;
+        }
+    }
+    return points;
+}
+
+function draw(canvas, room) {
+    const points = decode(room);
+    const [w, h] = room.size;
+    const scale = Math.max(1, Math.floor(900 / w));
+    canvas.width = w * scale;
+    canvas.height = h * scale;
+    const ctx = canvas.getContext('2d');
+    ctx.lineWidth = 1;
+    //y is up in the game, down on the canvas
+    const px = i => points[2 * i] * scale;
+    const py = i => (h - points[2 * i + 1]) * scale;
+    for (let run = 0; run + 1 < room.offsets.length; run++) {
+        const a = room.offsets[run], b = room.offsets[run + 1];
+        if (a == b) continue;
+        const outcome = DATA.outcomes[room.outcome[run]];
+        ctx.strokeStyle = STYLES[outcome];
+        ctx.beginPath();
+        ctx.moveTo(px(a), py(a));
+        for (let i = a + 1; i < b; i++) ctx.lineTo(px(i), py(i));
+        ctx.stroke();
+        ctx.fillStyle = 'blue';
+        ctx.fillRect(px(a) - 2, py(a) - 2, 4, 4);
+        if (outcome == 'dead') {
+            ctx.fillStyle = 'red';
+            ctx.fillRect(px(b - 1) - 2, py(b - 1) - 2, 4, 4);
+        }
+    }
+}
+
+function cell(row, text) {
+    const td = document.createElement('td');
+    td.textContent = text;
+    row.appendChild(td);
+}
+
+document.getElementById('quality').textContent = DATA.quality.join('\\n');
+const summary = document.getElementById('summary');
+const container = document.getElementById('rooms');
+const observer = new IntersectionObserver(entries => {
+    for (const entry of entries) {
+        if (!entry.isIntersecting) continue;
+        observer.unobserve(entry.target);
+        draw(entry.target, DATA.rooms[entry.target.dataset.room]);
+    }
+});
+DATA.rooms.forEach((room, idx) => {
+    const s = room.stats;
+    const row = document.createElement('tr');
+    const link = document.createElement('a');
+    link.href = '#room-' + idx;
+    link.textContent = room.name;
+    const td = document.createElement('td');
+    td.appendChild(link);
+    row.appendChild(td);
+    [s.attempts, s.deaths, Math.round(100 * s.death_rate) + '%', s.clears,
+        s.best ?? '', s.median ?? '', s.first_clear ?? ''].forEach(x => cell(row, x));
+    summary.appendChild(row);
+
+    const div = document.createElement('div');
+    div.className = 'room';
+    div.id = 'room-' + idx;
+    const title = document.createElement('h2');
+    title.textContent = room.name + ': ' + s.attempts + ' runs, ' + s.deaths + ' deaths';
+    div.appendChild(title);
+    const canvas = document.createElement('canvas');
+    canvas.dataset.room = idx;
+    canvas.width = room.size[0];
+    canvas.height = room.size[1];
+    div.appendChild(canvas);
+    container.appendChild(div);
+    observer.observe(canvas);
+});
+</script>
+</body>
+</html>
+'''
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Write a self contained HTML report per capture.')
+    parser.add_argument('captures', nargs='+')
+    parser.add_argument('--output', '-o', default=None, help='report file, <capture>_report.html by default')
+    parser.add_argument('--jobs', '-j', type=int, default=None, help='worker processes, all cores by default')
+    args = parser.parse_args(argv[1:])
+    if args.output is not None and len(args.captures) > 1:
+        raise RuntimeError('--output needs a single capture')
+
+    for infile in args.captures:
+        data = session_data(infile, args.jobs)
+        outfile = args.output if args.output is not None else report_file(infile)
+        with open(outfile, 'w', encoding='utf-8') as fp:
+            write_report(fp, data)
+        points = sum(x['offsets'][-1] for x in data['rooms'])
+        print(f'{outfile}: {len(data["rooms"])} rooms, {points} points, {os.path.getsize(outfile)/1e6:.2f} MB')
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,151 @@
+"""
+Record framing for raw captures that survives damage.
+
+Every record header is checked before it is trusted: the stamp has to be a
+plausible wall clock time close to the previous one, the message id has to be
+known and the size has to fit in the CelesteTAS shared memory buffer. When a
+header fails, the scanner searches forward for the high bytes of the last good
+stamp (which only change every few days) instead of retrying byte by byte, and
+records the range it skipped.
+"""
+import sys
+import math
+import struct
+
+from model import MessageId
+
+#stamp, message id, signature, data size
+HEADER = struct.Struct('=dBII')
+
+VALID_IDS = {x.value for x in MessageId}
+
+#same as the mmap size in main.py, nothing bigger can be captured
+MAX_SIZE = 0x100000
+
+STAMP_MIN = 1e9
+STAMP_MAX = 4e9
+#how far a stamp may move from the previous good one, in seconds
+MAX_BACKSTEP = 60
+MAX_GAP = 86400
+
+#bytes 5-7 of a little endian double near 1.7e9 change about every three days
+NEEDLE_START = 5
+
+class Scanner():
+    def __init__(self, raw, base=0):
+        """
+        raw is the capture bytes starting at file offset base
+        """
+        self.raw = raw
+        self.base = base
+        self.skipped = []
+        self.truncated = None
+
+    def check(self, offset, last_stamp=None):
+        """
+        Returns the end offset of a valid record at offset, None if the header
+        is bad, or -1 if it looks fine but runs past the end of the data.
+        """
+        raw = self.raw
+        if offset < 0 or offset+HEADER.size > len(raw):
+            return -1 if offset < len(raw) else None
+        stamp, id_, _, size = HEADER.unpack_from(raw, offset)
+
+        if not math.isfinite(stamp) or stamp < STAMP_MIN or stamp > STAMP_MAX:
+            return None
+        if last_stamp is not None and (stamp < last_stamp-MAX_BACKSTEP or stamp > last_stamp+MAX_GAP):
+            return None
+        if not id_ in VALID_IDS:
+            return None
+        if size > MAX_SIZE:
+            return None
+
+        end = offset+HEADER.size+size
+        if end > len(raw):
+            return -1
+        return end
+
+    def stamp(self, offset):
+        return HEADER.unpack_from(self.raw, offset)[0]
+
+    def resync(self, offset, last_stamp):
+        """
+        Offset of the next header after offset that is valid and is followed
+        by either another valid header or the end of the data.
+        """
+        raw = self.raw
+        if last_stamp is not None:
+            needle = struct.pack('d', last_stamp)[NEEDLE_START:]
+            shift = NEEDLE_START
+        else:
+            #top byte of any double between 2^30 and 2^32
+            needle = b'\x41'
+            shift = 7
+
+        pos = offset+1
+        while True:
+            hit = raw.find(needle, pos+shift)
+            if hit == -1:
+                return None
+            candidate = hit-shift
+            pos = candidate+1
+            end = self.check(candidate, last_stamp)
+            if end is None:
+                continue
+            if end == -1 or end == len(raw):
+                return candidate
+            stamp = self.stamp(candidate)
+            if self.check(end, stamp) is not None:
+                return candidate
+
+    def records(self):
+        """
+        Yields (start, end) offsets into raw of every valid record
+        """
+        offset = 0
+        last_stamp = None
+        while offset < len(self.raw):
+            end = self.check(offset, last_stamp)
+            if end is None:
+                nxt = self.resync(offset, last_stamp)
+                if nxt is None:
+                    self.skip(offset, len(self.raw))
+                    return
+                self.skip(offset, nxt)
+                offset = nxt
+                continue
+            if end == -1:
+                #a corrupt size can also point past the end, it is only a
+                #truncated record if no complete one follows
+                nxt = self.resync(offset, last_stamp)
+                if nxt is None or self.check(nxt, last_stamp) in (None, -1):
+                    self.truncated = (self.base+offset, self.base+len(self.raw))
+                    return
+                self.skip(offset, nxt)
+                offset = nxt
+                continue
+
+            last_stamp = self.stamp(offset)
+            yield offset, end
+            offset = end
+
+    def skip(self, start, end):
+        self.skipped.append((self.base+start, self.base+end))
+
+    def report(self, name=''):
+        lines = []
+        for start, end in self.skipped:
+            lines.append(f'{name}skipped {end-start} bad bytes at {start}-{end}')
+        if self.truncated is not None:
+            start, end = self.truncated
+            lines.append(f'{name}ignored truncated record at {start}-{end}')
+        return lines
+
+if __name__ == '__main__':
+    for filename in sys.argv[1:]:
+        with open(filename, 'rb') as fp:
+            scanner = Scanner(fp.read())
+        count = sum(1 for _ in scanner.records())
+        print(f'{filename}: {count} records')
+        for line in scanner.report():
+            print(line)
@@ -0,0 +1,340 @@
+"""
+Route similarity search and clustering for the runs of a room.
+
+Every run gets two compact descriptors:
+* its path resampled to a fixed number of points evenly spaced by distance
+  travelled, so runs of different lengths compare point for point
+* a bitset of the tiles it passed through
+
+Nearest neighbour queries and clustering work on whole descriptor matrices at
+once. An early abandoning DTW is only used to rerank the handful of best
+candidates.
+"""
+import sys
+import os
+
+import numpy as np
+
+from columns import Columns, Grid, room_cache
+
+POINTS = 32
+
+#set bits per byte value
+POPCOUNT = np.array([bin(x).count('1') for x in range(256)], dtype=np.uint16)
+
+def resample(cols, points=POINTS):
+    """
+    (runs, points, 2) positions evenly spaced by distance along each run.
+    Runs that never move are spread evenly by frame instead.
+    """
+    runs = cols.runs()
+    if len(cols) == 0:
+        return np.zeros((runs, points, 2), dtype=np.float32)
+
+    x = cols.x.astype(np.float64)
+    y = cols.y.astype(np.float64)
+    step = np.zeros(len(x))
+    step[1:] = np.hypot(np.diff(x), np.diff(y))
+    step[cols.run_start] = 0
+
+    dist = np.cumsum(step)
+    starts = cols.offsets[:-1]
+    ends = cols.offsets[1:]
+    lengths = ends-starts
+    nonempty = lengths > 0
+
+    base = np.zeros(runs)
+    total = np.zeros(runs)
+    base[nonempty] = dist[starts[nonempty]]
+    total[nonempty] = dist[ends[nonempty]-1] - base[nonempty]
+
+    #fraction along own run, falling back to frame fraction for stationary runs
+    frac = dist - base[cols.run]
+    still = total[cols.run] <= 0
+    frac[~still] /= total[cols.run][~still]
+    local = cols.local_frame(np.arange(len(x)))
+    denom = np.maximum(lengths[cols.run]-1, 1)
+    frac[still] = local[still]/denom[still]
+
+    #run + fraction is non decreasing over all frames, so one searchsorted
+    #resamples every run at once
+    key = cols.run + frac*0.5
+    targets = (np.arange(runs)[:,None] + np.linspace(0, 0.5, points)[None,:]).ravel()
+    hi = np.searchsorted(key, targets, side='left')
+    hi = np.clip(hi, 0, len(x)-1)
+    lo = np.clip(hi-1, 0, len(x)-1)
+    same = cols.run[lo] == cols.run[hi]
+    lo = np.where(same, lo, hi)
+
+    span = key[hi]-key[lo]
+    weight = np.zeros(len(targets))
+    ok = span > 0
+    weight[ok] = (targets[ok]-key[lo][ok])/span[ok]
+    weight = np.clip(weight, 0, 1)
+
+    rx = x[lo] + (x[hi]-x[lo])*weight
+    ry = y[lo] + (y[hi]-y[lo])*weight
+    result = np.stack([rx, ry], axis=-1).reshape(runs, points, 2)
+    result[~nonempty] = 0
+    return result.astype(np.float32)
+
+def tile_bits(cols, grid=None):
+    """
+    Packed (runs, bytes) bitset of visited tiles per run
+    """
+    if grid is None:
+        grid = Grid.covering(cols.x, cols.y)
+    visited = np.zeros((cols.runs(), grid.tiles()), dtype=bool)
+    if len(cols) > 0:
+        visited[cols.run, grid.cell(cols.x, cols.y)] = True
+    return np.packbits(visited, axis=1), grid
+
+def regrid(bits, grid, target):
+    """
+    Move packed bitsets from grid onto the larger target grid
+    """
+    count = len(bits)
+    visited = np.unpackbits(bits, axis=1, count=grid.tiles()).reshape(count, grid.height, grid.width)
+    result = np.zeros((count, target.height, target.width), dtype=np.uint8)
+    dx = grid.x0-target.x0
+    dy = grid.y0-target.y0
+    result[:, dy:dy+grid.height, dx:dx+grid.width] = visited
+    return np.packbits(result.reshape(count, -1), axis=1)
+
+def dtw(a, b, window=None, cutoff=np.inf):
+    """
+    Dynamic time warping distance between two (n, 2) paths, with an optional
+    Sakoe-Chiba window. Gives up and returns inf as soon as every cell of a row
+    exceeds cutoff.
+    """
+    n = len(a)
+    m = len(b)
+    if window is None:
+        window = max(n, m)
+    window = max(window, abs(n-m))
+
+    cost = np.hypot(a[:,None,0]-b[None,:,0], a[:,None,1]-b[None,:,1])
+    prev = np.full(m+1, np.inf)
+    prev[0] = 0
+    for i in range(1, n+1):
+        cur = np.full(m+1, np.inf)
+        lo = max(1, i-window)
+        hi = min(m, i+window)
+        row = cost[i-1]
+        #diagonal and vertical moves are known for the whole row up front
+        best = np.minimum(prev[lo-1:hi], prev[lo:hi+1])
+        acc = cur[lo-1]
+        for j in range(lo, hi+1):
+            acc = row[j-1] + min(best[j-lo], acc)
+            cur[j] = acc
+        if cur[lo:hi+1].min() > cutoff:
+            return np.inf
+        prev = cur
+    return prev[m]
+
+class RouteIndex():
+    def __init__(self, keys, paths, bits, grid):
+        self.keys = list(keys)
+        self.paths = paths
+        self.bits = bits
+        self.grid = grid
+
+    def __len__(self):
+        return len(self.keys)
+
+    @staticmethod
+    def build(runs, keys, points=POINTS):
+        cols = Columns.from_runs(runs)
+        paths = resample(cols, points)
+        bits, grid = tile_bits(cols)
+        return RouteIndex(keys, paths, bits, grid)
+
+    @staticmethod
+    def empty(points=POINTS):
+        grid = Grid(0, 0, 1, 1)
+        bits = np.zeros((0, (grid.tiles()+7)//8), dtype=np.uint8)
+        return RouteIndex([], np.zeros((0, points, 2), dtype=np.float32), bits, grid)
+
+    @staticmethod
+    def concatenate(indices):
+        indices = [x for x in indices if len(x) > 0]
+        if len(indices) == 0:
+            return RouteIndex.empty()
+        grid = indices[0].grid
+        for index in indices[1:]:
+            grid = grid.union(index.grid)
+
+        keys = []
+        paths = []
+        bits = []
+        for index in indices:
+            keys.extend(index.keys)
+            paths.append(index.paths)
+            bits.append(regrid(index.bits, index.grid, grid))
+        return RouteIndex(keys, np.concatenate(paths), np.concatenate(bits), grid)
+
+    def path_distances(self, path):
+        """
+        Mean point to point distance from path to every run
+        """
+        delta = self.paths - path[None]
+        return np.sqrt((delta**2).sum(axis=-1)).mean(axis=-1)
+
+    def tile_distances(self, bits):
+        """
+        Jaccard distance between a tile bitset and every run
+        """
+        inter = POPCOUNT[self.bits & bits[None]].sum(axis=1).astype(np.float64)
+        union = POPCOUNT[self.bits | bits[None]].sum(axis=1).astype(np.float64)
+        result = np.ones(len(self))
+        ok = union > 0
+        result[ok] = 1 - inter[ok]/union[ok]
+        return result
+
+    def nearest(self, idx, k=5, metric='path', refine=0, window=None):
+        """
+        k nearest runs to run idx, excluding itself, as (index, distance)
+        pairs.
+
+        refine > 0 reranks that many of the closest candidates by DTW over
+        the resampled paths, abandoning any that can't beat the current kth
+        best.
+        """
+        if metric == 'path':
+            dist = self.path_distances(self.paths[idx])
+        else:
+            dist = self.tile_distances(self.bits[idx])
+        dist[idx] = np.inf
+
+        count = min(max(k, refine), len(self)-1)
+        if count <= 0:
+            return []
+        order = np.argpartition(dist, count-1)[:count]
+        order = order[np.argsort(dist[order])]
+
+        if refine <= 0:
+            return [(int(x), float(dist[x])) for x in order[:k]]
+
+        best = []
+        cutoff = np.inf
+        for other in order:
+            value = dtw(self.paths[idx], self.paths[other], window, cutoff)
+            if value == np.inf:
+                continue
+            best.append((value, int(other)))
+            best.sort()
+            best = best[:k]
+            if len(best) == k:
+                cutoff = best[-1][0]
+        return [(x, float(d)) for d, x in best]
+
+    def distance_matrix(self, metric='path'):
+        """
+        Full (runs, runs) distance matrix. Fine for one room of one session,
+        use cluster() for larger sets.
+        """
+        if metric == 'path':
+            flat = self.paths.reshape(len(self), -1, 2)
+            delta = flat[:,None] - flat[None,:]
+            return np.sqrt((delta**2).sum(axis=-1)).mean(axis=-1)
+
+        visited = np.unpackbits(self.bits, axis=1).astype(np.float32)
+        inter = visited @ visited.T
+        sizes = visited.sum(axis=1)
+        union = sizes[:,None] + sizes[None,:] - inter
+        result = np.ones_like(union)
+        ok = union > 0
+        result[ok] = 1 - inter[ok]/union[ok]
+        return result
+
+    def cluster(self, k, iterations=50, seed=0):
+        """
+        k-means over resampled paths with k-means++ seeding. Returns the
+        cluster label of every run and the index of the run closest to each
+        cluster centre.
+        """
+        rng = np.random.default_rng(seed)
+        data = self.paths.reshape(len(self), -1).astype(np.float64)
+        k = min(k, len(self))
+
+        centers = [data[rng.integers(len(data))]]
+        closest = ((data-centers[0])**2).sum(axis=1)
+        for _ in range(1, k):
+            total = closest.sum()
+            if total <= 0:
+                pick = rng.integers(len(data))
+            else:
+                pick = rng.choice(len(data), p=closest/total)
+            centers.append(data[pick])
+            closest = np.minimum(closest, ((data-data[pick])**2).sum(axis=1))
+        centers = np.array(centers)
+
+        sq = (data**2).sum(axis=1)
+        labels = np.zeros(len(data), dtype=np.int64)
+        for it in range(iterations):
+            dist = sq[:,None] - 2*data@centers.T + (centers**2).sum(axis=1)[None,:]
+            new_labels = dist.argmin(axis=1)
+            if it > 0 and np.array_equal(new_labels, labels):
+                break
+            labels = new_labels
+            onehot = np.zeros((len(data), k))
+            onehot[np.arange(len(data)), labels] = 1
+            sums = onehot.T @ data
+            counts = np.bincount(labels, minlength=k)
+            ok = counts > 0
+            centers[ok] = sums[ok]/counts[ok,None]
+
+        dist = sq[:,None] - 2*data@centers.T + (centers**2).sum(axis=1)[None,:]
+        medoids = [int(np.argmin(np.where(labels == c, dist[:,c], np.inf))) for c in range(k)]
+        return labels, medoids
+
+    def to_arrays(self, prefix=''):
+        return {
+            f'{prefix}keys': np.array(self.keys, dtype=str),
+            f'{prefix}paths': self.paths,
+            f'{prefix}bits': self.bits,
+            f'{prefix}grid': self.grid.to_array(),
+            }
+
+    @staticmethod
+    def from_arrays(data, prefix=''):
+        keys = [tuple(x) for x in data[f'{prefix}keys'].tolist()]
+        return RouteIndex(keys, data[f'{prefix}paths'], data[f'{prefix}bits'], Grid.from_array(data[f'{prefix}grid']))
+
+def routes_file(roomset):
+    return os.path.splitext(roomset.infile)[0]+'_routes.npz'
+
+def room_routes(roomset, room_name):
+    """
+    Route descriptors for every run of a room in one capture, cached in
+    <capture>_routes.npz next to the index.
+    """
+    def build():
+        runs = []
+        for room in roomset.get_room(room_name):
+            runs.extend(room.runs)
+        keys = [(roomset.infile, room_name, str(idx)) for idx in range(len(runs))]
+        return RouteIndex.build(runs, keys)
+
+    return room_cache(routes_file(roomset), roomset.infile, room_name, 'keys', RouteIndex.from_arrays, build)
+
+def main(argv):
+    from decode import RoomSet
+
+    room_name = argv[1]
+    k = int(argv[2])
+    captures = argv[3:]
+
+    roomsets = [RoomSet(x) for x in captures]
+    index = RouteIndex.concatenate([room_routes(x, room_name) for x in roomsets if room_name in x.index])
+    if len(index) == 0:
+        print(f'No runs of {room_name}')
+        return
+    labels, medoids = index.cluster(k)
+    for cluster, medoid in enumerate(medoids):
+        members = np.flatnonzero(labels == cluster)
+        source, _, run = index.keys[medoid]
+        print(f'route {cluster}: {len(members)} runs, e.g. run {run} of {os.path.basename(source)}')
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,41 @@
+"""
+Shared memory regions the recorders read from.
+
+In game, CelesteTAS publishes its state through a tagged (Windows only) mmap and
+the tuw mod through /tmp/celeste_tuw.share. Passing a path instead opens a plain
+file backed region with the same layout, which is what replay.py writes to.
+"""
+import os
+import mmap
+
+#size of the CelesteTAS shared memory buffer
+BUFFER_SIZE = 0x100000
+CELESTETAS_TAG = 'CelesteTAS'
+
+TUW_PATH = '/tmp/celeste_tuw.share'
+TUW_SIZE = 0x10000
+
+def open_file_region(path, size):
+    """
+    mmap of a file of at least size bytes, creating or growing it as needed
+    """
+    mode = 'r+b' if os.path.exists(path) else 'w+b'
+    with open(path, mode) as fp:
+        fp.seek(0, os.SEEK_END)
+        if fp.tell() < size:
+            fp.truncate(size)
+        fp.flush()
+        return mmap.mmap(fp.fileno(), size)
+
+def open_celestetas(path=None):
+    if path is None:
+        return mmap.mmap(-1, BUFFER_SIZE, CELESTETAS_TAG)
+    return open_file_region(path, BUFFER_SIZE)
+
+def open_tuw(path=None, create=False):
+    if path is None:
+        path = TUW_PATH
+    if create:
+        return open_file_region(path, TUW_SIZE)
+    with open(path, 'r+b') as fx:
+        return mmap.mmap(fx.fileno(), 0)
@@ -0,0 +1,210 @@
+"""
+Per room spatial index over every frame position.
+
+Frames are bucketed by tile (8 px by default) into postings sorted by tile, with
+an offset table per tile, so a rectangle query reads one contiguous slice of
+postings per tile row and then filters exactly on position. Postings carry the
+run and frame they came from plus flags for spawns and deaths.
+"""
+import sys
+import os
+
+import numpy as np
+
+from columns import Columns, Grid, room_cache
+
+SPAWN = 1
+DEATH = 2
+
+class Hits():
+    def __init__(self, index, idx):
+        self.index = index
+        self.idx = idx
+
+    def __len__(self):
+        return len(self.idx)
+
+    @property
+    def run(self):
+        return self.index.run[self.idx]
+
+    @property
+    def frame(self):
+        return self.index.frame[self.idx]
+
+    @property
+    def x(self):
+        return self.index.x[self.idx]
+
+    @property
+    def y(self):
+        return self.index.y[self.idx]
+
+    def runs(self):
+        """
+        Distinct runs that were hit
+        """
+        return np.unique(self.run)
+
+    def run_starts(self):
+        """
+        Capture byte offsets of the runs that were hit, matching the start
+        column of the index run table
+        """
+        return self.index.run_starts[self.runs()]
+
+class SpatialIndex():
+    def __init__(self, grid, cell_offsets, x, y, run, frame, flags, run_starts):
+        self.grid = grid
+        self.cell_offsets = cell_offsets
+        self.x = x
+        self.y = y
+        self.run = run
+        self.frame = frame
+        self.flags = flags
+        self.run_starts = run_starts
+
+    def __len__(self):
+        return len(self.x)
+
+    @staticmethod
+    def build(cols, run_starts=None, dead=None, tile=8):
+        """
+        cols is a Columns of all runs of the room, run_starts the capture byte
+        offset of each run and dead whether each run ended in a death.
+        """
+        grid = Grid.covering(cols.x, cols.y, tile)
+        cells = grid.cell(cols.x, cols.y)
+        order = np.argsort(cells, kind='stable')
+        counts = np.bincount(cells, minlength=grid.tiles())
+        cell_offsets = np.zeros(grid.tiles()+1, dtype=np.int64)
+        np.cumsum(counts, out=cell_offsets[1:])
+
+        flags = np.zeros(len(cols), dtype=np.uint8)
+        starts = cols.offsets[:-1]
+        ends = cols.offsets[1:]
+        nonempty = ends > starts
+        flags[starts[nonempty]] |= SPAWN
+        if dead is not None:
+            dead = np.asarray(dead, dtype=bool)
+            last = ends[nonempty & dead]-1
+            flags[last] |= DEATH
+
+        if run_starts is None:
+            run_starts = np.arange(cols.runs())
+
+        frame = cols.local_frame(np.arange(len(cols)))
+        return SpatialIndex(grid, cell_offsets,
+            cols.x[order], cols.y[order], cols.run[order].astype(np.int32),
+            frame[order].astype(np.int32), flags[order], np.asarray(run_starts, dtype=np.int64))
+
+    def _tile_range(self, xmin, xmax, ymin, ymax):
+        g = self.grid
+        tx0 = max(int(np.floor(xmin/g.tile)) - g.x0, 0)
+        tx1 = min(int(np.floor(xmax/g.tile)) - g.x0, g.width-1)
+        ty0 = max(int(np.floor(ymin/g.tile)) - g.y0, 0)
+        ty1 = min(int(np.floor(ymax/g.tile)) - g.y0, g.height-1)
+        return tx0, tx1, ty0, ty1
+
+    def _candidates(self, xmin, xmax, ymin, ymax):
+        tx0, tx1, ty0, ty1 = self._tile_range(xmin, xmax, ymin, ymax)
+        if tx0 > tx1 or ty0 > ty1:
+            return np.zeros(0, dtype=np.int64)
+        width = self.grid.width
+        rows = np.arange(ty0, ty1+1)*width
+        lo = self.cell_offsets[rows+tx0]
+        hi = self.cell_offsets[rows+tx1+1]
+        #one contiguous slice of postings per tile row
+        lengths = hi-lo
+        total = lengths.sum()
+        if total == 0:
+            return np.zeros(0, dtype=np.int64)
+        base = np.repeat(lo - np.cumsum(lengths) + lengths, lengths)
+        return base + np.arange(total)
+
+    def _select(self, idx, flags):
+        if flags:
+            idx = idx[(self.flags[idx] & flags) != 0]
+        return Hits(self, idx)
+
+    def rect(self, xmin, xmax, ymin, ymax, flags=0):
+        """
+        Postings inside the rectangle. flags=DEATH or SPAWN restricts to
+        deaths or run starts.
+        """
+        idx = self._candidates(xmin, xmax, ymin, ymax)
+        x = self.x[idx]
+        y = self.y[idx]
+        idx = idx[(x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)]
+        return self._select(idx, flags)
+
+    def radius(self, cx, cy, r, flags=0):
+        idx = self._candidates(cx-r, cx+r, cy-r, cy+r)
+        dx = self.x[idx]-cx
+        dy = self.y[idx]-cy
+        idx = idx[dx*dx+dy*dy <= r*r]
+        return self._select(idx, flags)
+
+    def point(self, x, y, flags=0):
+        """
+        Postings in the tile containing (x, y)
+        """
+        idx = self._candidates(x, x, y, y)
+        return self._select(idx, flags)
+
+    def tile_counts(self, flags=0):
+        """
+        (height, width) postings per tile, e.g. flags=DEATH for where deaths
+        cluster
+        """
+        counts = np.diff(self.cell_offsets)
+        if flags:
+            cells = np.repeat(np.arange(self.grid.tiles()), counts)
+            counts = np.bincount(cells[(self.flags & flags) != 0], minlength=self.grid.tiles())
+        return counts.reshape(self.grid.height, self.grid.width)
+
+    def to_arrays(self, prefix=''):
+        return {
+            f'{prefix}grid': self.grid.to_array(),
+            f'{prefix}cell_offsets': self.cell_offsets,
+            f'{prefix}x': self.x,
+            f'{prefix}y': self.y,
+            f'{prefix}run': self.run,
+            f'{prefix}frame': self.frame,
+            f'{prefix}flags': self.flags,
+            f'{prefix}run_starts': self.run_starts,
+            }
+
+    @staticmethod
+    def from_arrays(data, prefix=''):
+        return SpatialIndex(Grid.from_array(data[f'{prefix}grid']),
+            *[data[f'{prefix}{x}'] for x in ['cell_offsets', 'x', 'y', 'run', 'frame', 'flags', 'run_starts']])
+
+def spatial_file(roomset):
+    return os.path.splitext(roomset.infile)[0]+'_spatial.npz'
+
+def room_spatial(roomset, room_name):
+    """
+    Spatial index of a room in one capture, cached in <capture>_spatial.npz
+    next to the index.
+    """
+    def build():
+        runs = []
+        for room in roomset.get_room(room_name):
+            runs.extend(room.runs)
+        cols = Columns.from_runs(runs)
+        return SpatialIndex.build(cols, [x.msgs[0].file_start_idx for x in runs], [x.dead for x in runs])
+
+    return room_cache(spatial_file(roomset), roomset.infile, room_name, 'grid', SpatialIndex.from_arrays, build)
+
+if __name__ == '__main__':
+    from decode import RoomSet
+
+    roomset = RoomSet(sys.argv[1])
+    room_name = sys.argv[2]
+    x, y, r = [float(v) for v in sys.argv[3:6]]
+
+    index = room_spatial(roomset, room_name)
+    hits = index.radius(x, y, r)
+    deaths = index.radius(x, y, r, DEATH)
+    print(f'{len(hits.runs())} runs passed within {r} of ({x}, {y}), {len(deaths)} deaths there')
@@ -0,0 +1,247 @@
+"""
+Export captures to a SQLite database for SQL over sessions, rooms, runs and
+frames.
+
+    sessions    one row per capture file
+    rooms       room names
+    runs        the index run table of each capture, see decode.RUN_FIELDS
+    frames      every state of every run, state and status as bitmasks
+    state_names, status_names   bit -> name for the masks, e.g.
+                frames.state & (1 << state_names.bit) != 0
+
+Frames are loaded room segment by room segment through decode, so memory stays
+bounded, and written with executemany in batches of BATCH rows inside one
+transaction per capture. Secondary indexes are dropped before a load and built
+again afterwards, which is much faster than keeping them up to date row by row.
+Captures already in the database are skipped unless they changed since (or
+--force), so new captures can be appended to the same file. A capture and the
+.datz compressed from it are one session: only the .dat is loaded when both are
+given, and loading either replaces a session loaded from the other.
+
+    sqlexport.py <database> <data file | directory> [...] [--force]
+"""
+import sys
+import os
+import time
+import sqlite3
+import argparse
+
+from columns import Columns
+from model import idx_to_state, idx_to_status
+
+BATCH = 50000
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS sessions (
+        id INTEGER PRIMARY KEY,
+        capture TEXT UNIQUE,
+        mtime REAL,
+        size INTEGER,
+        start_stamp REAL,
+        end_stamp REAL,
+        runs INTEGER,
+        frames INTEGER,
+        loaded REAL)''',
+    '''CREATE TABLE IF NOT EXISTS rooms (
+        id INTEGER PRIMARY KEY,
+        name TEXT UNIQUE)''',
+    '''CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY,
+        session_id INTEGER,
+        room_id INTEGER,
+        start INTEGER,
+        end INTEGER,
+        start_stamp REAL,
+        end_stamp REAL,
+        dead INTEGER,
+        nocontrol INTEGER,
+        savestate INTEGER,
+        msgs INTEGER,
+        frames INTEGER,
+        xmin REAL,
+        xmax REAL,
+        ymin REAL,
+        ymax REAL,
+        states INTEGER)''',
+    '''CREATE TABLE IF NOT EXISTS frames (
+        run_id INTEGER,
+        stamp REAL,
+        frame INTEGER,
+        x REAL,
+        y REAL,
+        sx REAL,
+        sy REAL,
+        state INTEGER,
+        status INTEGER,
+        wall INTEGER)''',
+    'CREATE TABLE IF NOT EXISTS state_names (bit INTEGER PRIMARY KEY, name TEXT)',
+    'CREATE TABLE IF NOT EXISTS status_names (bit INTEGER PRIMARY KEY, name TEXT)',
+    ]
+
+INDEXES = {
+    'runs_session': 'runs (session_id)',
+    'runs_room': 'runs (room_id)',
+    'runs_stamp': 'runs (start_stamp)',
+    'frames_run': 'frames (run_id)',
+    'frames_stamp': 'frames (stamp)',
+    }
+
+RUN_COLUMNS = ['start', 'end', 'start_stamp', 'end_stamp', 'dead', 'nocontrol', 'savestate',
+    'msgs', 'frames', 'xmin', 'xmax', 'ymin', 'ymax', 'states']
+
+def connect(filename):
+    db = sqlite3.connect(filename)
+    for statement in SCHEMA:
+        db.execute(statement)
+    db.executemany('INSERT OR REPLACE INTO state_names VALUES (?, ?)', idx_to_state.items())
+    db.executemany('INSERT OR REPLACE INTO status_names VALUES (?, ?)', idx_to_status.items())
+    db.commit()
+    return db
+
+def drop_indexes(db):
+    for name in INDEXES:
+        db.execute(f'DROP INDEX IF EXISTS {name}')
+
+def create_indexes(db):
+    for name, target in INDEXES.items():
+        db.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {target}')
+    db.commit()
+
+def room_id(db, name, cache):
+    if name not in cache:
+        db.execute('INSERT OR IGNORE INTO rooms (name) VALUES (?)', (name,))
+        cache[name] = db.execute('SELECT id FROM rooms WHERE name = ?', (name,)).fetchone()[0]
+    return cache[name]
+
+def batches(rows, size=BATCH):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+def frame_rows(cols, run_ids):
+    run = [run_ids[x] for x in cols.run.tolist()]
+    return zip(run, cols.stamp.tolist(), cols.frame.tolist(), cols.x.tolist(), cols.y.tolist(),
+        cols.sx.tolist(), cols.sy.tolist(), cols.state.tolist(), cols.status.tolist(), cols.wall.tolist())
+
+def session_state(db, capture):
+    """
+    (id, mtime, size, capture) of every session loaded from capture or from
+    the other of its .dat and .datz
+    """
+    import blocks
+
+    base = os.path.splitext(capture)[0]
+    names = {capture, base+'.dat', base+blocks.EXTENSION}
+    return db.execute(f'SELECT id, mtime, size, capture FROM sessions WHERE capture IN ({", ".join("?"*len(names))})',
+        sorted(names)).fetchall()
+
+def delete_session(db, session):
+    db.execute('DELETE FROM frames WHERE run_id IN (SELECT id FROM runs WHERE session_id = ?)', (session,))
+    db.execute('DELETE FROM runs WHERE session_id = ?', (session,))
+    db.execute('DELETE FROM sessions WHERE id = ?', (session,))
+
+def load_capture(db, infile, rooms_cache):
+    """
+    Insert one capture. Runs come from the index run table, frames are
+    decoded one room segment at a time in file order.
+    """
+    from decode import RoomSet, read_file, extract_rooms
+
+    roomset = RoomSet(infile)
+    table = roomset.runs
+    count = len(table['room'])
+    capture = os.path.abspath(infile)
+    stat = os.stat(infile)
+
+    cursor = db.execute('INSERT INTO sessions (capture, mtime, size, start_stamp, end_stamp, runs, frames, loaded) '
+        + 'VALUES (?, ?, ?, ?, ?, ?, 0, ?)',
+        (capture, stat.st_mtime, stat.st_size, min(table['start_stamp'], default=None),
+            max(table['end_stamp'], default=None), count, time.time()))
+    session = cursor.lastrowid
+
+    base = db.execute('SELECT COALESCE(MAX(id), 0)+1 FROM runs').fetchone()[0]
+    run_ids = {start: base+idx for idx, start in enumerate(table['start'])}
+    rows = ((base+idx, session, room_id(db, table['room'][idx], rooms_cache), *[table[k][idx] for k in RUN_COLUMNS])
+        for idx in range(count))
+    db.executemany(f'INSERT INTO runs (id, session_id, room_id, {", ".join(RUN_COLUMNS)}) '
+        + f'VALUES ({", ".join("?"*(len(RUN_COLUMNS)+3))})', rows)
+
+    segments = sorted((x['start'], x['end']) for entries in roomset.index.values() for x in entries)
+    frames = 0
+    for start, end in segments:
+        runs = [x for room in extract_rooms(read_file(infile, start, end)) for x in room.runs]
+        runs = [x for x in runs if x.msgs[0].file_start_idx in run_ids]
+        if len(runs) == 0:
+            continue
+        cols = Columns.from_runs(runs)
+        ids = [run_ids[x.msgs[0].file_start_idx] for x in runs]
+        for batch in batches(frame_rows(cols, ids)):
+            db.executemany('INSERT INTO frames VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', batch)
+        frames += len(cols)
+
+    db.execute('UPDATE sessions SET frames = ? WHERE id = ?', (frames, session))
+    return count, frames
+
+def export(filename, captures, force=False):
+    """
+    Load captures into the database, skipping ones that are already there
+    and unchanged
+    """
+    from translate import unique_captures
+
+    db = connect(filename)
+    captures = unique_captures(captures)
+    todo = []
+    for infile in captures:
+        capture = os.path.abspath(infile)
+        known = session_state(db, capture)
+        stat = os.stat(infile)
+        #a session from the other of .dat and .datz is replaced
+        if (not force and len(known) == 1 and known[0][3] == capture
+                and known[0][1] == stat.st_mtime and known[0][2] == stat.st_size):
+            continue
+        todo.append((infile, known))
+    print(f'{len(captures)} captures, {len(captures)-len(todo)} already loaded, {len(todo)} to load')
+    if len(todo) == 0:
+        create_indexes(db)
+        return
+
+    db.execute('PRAGMA synchronous = OFF')
+    #changed captures are removed while the run index still speeds that up
+    with db:
+        for infile, known in todo:
+            for session in known:
+                delete_session(db, session[0])
+    drop_indexes(db)
+    rooms_cache = {}
+    start_time = time.perf_counter()
+    total = 0
+    for infile, known in todo:
+        with db:
+            runs, frames = load_capture(db, infile, rooms_cache)
+        total += frames
+        print(f'{infile}: {runs} runs, {frames} frames')
+    print('Creating indexes...')
+    create_indexes(db)
+    elapsed = time.perf_counter()-start_time
+    print(f'{total} frames in {elapsed:.1f} s ({total/max(elapsed, 1e-9):.0f} frames/s)')
+    db.close()
+
+def main(argv):
+    from translate import find_captures
+
+    parser = argparse.ArgumentParser(description='Export captures to a SQLite database.')
+    parser.add_argument('database')
+    parser.add_argument('paths', nargs='+', help='captures, or directories to search for them')
+    parser.add_argument('--force', action='store_true', help='reload captures that are already in the database')
+    args = parser.parse_args(argv[1:])
+
+    export(args.database, find_captures(args.paths), args.force)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,186 @@
+"""
+Attempt statistics per room, per session and over time.
+
+Everything here works from the run summary table in the capture index, never
+from the capture itself. Each capture is one session. Its per room rows are
+computed once and kept in the index under 'stats'; a history file collects the
+rows of many captures and only reads the index of captures that are new or whose
+index changed since they were added, so aggregating months of play reads nothing
+but summary rows.
+
+    stats.py <history.json> <data file> [data file ...]
+"""
+import sys
+import os
+import json
+from statistics import median
+
+#bump when the row layout changes so cached rows get recomputed
+STATS_VERSION = 1
+
+def outcome(runs, idx):
+    """
+    'death', 'clear' (left the room in control) or 'other' (lost control,
+    e.g. a cutscene or transition, or cut short by a savestate load)
+    """
+    if runs['dead'][idx]:
+        return 'death'
+    if runs['nocontrol'][idx] or runs['savestate'][idx]:
+        return 'other'
+    return 'clear'
+
+def new_row():
+    return {
+        'attempts': 0,
+        'deaths': 0,
+        'clears': 0,
+        'clear_frames': [],
+        'first_clear': None,
+        'frames': 0,
+        'start_stamp': None,
+        'end_stamp': None,
+        }
+
+def session_rows(runs):
+    """
+    Per room rows from an index run table. first_clear is the number of
+    attempts up to and including the first clear of the session.
+    """
+    rows = {}
+    for idx, room in enumerate(runs['room']):
+        row = rows.get(room, None)
+        if row is None:
+            row = rows[room] = new_row()
+        row['attempts'] += 1
+        row['frames'] += runs['frames'][idx]
+        result = outcome(runs, idx)
+        if result == 'death':
+            row['deaths'] += 1
+        elif result == 'clear':
+            row['clears'] += 1
+            row['clear_frames'].append(runs['frames'][idx])
+            if row['first_clear'] is None:
+                row['first_clear'] = row['attempts']
+        if row['start_stamp'] is None:
+            row['start_stamp'] = runs['start_stamp'][idx]
+        row['end_stamp'] = runs['end_stamp'][idx]
+    return rows
+
+def merge(rows):
+    """
+    Combine rows of one room in time order
+    """
+    total = new_row()
+    for row in rows:
+        if total['first_clear'] is None and row['first_clear'] is not None:
+            total['first_clear'] = total['attempts'] + row['first_clear']
+        for key in ['attempts', 'deaths', 'clears', 'frames']:
+            total[key] += row[key]
+        total['clear_frames'].extend(row['clear_frames'])
+        if total['start_stamp'] is None:
+            total['start_stamp'] = row['start_stamp']
+        total['end_stamp'] = row['end_stamp']
+    return total
+
+def describe(row):
+    """
+    Derived figures for a row
+    """
+    clears = row['clear_frames']
+    return {
+        'attempts': row['attempts'],
+        'deaths': row['deaths'],
+        'clears': row['clears'],
+        'death_rate': row['deaths']/row['attempts'] if row['attempts'] > 0 else 0,
+        'best': min(clears) if len(clears) > 0 else None,
+        'median': median(clears) if len(clears) > 0 else None,
+        'first_clear': row['first_clear'],
+        'frames': row['frames'],
+        }
+
+def format_row(name, row):
+    info = describe(row)
+    line = f'{name}: {info["attempts"]} runs, {info["deaths"]} deaths ({info["death_rate"]:.0%}), {info["clears"]} clears'
+    if info['best'] is not None:
+        line += f', best {info["best"]} frames, median {info["median"]} frames, first clear on attempt {info["first_clear"]}'
+    return line
+
+def index_section(runs):
+    return {'version': STATS_VERSION, 'rooms': session_rows(runs)}
+
+def room_stats(roomset):
+    """
+    Per room rows of one capture, cached in the capture index. New indices get
+    them when they are generated.
+    """
+    cache = roomset.extra.get('stats', None)
+    if cache is None or cache.get('version', None) != STATS_VERSION:
+        cache = roomset.extra['stats'] = index_section(roomset.runs)
+        roomset.save_index()
+    return cache['rooms']
+
+class History():
+    """
+    Per session rows of many captures, keyed by capture path and invalidated by
+    the modification time of the capture index.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.sessions = {}
+        if os.path.exists(filename):
+            with open(filename, 'r') as fp:
+                data = json.load(fp)
+            if data.get('version', None) == STATS_VERSION:
+                self.sessions = data['sessions']
+
+    def save(self):
+        with open(self.filename, 'w') as fp:
+            json.dump({'version': STATS_VERSION, 'sessions': self.sessions}, fp)
+
+    def add(self, infile):
+        """
+        Returns False if the capture is already up to date
+        """
+        from decode import RoomSet
+
+        key = os.path.abspath(infile)
+        idxfile = os.path.splitext(infile)[0]+'_index.json'
+        entry = self.sessions.get(key, None)
+        if entry is not None and os.path.exists(idxfile) and entry['mtime'] >= os.path.getmtime(idxfile):
+            return False
+
+        rows = room_stats(RoomSet(infile))
+        stamps = [x['start_stamp'] for x in rows.values()]
+        self.sessions[key] = {
+            'mtime': os.path.getmtime(idxfile),
+            'start_stamp': min(stamps) if len(stamps) > 0 else 0,
+            'rooms': rows,
+            }
+        return True
+
+    def ordered(self):
+        return sorted(self.sessions.items(), key=lambda x: x[1]['start_stamp'])
+
+    def timeline(self, room_name):
+        """
+        (capture, row) of every session that visited the room, oldest first
+        """
+        return [(k, v['rooms'][room_name]) for k, v in self.ordered() if room_name in v['rooms']]
+
+    def rooms(self):
+        """
+        Rows merged over every session
+        """
+        grouped = {}
+        for _, session in self.ordered():
+            for name, row in session['rooms'].items():
+                grouped.setdefault(name, []).append(row)
+        return {k: merge(v) for k, v in grouped.items()}
+
+if __name__ == '__main__':
+    history = History(sys.argv[1])
+    added = sum(history.add(x) for x in sys.argv[2:])
+    history.save()
+    print(f'{added} captures added, {len(history.sessions)} sessions')
+    for name, row in history.rooms().items():
+        print(format_row(name, row))
@@ -0,0 +1,266 @@
+"""
+Rule based tech detection over columnar run data.
+
+Rules are declared once from a small expression language (fields, states,
+statuses, comparisons, onsets, shifts) and compiled into boolean masks over every
+frame at once. Subexpressions shared between rules are only evaluated once per
+set of columns.
+
+A rule fires at every frame where its start condition holds. If it has a then
+condition, it only matches if that holds within the given number of frames
+afterwards in the same run, and the match spans from start to the first such
+frame.
+"""
+import sys
+
+import numpy as np
+
+from columns import Columns
+from model import state_to_idx, status_to_idx
+
+#bump when RULES change so cached counts in the index get recomputed
+TECH_VERSION = 1
+
+class Expr():
+    def __init__(self, key, func):
+        self.key = key
+        self.func = func
+
+    def _binary(self, other, op, func):
+        if isinstance(other, Expr):
+            return type(self)(f'({self.key}{op}{other.key})', lambda c: func(c.eval(self), c.eval(other)))
+        return type(self)(f'({self.key}{op}{other!r})', lambda c: func(c.eval(self), other))
+
+    def _compare(self, other, op, func):
+        result = self._binary(other, op, func)
+        return Cond(result.key, result.func)
+
+    def __add__(self, other): return self._binary(other, '+', np.add)
+    def __sub__(self, other): return self._binary(other, '-', np.subtract)
+    def __mul__(self, other): return self._binary(other, '*', np.multiply)
+    def __gt__(self, other): return self._compare(other, '>', np.greater)
+    def __ge__(self, other): return self._compare(other, '>=', np.greater_equal)
+    def __lt__(self, other): return self._compare(other, '<', np.less)
+    def __le__(self, other): return self._compare(other, '<=', np.less_equal)
+
+    def eq(self, other): return self._compare(other, '==', np.equal)
+    def ne(self, other): return self._compare(other, '!=', np.not_equal)
+
+    def abs(self):
+        return type(self)(f'abs({self.key})', lambda c: np.abs(c.eval(self)))
+
+    def prev(self):
+        """
+        Value on the previous frame of the same run. The first frame of a run
+        sees its own value.
+        """
+        return self.shift(1)
+
+    def shift(self, n):
+        """
+        Value n frames earlier (n > 0) or later (n < 0) in the same run. Frames
+        that would read across a run boundary see their own value.
+        """
+        def func(c):
+            values = c.eval(self)
+            if n == 0 or len(values) == 0:
+                return values
+            idx = np.arange(len(values)) - n
+            np.clip(idx, 0, len(values)-1, out=idx)
+            ok = c.cols.run[idx] == c.cols.run
+            return np.where(ok, values[idx], values)
+        return type(self)(f'shift({self.key},{n})', func)
+
+class Cond(Expr):
+    def __and__(self, other):
+        return Cond(f'({self.key}&{other.key})', lambda c: c.eval(self) & c.eval(other))
+
+    def __or__(self, other):
+        return Cond(f'({self.key}|{other.key})', lambda c: c.eval(self) | c.eval(other))
+
+    def __invert__(self):
+        return Cond(f'~{self.key}', lambda c: ~c.eval(self))
+
+    def onset(self):
+        """
+        True where the condition holds and did not hold on the previous frame,
+        including the first frame of a run.
+        """
+        def func(c):
+            values = c.eval(self)
+            result = values.copy()
+            result[1:] &= ~values[:-1]
+            result |= values & c.cols.run_start
+            return result
+        return Cond(f'onset({self.key})', func)
+
+    def ahead(self, n):
+        return self.shift(-n)
+
+    def shift(self, n):
+        result = Expr.shift(self, n)
+        return Cond(result.key, result.func)
+
+def field(name):
+    return Expr(name, lambda c: c.cols.get(name))
+
+def flag(name):
+    """
+    Optional boolean column from Columns.extra, all False if it wasn't captured
+    """
+    def func(c):
+        if name in c.cols.extra:
+            return c.cols.extra[name].astype(bool)
+        return np.zeros(len(c.cols), dtype=bool)
+    return Cond(f'flag({name})', func)
+
+def state(name):
+    bit = np.uint32(1<<state_to_idx[name])
+    return Cond(f'state({name})', lambda c: (c.cols.state & bit) != 0)
+
+def status(name):
+    bit = np.uint32(1<<status_to_idx[name])
+    return Cond(f'status({name})', lambda c: (c.cols.status & bit) != 0)
+
+class Compiler():
+    def __init__(self, cols):
+        self.cols = cols
+        self.cache = {}
+
+    def eval(self, expr):
+        if not expr.key in self.cache:
+            self.cache[expr.key] = expr.func(self)
+        return self.cache[expr.key]
+
+class Rule():
+    def __init__(self, name, start, then=None, within=0):
+        self.name = name
+        self.start = start
+        self.then = then
+        self.within = within
+
+    def match(self, compiler):
+        """
+        Global (start, end) frame indices of every match
+        """
+        cols = compiler.cols
+        starts = np.flatnonzero(compiler.eval(self.start))
+        if self.then is None:
+            return starts, starts.copy()
+
+        follows = np.flatnonzero(compiler.eval(self.then))
+        if len(follows) == 0 or len(starts) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty
+
+        nxt = np.searchsorted(follows, starts, side='left')
+        ok = nxt < len(follows)
+        starts = starts[ok]
+        ends = follows[nxt[ok]]
+        ok = (ends - starts <= self.within) & (cols.run[ends] == cols.run[starts])
+        return starts[ok], ends[ok]
+
+    def __repr__(self):
+        return f'Rule({self.name})'
+
+#celeste speeds, px/s
+DASH_SPEED = 240
+HYPER_SPEED = 260
+
+sx = field('sx')
+sy = field('sy')
+
+dash_start = state('StDash').onset()
+#speed is only set a frame or two after the dash state begins
+down_diagonal = ((sy < 0) & (sx.abs() > 0)).ahead(2)
+horizontal = (sy.eq(0) & (sx.abs() > 0)).ahead(2)
+grounded = status('Coyote')
+jump = status('Jump').onset()
+landing = sy.eq(0) & (sy.prev() < 0)
+
+RULES = [
+    Rule('hyper', dash_start & down_diagonal & grounded,
+        then = jump & (sx.abs() >= HYPER_SPEED), within = 15),
+    Rule('wavedash', dash_start & down_diagonal & ~grounded,
+        then = jump & (sx.abs() >= HYPER_SPEED), within = 20),
+    Rule('super', dash_start & horizontal & grounded,
+        then = jump, within = 15),
+    Rule('ultra', dash_start & down_diagonal,
+        then = landing & (sx.abs() >= sx.abs().prev()*1.15), within = 20),
+    #ducking is not part of the CelesteTAS status text, so this only fires
+    #when a ducking column is supplied from recorded inputs
+    Rule('demo', dash_start & flag('ducking')),
+    ]
+
+class Detections():
+    def __init__(self, cols, names, kind, starts, ends):
+        self.cols = cols
+        self.names = names
+        self.kind = kind
+        self.start = starts
+        self.end = ends
+        self.run = cols.run[starts] if len(starts) > 0 else np.zeros(0, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.kind)
+
+    def counts(self):
+        totals = np.bincount(self.kind, minlength=len(self.names))
+        return {name: int(totals[idx]) for idx, name in enumerate(self.names)}
+
+    def labels(self):
+        """
+        Per run list of (tech, first frame, last frame), frames counted from the
+        start of the run.
+        """
+        result = [[] for _ in range(self.cols.runs())]
+        starts = self.cols.local_frame(self.start)
+        ends = self.cols.local_frame(self.end)
+        for idx in np.argsort(self.start, kind='stable'):
+            result[self.run[idx]].append((self.names[self.kind[idx]], int(starts[idx]), int(ends[idx])))
+        return result
+
+def detect(cols, rules=None):
+    if rules is None:
+        rules = RULES
+    compiler = Compiler(cols)
+
+    kinds = []
+    starts = []
+    ends = []
+    for idx, rule in enumerate(rules):
+        start, end = rule.match(compiler)
+        kinds.append(np.full(len(start), idx, dtype=np.int32))
+        starts.append(start)
+        ends.append(end)
+
+    return Detections(cols, [x.name for x in rules],
+        np.concatenate(kinds), np.concatenate(starts).astype(np.int64), np.concatenate(ends).astype(np.int64))
+
+def room_counts(roomset, room_name):
+    """
+    Tech counts for a room, cached in the capture index.
+    """
+    cache = roomset.extra.get('tech', None)
+    if cache is None or cache.get('version', None) != TECH_VERSION:
+        cache = roomset.extra['tech'] = {'version': TECH_VERSION, 'rooms': {}}
+
+    if not room_name in cache['rooms']:
+        cols = Columns.from_rooms(roomset.get_room(room_name))
+        cache['rooms'][room_name] = detect(cols).counts()
+        roomset.save_index()
+
+    return cache['rooms'][room_name]
+
+if __name__ == '__main__':
+    from decode import RoomSet
+
+    roomset = RoomSet(sys.argv[1])
+    names = sys.argv[2:]
+    if len(names) == 0:
+        names = list(roomset.index.keys())
+
+    for name in names:
+        counts = room_counts(roomset, name)
+        found = ', '.join(f'{k}: {v}' for k,v in counts.items() if v > 0)
+        print(f'{name}: {found}')
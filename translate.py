@@ -7,26 +7,42 @@ import re
 import itertools
 import json
 import os
+import io
+import argparse
 from collections import defaultdict
 
-import clr
-import System
+from model import MessageId, state_to_idx, Status, Symbols, room_symbols, token_symbols
+import blocks
+import party
+import profiling
+import scan
 
-from System.Runtime.Serialization.Formatters.Binary import BinaryFormatter
-from System.Runtime.Serialization import SerializationException
-from System.IO import MemoryStream
+#the .NET runtime takes a while to start, so it is only loaded once something
+#actually needs to be deserialized
+serializer = None
+SerializationException = None
+MemoryStream = None
 
-serializer = BinaryFormatter()
+def load_runtime():
+    global serializer, SerializationException, MemoryStream
+    if serializer is not None:
+        return
 
-from model import MessageId, state_to_idx, Status
-from party import GameState
+    import clr
+    import System
+
+    from System.Runtime.Serialization.Formatters.Binary import BinaryFormatter
+    from System.Runtime.Serialization import SerializationException
+    from System.IO import MemoryStream
+
+    serializer = BinaryFormatter()
 
 
 class IgnoreMessage(Exception):
     pass
 
 class Message():
-    def __init__(self, fp):
+    def __init__(self, fp, decode=True):
         self.file_start_idx = fp.tell()
 
         self.stamp_raw = fp.read(8)
@@ -50,6 +66,10 @@ class Message():
 
         self.file_end_idx = fp.tell()-1
 
+        if decode:
+            self.decode_all()
+
+    def decode_all(self):
         self.decode()
 
         try:
@@ -82,15 +102,15 @@ class Message():
             parts = line.split()
             stam = parts[1]
             self.stamina = float(stam)
-            self.state = []
+            self.states = []
             self.wall = None
             for state in parts[2:]:
                 if 'St' in state:
                     if state == 'StIntroRespawn':
                         self.dead = True
-                    self.state.append(state)
+                    self.states.append(token_symbols.intern(state))
                 elif 'Wall' in state:
-                    self.wall = state
+                    self.wall = token_symbols.intern(state)
                 else:
                     print(f'Unhandled state: {state}')
         elif line.startswith('LiftBoost'):
@@ -123,7 +143,7 @@ class Message():
 
 
         if not self.game_info.startswith('Pos'):
-            self.room = self.game_info
+            self.room = room_symbols.intern(self.game_info)
             return
 
         lines = [x.strip() for x in self.game_info.split('\n')]
@@ -146,12 +166,12 @@ class Message():
         try:
             #TODO: handle truncated lines
             room, _, time = lines[-1].split()
-            self.room = room[1:-1]
+            self.room = room_symbols.intern(room[1:-1])
             _, frame = time.split('(')
             frame = frame.split(')')[0]
             self.frame = int(frame)
         except:
-            self.room = lines[-1].split(']')[0][1:]
+            self.room = room_symbols.intern(lines[-1].split(']')[0][1:])
             self.frame = -1
             print(lines[-1])
 
@@ -173,7 +193,7 @@ class Message():
             return [0,0,0]
         return [1, self.retain_frame, self.retain_value]
 
-    def serialize(self):
+    def serialize(self, rooms=None):
         """
         boilerplate
         4i length
@@ -222,6 +242,9 @@ class Message():
 
         null terminated: room name
         =?
+        or with rooms, the model.Symbols of the file's room table
+            2i room id
+        =2
 
         """
         fmt = ( '=Id' #length and stamp
@@ -236,7 +259,10 @@ class Message():
 
         fmt += statefmt
         fmt += statusfmt
-        fmt += f'{len(self.room)+1}s'
+        if rooms is None:
+            fmt += f'{len(self.room)+1}s'
+        else:
+            fmt += 'H'
 
         length = struct.calcsize(fmt)-4
 
@@ -255,58 +281,176 @@ class Message():
         for status in self.statuses:
             data.extend(status.serialize())
 
-        data.append(self.room.encode('ascii'))
+        if rooms is None:
+            data.append(self.room.encode('ascii'))
+        else:
+            data.append(rooms.id(self.room))
 
         result = struct.pack(fmt, *data)
 
         return result
 
-if __name__ == '__main__':
-
-    msgs = []
-    start_time = time.time()
-    infile = sys.argv[1]
-    with open(infile, 'rb') as fp:
-        idx = 0
-        bad = 0
-        weird = 0
-        while True:
-            try:
-                msg= Message(fp)
-                msgs.append(msg)
-                idx += 1
-                if idx%1000 ==0:
-                    print(idx)
-            except RuntimeError:
-                break
-            except IgnoreMessage:
-                weird += 1
-            except SerializationException:
-                bad +=1
-
-
-    print(f'{len(msgs)} messages processed. {bad} bad messages ignored. {weird} inscrutable messages ignored.')
-    mid_time = time.time()
-    print(f'msgs loaded in {mid_time-start_time:.2f} s')
-
-    outfile = os.path.splitext(infile)[0]+'.bin'
-
-    with open(outfile, 'wb') as fp:
-        for msg in msgs:
-            fp.write(msg.serialize())
-
-
-    start_time = time.time()
-    game_states = []
-    with open(outfile, 'rb') as fp:
-        while True:
+def bin_file(infile):
+    return os.path.splitext(infile)[0]+'.bin'
+
+def manifest_file(infile):
+    return os.path.splitext(infile)[0]+'_manifest.json'
+
+def up_to_date(infile):
+    outfile = bin_file(infile)
+    return os.path.exists(outfile) and os.path.getmtime(outfile) >= os.path.getmtime(infile)
+
+def translate_file(infile, quiet=False):
+    """
+    Convert one capture to .bin, writing each record as soon as it is decoded
+    instead of collecting them first. The output is written under a temporary
+    name and moved into place at the end, so an interrupted run never leaves a
+    partial .bin that looks up to date. Returns the manifest, which is also
+    written next to the capture.
+    """
+    load_runtime()
+    start_time = time.perf_counter()
+    outfile = bin_file(infile)
+    tmpfile = outfile+'.tmp'
+
+    with profiling.stage('read') as st:
+        raw = blocks.read_capture(infile)
+        st.count(nbytes=len(raw))
+
+    records = 0
+    written = 0
+    bad = 0
+    weird = 0
+    rooms = Symbols()
+    scanner = scan.Scanner(raw)
+    #framing, decoding and serializing are interleaved, so they are timed as one
+    with profiling.stage('decode') as st:
+        src = io.BytesIO(raw)
+        with open(tmpfile, 'wb') as fp:
+            for offset, end in scanner.records():
+                src.seek(offset)
+                msg = Message(src, decode=False)
+                records += 1
+                if not quiet and records%1000 == 0:
+                    print(records)
+                try:
+                    msg.decode_all()
+                except IgnoreMessage:
+                    weird += 1
+                    continue
+                except SerializationException:
+                    bad += 1
+                    continue
+                fp.write(msg.serialize(rooms))
+                written += 1
+            party.write_room_table(fp, rooms)
+            nbytes = fp.tell()
+        st.count(records=records, nbytes=len(raw))
+    os.replace(tmpfile, outfile)
+
+    elapsed = time.perf_counter()-start_time
+    manifest = {
+        'capture': infile,
+        'output': outfile,
+        'capture_bytes': len(raw),
+        'output_bytes': nbytes,
+        'records': records,
+        'written': written,
+        'bad': bad,
+        'inscrutable': weird,
+        'skipped': scanner.skipped,
+        'truncated': scanner.truncated,
+        'seconds': elapsed,
+        'records_per_second': records/elapsed if elapsed > 0 else 0,
+        'mb_per_second': len(raw)/elapsed/1e6 if elapsed > 0 else 0,
+        }
+    with open(manifest_file(infile), 'w') as fp:
+        json.dump(manifest, fp, indent=1)
+
+    if not quiet:
+        for line in scanner.report(f'{infile}: '):
+            print(line)
+    return manifest
+
+def find_captures(paths):
+    """
+    Capture files named directly or found anywhere under the given directories
+    """
+    result = []
+    for path in paths:
+        if not os.path.isdir(path):
+            result.append(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if os.path.splitext(name)[1] in {'.dat', blocks.EXTENSION}:
+                    result.append(os.path.join(root, name))
+    return unique_captures(result)
+
+def unique_captures(captures):
+    """
+    One capture per base name, since x.dat and the x.datz compressed from it
+    would both be written to x.bin. The .dat is kept.
+    """
+    chosen = {}
+    for capture in captures:
+        base, ext = os.path.splitext(capture)
+        if base not in chosen or ext == '.dat':
+            chosen[base] = capture
+    return list(chosen.values())
+
+def describe(manifest):
+    return (f'{manifest["capture"]}: {manifest["written"]} messages written, {manifest["bad"]} bad, '
+        + f'{manifest["inscrutable"]} inscrutable, {manifest["seconds"]:.1f} s '
+        + f'({manifest["records_per_second"]:.0f} rec/s, {manifest["mb_per_second"]:.2f} MB/s)')
+
+def translate_batch(paths, jobs=None, force=False):
+    """
+    Translate every capture that is out of date across a process pool. Each
+    worker starts the .NET runtime once and keeps it for its later files.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    captures = find_captures(paths)
+    todo = [x for x in captures if force or not up_to_date(x)]
+    print(f'{len(captures)} captures, {len(captures)-len(todo)} up to date, {len(todo)} to translate')
+
+    manifests = []
+    failed = 0
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(translate_file, x, True): x for x in todo}
+        for future in as_completed(futures):
             try:
-                gs = GameState()
-                gs.read(fp)
-                game_states.append(gs)
-            except RuntimeError:
-                break
-    end_time = time.time()
-    print(f'{len(game_states)} game states loaded in {end_time-start_time:.2f} s')
-
+                manifest = future.result()
+            except Exception as e:
+                failed += 1
+                print(f'{futures[future]}: failed, {e!r}')
+                continue
+            manifests.append(manifest)
+            print(describe(manifest))
+
+    elapsed = time.perf_counter()-start_time
+    total = sum(x['capture_bytes'] for x in manifests)
+    print(f'{len(manifests)} captures translated, {failed} failed, in {elapsed:.1f} s ({total/max(elapsed, 1e-9)/1e6:.2f} MB/s)')
+    return manifests
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Convert captures to the compact .bin format.')
+    parser.add_argument('paths', nargs='+', help='captures, or directories to search for them')
+    parser.add_argument('--jobs', '-j', type=int, default=None, help='worker processes, all cores by default')
+    parser.add_argument('--force', action='store_true', help='also translate captures whose .bin is newer than them')
+    args = parser.parse_args(argv[1:])
+
+    #a single named file is always translated, in process so --profile sees
+    #the stages
+    if len(args.paths) == 1 and not os.path.isdir(args.paths[0]):
+        print(describe(translate_file(args.paths[0])))
+        return
+
+    translate_batch(args.paths, args.jobs, args.force)
 
+if __name__ == '__main__':
+    argv, run = profiling.parse_argv(sys.argv)
+    run(main, argv)
@@ -5,51 +5,143 @@ import mmap
 import enum
 import re
 import itertools
+import argparse
+import signal
 
-try:
+import sources
+
+HEAD_FMT = '=Idqi' #sequence, timestamp, gametime, deaths
+PLAYER_STATE_FMT = '=fffffffiiBB'
+INPUT_STATE_FMT = '=BBff' #buttons, directions, aim x, aim y
+
+#bits of the buttons and directions bytes of the input block
+BUTTONS = ['jump', 'dash', 'grab', 'demo']
+DIRECTIONS = ['right', 'left', 'up', 'down']
+
+#records written with --output: recorder stamp and payload size, then the
+#payload exactly as read from the shared file
+RECORD = struct.Struct('=dH')
+EXTENSION = '.tuw'
+
+class Stats():
+    def __init__(self):
+        self.start = time.time()
+        self.cpu_start = time.process_time()
+        self.polls = 0
+        self.unique = 0
+        self.skipped = 0
+
+    def __str__(self):
+        wall = time.time()-self.start
+        cpu = time.process_time()-self.cpu_start
+        return (f'{self.unique} states read in {wall:.1f} s over {self.polls} polls, '
+            + f'{self.skipped} sequence numbers missed, '
+            + f'{cpu:.2f} s cpu ({cpu/max(wall, 1e-9)*100:.1f}%)')
+
+def parse(raw):
+    sequence, timestamp, gametime, deaths = struct.unpack(HEAD_FMT, raw[:24])
+    raw = raw[24:]
+
+    room, raw = raw.split(b'\x00', maxsplit=1)
+    room = room.decode('ascii')
+
+    size = struct.calcsize(PLAYER_STATE_FMT)
+    player_state = struct.unpack(PLAYER_STATE_FMT, raw[:size])
+    raw = raw[size:]
+
+    size = struct.calcsize(INPUT_STATE_FMT)
+    input_state = struct.unpack(INPUT_STATE_FMT, raw[:size])
+    raw = raw[size:]
+
+    return sequence, timestamp, gametime, deaths, room, player_state, input_state
+
+def read_records(filename):
+    """
+    (stamp, payload) of every record in a file written with --output
+    """
+    with open(filename, 'rb') as fp:
+        raw = fp.read()
+    offset = 0
+    while offset+RECORD.size <= len(raw):
+        stamp, size = RECORD.unpack_from(raw, offset)
+        offset += RECORD.size
+        if offset+size > len(raw):
+            break
+        yield stamp, raw[offset:offset+size]
+        offset += size
+
+def monitor(fp, stats, interval=0.1, quiet=False, out=None):
+    """
+    out is an open file to append every new state to
+    """
     last_sequence = None
-    with open('/tmp/celeste_tuw.share', 'r+b') as fx:
-        with mmap.mmap(fx.fileno(), 0) as fp:
-            while True:
-                time.sleep(0.1)
-                fp.seek(0)
-                size_raw = fp.read(2)
-                size = struct.unpack('=H', size_raw)[0]
+    while True:
+        time.sleep(interval)
+        stats.polls += 1
+        fp.seek(0)
+        size_raw = fp.read(2)
+        size = struct.unpack('=H', size_raw)[0]
 
-                if size == 0:
-                    continue
+        if size == 0:
+            continue
 
-                raw = fp.read(size)
+        raw = fp.read(size)
 
-                sequence, timestamp, gametime, deaths = struct.unpack('=Idqi', raw[:24])
-                raw = raw[24:]
+        sequence, timestamp, gametime, deaths, room, player_state, input_state = parse(raw)
 
-                if sequence == last_sequence:
-                    continue
-                last_sequence = sequence
+        if sequence == last_sequence:
+            continue
+        if last_sequence is not None and sequence > last_sequence+1:
+            stats.skipped += sequence-last_sequence-1
+        last_sequence = sequence
+        stats.unique += 1
 
-                room, raw = raw.split(b'\x00', maxsplit=1)
-                room = room.decode('ascii')
+        if out is not None:
+            out.write(RECORD.pack(time.time(), size) + raw)
+            out.flush()
 
-                player_state_fmt = '=fffffffiiBB'
-                size = struct.calcsize(player_state_fmt)
-                player_state = struct.unpack(player_state_fmt, raw[:size])
-                raw = raw[size:]
-                (xpos, ypos, xvel, yvel, samina, xlift, ylift, state, dashes, control, status) = player_state
+        (xpos, ypos, xvel, yvel, samina, xlift, ylift, state, dashes, control, status) = player_state
 
-                input_state_fmt = '=BBff'
-                size = struct.calcsize(input_state_fmt)
-                input_state = struct.unpack(input_state_fmt, raw[:size])
-                raw = raw[size:]
+        if not quiet:
+            print(sequence, timestamp, gametime, deaths, room)
+            print(player_state)
+            print(input_state)
+            print()
 
-                print(sequence, timestamp, gametime, deaths, room)
-                print(player_state)
-                print(input_state)
-                print()
+def stop(signum, frame):
+    raise KeyboardInterrupt
 
+def main(argv):
+    parser = argparse.ArgumentParser(description='Watch the tuw shared file.')
+    parser.add_argument('--source', default=None, help=f'shared file to read instead of {sources.TUW_PATH}')
+    parser.add_argument('--interval', type=float, default=None,
+        help='seconds between polls, 0.1 or 0.001 with --output so no frame is missed')
+    parser.add_argument('--output', '-o', default=None,
+        help=f'keep every state, inputs included, in this file (<timestamp>{EXTENSION} if given as -)')
+    parser.add_argument('--quiet', '-q', action='store_true')
+    args = parser.parse_args(argv[1:])
 
-except KeyboardInterrupt:
-    pass
+    outfile = args.output
+    if outfile == '-':
+        outfile = time.strftime('%Y-%m-%d-%H%M%S')+EXTENSION
+    interval = args.interval
+    if interval is None:
+        interval = 0.1 if outfile is None else 0.001
 
+    #stop cleanly when killed by a test harness too
+    signal.signal(signal.SIGTERM, stop)
 
+    stats = Stats()
+    try:
+        with sources.open_tuw(args.source) as fp:
+            if outfile is None:
+                monitor(fp, stats, interval, args.quiet)
+            else:
+                with open(outfile, 'ab') as out:
+                    monitor(fp, stats, interval, args.quiet, out)
+    except KeyboardInterrupt:
+        pass
+    print(stats)
 
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,231 @@
+"""
+Map run timestamps onto frames of gameplay recordings and write edit lists.
+
+Capture stamps are wall clock time.time() values, so all that is needed to line
+a recording up is the wall clock time of its first frame and its frame rate.
+"""
+import sys
+import os
+import math
+import bisect
+import contextlib
+import argparse
+import datetime
+
+from decode import RoomSet
+
+class Video():
+    def __init__(self, path, start, fps, duration=None):
+        self.path = path
+        self.start = start
+        self.fps = fps
+        self.duration = duration
+
+    def end(self):
+        if self.duration is None:
+            return math.inf
+        return self.start + self.duration
+
+    def frame(self, stamp):
+        return (stamp - self.start)*self.fps
+
+def parse_time(text):
+    """
+    Accepts either a unix timestamp or a local ISO date time, e.g.
+    2023-05-10T14:20:30.5
+    """
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.datetime.fromisoformat(text).timestamp()
+
+class RunTable():
+    """
+    Run summaries from one or more capture indices, sorted by start stamp.
+    """
+    def __init__(self, roomsets):
+        rows = []
+        for roomset in roomsets:
+            runs = roomset.runs
+            for idx in range(len(runs['room'])):
+                rows.append((
+                    runs['start_stamp'][idx], runs['end_stamp'][idx],
+                    runs['room'][idx], runs['dead'][idx], runs['nocontrol'][idx],
+                    runs['savestate'][idx], roomset.infile,
+                    ))
+        rows.sort()
+
+        self.start_stamps = [x[0] for x in rows]
+        self.end_stamps = [x[1] for x in rows]
+        self.rooms = [x[2] for x in rows]
+        self.dead = [x[3] for x in rows]
+        self.nocontrol = [x[4] for x in rows]
+        self.savestate = [x[5] for x in rows]
+        self.sources = [x[6] for x in rows]
+
+    def __len__(self):
+        return len(self.start_stamps)
+
+    def select_first_last(self):
+        first = {}
+        last = {}
+        for idx, room in enumerate(self.rooms):
+            if not room in first:
+                first[room] = idx
+            last[room] = idx
+        return sorted(set(first.values()) | set(last.values()))
+
+    def is_clear(self, idx):
+        """
+        Same as query.Query.clears, the run left the room without dying,
+        losing control or loading a savestate
+        """
+        return not (self.dead[idx] or self.nocontrol[idx] or self.savestate[idx])
+
+    def select_clears(self):
+        return [idx for idx in range(len(self)) if self.is_clear(idx)]
+
+    def select_deaths(self):
+        return [idx for idx in range(len(self)) if self.dead[idx]]
+
+    def select_all(self):
+        return list(range(len(self)))
+
+    def select_room(self, selected, room):
+        return [idx for idx in selected if self.rooms[idx] == room]
+
+SELECTIONS = {
+    'first-last': lambda table: table.select_first_last(),
+    'clears': lambda table: table.select_clears(),
+    'deaths': lambda table: table.select_deaths(),
+    'all': lambda table: table.select_all(),
+    }
+
+class Clip():
+    def __init__(self, video, first, last, runs):
+        self.video = video
+        self.first = first
+        self.last = last
+        self.runs = runs
+
+    def inpoint(self):
+        return self.first/self.video.fps
+
+    def outpoint(self):
+        return (self.last+1)/self.video.fps
+
+    def __repr__(self):
+        return f'{os.path.basename(self.video.path)} {self.first}-{self.last} ({len(self.runs)} runs)'
+
+def make_clips(table, selected, videos, pad=0.5, merge=True):
+    """
+    Convert selected runs into frame ranges of whichever video contains their
+    start. Runs outside every video are dropped. Overlapping ranges in the same
+    video are merged.
+
+    pad is in seconds on either side of each run.
+    """
+    videos = sorted(videos, key=lambda x: x.start)
+    starts = [x.start for x in videos]
+    selected = sorted(selected)
+
+    clips = []
+    for idx in selected:
+        start_stamp = table.start_stamps[idx]
+        vidx = bisect.bisect_right(starts, start_stamp)-1
+        if vidx < 0:
+            continue
+        video = videos[vidx]
+        end = video.end()
+        if vidx+1 < len(videos):
+            end = min(end, videos[vidx+1].start)
+        if start_stamp >= end:
+            continue
+
+        first = max(0, math.floor(video.frame(start_stamp-pad)))
+        last = math.ceil(video.frame(min(table.end_stamps[idx]+pad, end)))-1
+
+        if merge and len(clips) > 0 and clips[-1].video is video and first <= clips[-1].last+1:
+            clips[-1].last = max(clips[-1].last, last)
+            clips[-1].runs.append(idx)
+        else:
+            clips.append(Clip(video, first, last, [idx]))
+
+    return clips
+
+def timecode(frame, fps):
+    base = round(fps)
+    frames = frame%base
+    seconds = frame//base
+    return f'{seconds//3600:02d}:{(seconds//60)%60:02d}:{seconds%60:02d}:{frames:02d}'
+
+def write_edl(fp, clips, title='celeste_mon'):
+    """
+    CMX 3600 edit decision list.
+    """
+    fp.write(f'TITLE: {title}\n')
+    fp.write('FCM: NON-DROP FRAME\n\n')
+    record = 0
+    for idx, clip in enumerate(clips):
+        fps = clip.video.fps
+        length = clip.last+1-clip.first
+        src_in = timecode(clip.first, fps)
+        src_out = timecode(clip.last+1, fps)
+        rec_in = timecode(record, fps)
+        rec_out = timecode(record+length, fps)
+        record += length
+        fp.write(f'{idx+1:03d}  AX       V     C        {src_in} {src_out} {rec_in} {rec_out}\n')
+        fp.write(f'* FROM CLIP NAME: {os.path.basename(clip.video.path)}\n\n')
+
+def write_ffconcat(fp, clips):
+    """
+    ffmpeg concat demuxer script, use with
+    ffmpeg -f concat -safe 0 -i list.txt -c copy out.mp4
+    """
+    fp.write('ffconcat version 1.0\n')
+    for clip in clips:
+        path = clip.video.path.replace("'", "'\\''")
+        fp.write(f"file '{path}'\n")
+        fp.write(f'inpoint {clip.inpoint():.3f}\n')
+        fp.write(f'outpoint {clip.outpoint():.3f}\n')
+
+WRITERS = {
+    'edl': write_edl,
+    'ffconcat': write_ffconcat,
+    }
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Cut recordings down to selected runs.')
+    parser.add_argument('captures', nargs='+', help='capture files (.dat)')
+    parser.add_argument('--video', nargs=2, action='append', required=True, metavar=('PATH', 'START'),
+        help='recording and the wall clock time of its first frame. repeat for multiple recordings')
+    parser.add_argument('--fps', type=float, default=60)
+    parser.add_argument('--select', default='first-last', choices=SELECTIONS.keys())
+    parser.add_argument('--room', default=None, help='only keep selected runs in this room')
+    parser.add_argument('--pad', type=float, default=0.5, help='seconds of padding around each run')
+    parser.add_argument('--format', default='ffconcat', choices=WRITERS.keys())
+    parser.add_argument('--output', '-o', default=None)
+    args = parser.parse_args(argv[1:])
+
+    #the edit list may go to stdout, so index generation and decode warnings go
+    #to stderr
+    with contextlib.redirect_stdout(sys.stderr):
+        table = RunTable([RoomSet(x) for x in args.captures])
+    videos = [Video(path, parse_time(start), args.fps) for path, start in args.video]
+
+    selected = SELECTIONS[args.select](table)
+    if args.room is not None:
+        selected = table.select_room(selected, args.room)
+    clips = make_clips(table, selected, videos, pad=args.pad)
+
+    frames = sum(x.last+1-x.first for x in clips)
+    print(f'{len(selected)} of {len(table)} runs selected, {len(clips)} clips, {frames/args.fps:.1f} s', file=sys.stderr)
+
+    if args.output is None:
+        WRITERS[args.format](sys.stdout, clips)
+    else:
+        with open(args.output, 'w') as fp:
+            WRITERS[args.format](fp, clips)
+
+if __name__ == '__main__':
+    main(sys.argv)
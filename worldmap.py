@@ -0,0 +1,353 @@
+"""
+Chapter scale map of the rooms of a capture, stitched by absolute position.
+
+Rooms of different chapters share coordinates, and often names (a-00, ...), so
+a map is drawn per chapter, see chapters. Room bounds come from the run table
+of the index, so laying out the map needs no capture reads. Each room is rasterized once per zoom level (level 0 is one
+map pixel per game pixel, each level halves that) as a point density image,
+see lod.density_image, cut into TILE x TILE pixel tiles aligned to a world grid,
+and stored in <capture>_map.npz under
+
+    <chapter>/<room>/<level>/<tile x>/<tile y>  uint8 RGBA tile
+    <chapter>/<room>/tiles                      (level, tile x, tile y) of every tile
+
+Composing a view only reads the tiles it covers from the cache and lays them
+over each other, so a whole chapter renders without loading any runs once the
+rooms have been rasterized.
+
+    worldmap.py <data file> [room name ...] [--chapter N] [--level N] [--output <image>]
+"""
+import sys
+import os
+import bisect
+import argparse
+from collections import defaultdict
+
+import numpy as np
+
+from columns import Columns, cache_valid, cache_version
+from lod import density_image
+
+#pixels per side of a cached tile
+TILE = 256
+LEVELS = 6
+
+def map_file(roomset):
+    return os.path.splitext(roomset.infile)[0]+'_map.npz'
+
+def union(a, b):
+    return [min(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3])]
+
+def overlaps(a, b):
+    return a[0] <= b[1] and b[0] <= a[1] and a[2] <= b[3] and b[2] <= a[3]
+
+class Chapter():
+    def __init__(self):
+        #(xmin, xmax, ymin, ymax) and run table start offsets of every room
+        self.bounds = {}
+        self.starts = {}
+
+    def add(self, name, box, starts):
+        if name in self.bounds:
+            box = union(self.bounds[name], box)
+        self.bounds[name] = box
+        self.starts.setdefault(name, set()).update(starts)
+
+    def matches(self, other):
+        """
+        True if other visits a room of the same name at the same place
+        """
+        return any(name in self.bounds and overlaps(self.bounds[name], box) for name, box in other.bounds.items())
+
+    def merge(self, other):
+        for name, box in other.bounds.items():
+            self.add(name, box, other.starts[name])
+
+def chapters(roomset):
+    """
+    Rooms of the capture grouped by chapter, in order of first visit. Room
+    names do not say which chapter they are in, so the run table is cut where
+    the chapter timer restarts (see quality.py) and the pieces are joined back
+    up when they visit a room of the same name at overlapping bounds, i.e. the
+    chapter was retried or entered again.
+    """
+    import quality
+
+    table = roomset.runs
+    cuts = sorted(x['offset'] for x in quality.session_report(roomset)['jumps'] if x['kind'] == 'restart')
+    pieces = defaultdict(Chapter)
+    for idx, name in enumerate(table['room']):
+        box = [table[x][idx] for x in ['xmin', 'xmax', 'ymin', 'ymax']]
+        if None in box:
+            continue
+        start = table['start'][idx]
+        pieces[bisect.bisect_right(cuts, start)].add(name, box, [start])
+
+    result = []
+    for _, piece in sorted(pieces.items()):
+        for chapter in result:
+            if chapter.matches(piece):
+                chapter.merge(piece)
+                break
+        else:
+            result.append(piece)
+    return result
+
+def cell_size(level):
+    """
+    Game pixels per map pixel
+    """
+    return 1<<level
+
+def render_room(cols, dead, levels=LEVELS):
+    """
+    Cached arrays for one room, without the room prefix
+    """
+    point_dead = np.asarray(dead, dtype=bool)[cols.run]
+    arrays = {}
+    tiles = []
+    for level in range(levels):
+        size = cell_size(level)
+        px = np.floor(cols.x/size).astype(np.int64)
+        py = np.floor(cols.y/size).astype(np.int64)
+        #whole tiles of the world grid around the room
+        tx0 = px.min()//TILE
+        ty0 = py.min()//TILE
+        width = (px.max()//TILE-tx0+1)*TILE
+        height = (py.max()//TILE-ty0+1)*TILE
+        cells = (py-ty0*TILE)*width + px-tx0*TILE
+
+        shape = (height, width)
+        dead_counts = np.bincount(cells[point_dead], minlength=width*height).reshape(shape)
+        clear_counts = np.bincount(cells[~point_dead], minlength=width*height).reshape(shape)
+        rgba = (density_image(dead_counts, clear_counts)*255).astype(np.uint8)
+
+        for ty in range(height//TILE):
+            for tx in range(width//TILE):
+                tile = rgba[ty*TILE:(ty+1)*TILE, tx*TILE:(tx+1)*TILE]
+                if not tile[..., 3].any():
+                    continue
+                key = (level, tx0+tx, ty0+ty)
+                arrays['/'.join(str(x) for x in key)] = tile
+                tiles.append(key)
+    arrays['tiles'] = np.array(tiles, dtype=np.int64).reshape(-1, 3)
+    return arrays
+
+class WorldMap():
+    def __init__(self, roomset, chapter=0, rooms=None, levels=LEVELS):
+        """
+        chapter indexes chapters(roomset), rooms limits the map to some rooms
+        of it, all by default
+        """
+        self.roomset = roomset
+        self.filename = map_file(roomset)
+        self.levels = levels
+        self.chapter = chapter
+        found = chapters(roomset)
+        if chapter >= len(found):
+            raise RuntimeError(f'Chapter {chapter} of {len(found)} is not in {roomset.infile}')
+        self.starts = found[chapter].starts
+        self.bounds = found[chapter].bounds
+        if rooms is not None:
+            self.bounds = {x: self.bounds[x] for x in rooms if x in self.bounds}
+        self.data = None
+        self.update()
+
+    def key(self, name):
+        return f'{self.chapter}/{name}'
+
+    def update(self):
+        """
+        Rasterize rooms missing from the cache, then keep it open so tiles are
+        only read when they are composed
+        """
+        roomset = self.roomset
+        arrays = {}
+        if cache_valid(self.filename, roomset.infile):
+            with np.load(self.filename) as data:
+                done = {x[:-len('/tiles')] for x in data.files if x.endswith('/tiles')}
+                missing = [x for x in self.bounds if self.key(x) not in done]
+                if len(missing) > 0:
+                    arrays = dict(data)
+        else:
+            missing = list(self.bounds)
+
+        if len(missing) > 0:
+            for name in missing:
+                print(f'Rendering {name}...')
+                #only the runs of this chapter's room of that name
+                starts = self.starts[name]
+                runs = [x for room in roomset.get_room(name) for x in room.runs if x.msgs[0].file_start_idx in starts]
+                room = render_room(Columns.from_runs(runs), [x.dead for x in runs], self.levels)
+                arrays.update({f'{self.key(name)}/{k}': v for k, v in room.items()})
+            arrays.update(cache_version())
+            np.savez_compressed(self.filename, **arrays)
+
+        if self.data is not None:
+            self.data.close()
+        self.data = np.load(self.filename)
+        self.composed = {}
+        self.tiles = defaultdict(list)
+        for name in self.bounds:
+            for level, tx, ty in self.data[f'{self.key(name)}/tiles']:
+                self.tiles[level, tx, ty].append(name)
+
+    def extent(self):
+        boxes = np.array(list(self.bounds.values()))
+        return boxes[:,0].min(), boxes[:,1].max(), boxes[:,2].min(), boxes[:,3].max()
+
+    def level_for(self, pixel):
+        """
+        Coarsest level with map pixels no bigger than pixel game pixels
+        """
+        level = 0
+        while level+1 < self.levels and cell_size(level+1) <= pixel:
+            level += 1
+        return level
+
+    def compose(self, level, view=None):
+        """
+        RGBA image of the tiles of a level covering view (xmin, xmax, ymin,
+        ymax), the whole map by default, and its extent
+        """
+        if view is None:
+            view = self.extent()
+        span = TILE*cell_size(level)
+        xmin, xmax, ymin, ymax = view
+        tx0 = int(np.floor(xmin/span))
+        tx1 = int(np.floor(xmax/span))
+        ty0 = int(np.floor(ymin/span))
+        ty1 = int(np.floor(ymax/span))
+
+        rgba = np.zeros(((ty1-ty0+1)*TILE, (tx1-tx0+1)*TILE, 4), dtype=np.float32)
+        for ty in range(ty0, ty1+1):
+            for tx in range(tx0, tx1+1):
+                tile = self.tile(level, tx, ty)
+                if tile is not None:
+                    rgba[(ty-ty0)*TILE:(ty-ty0+1)*TILE, (tx-tx0)*TILE:(tx-tx0+1)*TILE] = tile
+        return rgba, (tx0*span, (tx1+1)*span, ty0*span, (ty1+1)*span)
+
+    def tile(self, level, tx, ty):
+        """
+        One map tile with the tiles of every room in it laid over each other,
+        kept once composed so panning only reads new tiles
+        """
+        key = (level, tx, ty)
+        names = self.tiles.get(key, [])
+        if len(names) == 0:
+            return None
+        if key not in self.composed:
+            out = np.zeros((TILE, TILE, 4), dtype=np.float32)
+            for name in names:
+                tile = self.data[f'{self.key(name)}/{level}/{tx}/{ty}'].astype(np.float32)/255
+                alpha = tile[..., 3:]
+                out[..., :3] = tile[..., :3]*alpha + out[..., :3]*(1-alpha)
+                out[..., 3:] = alpha + out[..., 3:]*(1-alpha)
+            self.composed[key] = out
+        return self.composed[key]
+
+class MapLayer():
+    """
+    Draws a WorldMap on an axis, recomposing the visible tiles at a matching
+    level when the view changes
+    """
+    def __init__(self, ax, worldmap):
+        from decode import Bounds
+
+        self.ax = ax
+        self.worldmap = worldmap
+        self.image = None
+        for name, box in worldmap.bounds.items():
+            bounds = Bounds()
+            bounds.bounds = list(box)
+            bounds.plot(ax, '0.5', 'none')
+            ax.text(box[0], box[3], name, fontsize=6, va='bottom')
+        xmin, xmax, ymin, ymax = worldmap.extent()
+        ax.update_datalim([(xmin, ymin), (xmax, ymax)])
+        ax.autoscale_view()
+
+        self.last = None
+        ax.callbacks.connect('xlim_changed', self.on_limits)
+        ax.callbacks.connect('ylim_changed', self.on_limits)
+        self.update()
+
+    def on_limits(self, ax):
+        view = (ax.get_xlim(), ax.get_ylim())
+        if view == self.last:
+            return
+        self.update()
+        ax.figure.canvas.draw_idle()
+
+    def update(self):
+        from matplotlib.image import AxesImage
+
+        self.last = (self.ax.get_xlim(), self.ax.get_ylim())
+        xmin, xmax = sorted(self.ax.get_xlim())
+        ymin, ymax = sorted(self.ax.get_ylim())
+        bbox = self.ax.get_window_extent()
+        pixel = max((xmax-xmin)/max(bbox.width, 1), (ymax-ymin)/max(bbox.height, 1))
+
+        rgba, extent = self.worldmap.compose(self.worldmap.level_for(pixel), (xmin, xmax, ymin, ymax))
+        #a new image rather than set_extent, which would move the data limits
+        if self.image is not None:
+            self.image.remove()
+        self.image = AxesImage(self.ax, origin='lower', interpolation='nearest', extent=extent, zorder=-1)
+        self.image.set_data(rgba)
+        self.ax.add_image(self.image)
+
+def main(argv):
+    import matplotlib
+
+    parser = argparse.ArgumentParser(description='Map of every room of a capture per chapter, from cached raster tiles.')
+    parser.add_argument('capture')
+    parser.add_argument('rooms', nargs='*', help='only these rooms, all by default')
+    parser.add_argument('--chapter', type=int, default=None, help='only this chapter, every chapter by default')
+    parser.add_argument('--level', type=int, default=None, help='zoom level of --output, 0 is one pixel per game pixel')
+    parser.add_argument('--width', type=int, default=4000, help='pick the level of --output to fit this many pixels')
+    parser.add_argument('--output', '-o', default=None,
+        help='save each map to an image instead of showing a window, <output>_<chapter> with several chapters')
+    args = parser.parse_args(argv[1:])
+
+    if args.output is not None:
+        matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+    from decode import RoomSet
+
+    roomset = RoomSet(args.capture)
+    found = chapters(roomset)
+    for idx, chapter in enumerate(found):
+        names = list(chapter.bounds)
+        print(f'chapter {idx}: {len(names)} rooms, {names[0]} to {names[-1]}')
+    indices = range(len(found)) if args.chapter is None else [args.chapter]
+    if args.chapter is not None and not 0 <= args.chapter < len(found):
+        parser.error(f'--chapter {args.chapter}, the capture has {len(found)} chapters')
+    rooms = args.rooms if len(args.rooms) > 0 else None
+    maps = [WorldMap(roomset, idx, rooms) for idx in indices]
+    maps = [x for x in maps if len(x.bounds) > 0]
+    if len(maps) == 0:
+        parser.error('no rooms to map')
+
+    if args.output is not None:
+        base, ext = os.path.splitext(args.output)
+        for worldmap in maps:
+            outfile = args.output if len(maps) == 1 else f'{base}_{worldmap.chapter}{ext}'
+            level = args.level
+            if level is None:
+                xmin, xmax, _, _ = worldmap.extent()
+                level = worldmap.level_for((xmax-xmin)/args.width)
+            rgba, extent = worldmap.compose(level)
+            plt.imsave(outfile, rgba, origin='lower')
+            print(f'{outfile}: chapter {worldmap.chapter}, {len(worldmap.bounds)} rooms, level {level}, '
+                + f'{rgba.shape[1]}x{rgba.shape[0]} pixels')
+        return
+
+    layers = []
+    for worldmap in maps:
+        fig, ax = plt.subplots()
+        ax.set_title(f'{os.path.basename(args.capture)} chapter {worldmap.chapter}')
+        ax.set_aspect('equal')
+        layers.append(MapLayer(ax, worldmap))
+    plt.show()
+
+if __name__ == '__main__':
+    main(sys.argv)